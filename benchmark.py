@@ -0,0 +1,312 @@
+import sys
+import os
+sys.path.insert(0, "./src")
+
+import json
+import shutil
+import subprocess
+import time
+import tracemalloc
+import argparse
+import datetime as dt
+
+from src.dictionaries import YEAR_NOW
+
+from src.synthetic import synthetic_response, write_synthetic_group
+
+from src.storage import read_site_data
+
+from src.fonctions import (
+    aggregate_month_counts,
+    build_csv_data,
+    build_rate_tables,
+    compute_rates,
+    find_outliers,
+    get_month_datetimes,
+    get_outliers,
+)
+
+
+def run_stage(name, rows, function, *args):
+    """
+    Time a stage, then run it again under tracemalloc for its peak
+    python/numpy memory. rows = None counts the rows of the stage result.
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    if rows is None:
+        rows = len(result)
+    report = {
+        "stage": name,
+        "seconds": seconds,
+        "rows": rows,
+        "rows_per_second": rows / seconds if seconds > 0 else None,
+        "peak_memory_mb": peak / 2**20,
+    }
+    return result, report
+
+
+def legacy_compute_rates(site, data, month):
+    """
+    compute_rates() once by (id, month), as the former compute_rates.py
+    """
+    months = data["date"].dt.month
+    for id in data["id"].unique():
+        id_data = data[data["id"] == id]
+        acc_count, acc_lost, acc_indisponibility_lost = 2, 0, 0
+        for m in range(1, month + 1):
+            (_,
+             acc_count,
+             acc_lost,
+             acc_indisponibility_lost,
+             _,
+             _) = compute_rates(
+                site,
+                id_data[months[id_data.index] == m],
+                acc_count,
+                acc_lost,
+                acc_indisponibility_lost
+            )
+
+
+def legacy_outliers(data):
+    for id in data["id"].unique():
+        get_outliers(data[data["id"] == id])
+
+
+def build_month_files(responses, out_file):
+    for response in responses:
+        build_csv_data(response, out_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""
+This script benchmark the tauxfo pipeline
+on synthetic 15 minutes station data :
+-   build_csv_data()
+-   site CSV loading
+-   compute_rates() by id and month
+-   group rate engine
+-   get_outliers() by id and find_outliers()
+-   python -m compute_rates end to end
+            """,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "-w",
+        "--workdir",
+        type=str,
+        default="./benchmark",
+        help="Synthetic data directory (deleted at the end unless -keep)",
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-y",
+        "--year",
+        type=int,
+        help="Synthetic year",
+        default=YEAR_NOW - 1,
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-n",
+        "--sites",
+        type=int,
+        help="Number of sites",
+        default=2,
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-m",
+        "--measures",
+        type=int,
+        help="Number of measures by site",
+        default=5,
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-gr",
+        "--gap_rate",
+        type=float,
+        help="Share of missing quarter-hours",
+        default=0.01,
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-sm",
+        "--state_mix",
+        type=json.loads,
+        help="""State code probabilities as json,
+        like '{"A": 0.9, "N": 0.1}'""",
+        default=None,
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-r",
+        "--report",
+        type=str,
+        help="Write the benchmark report as json",
+        default=None,
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-legacy",
+        action="store_true",
+        help="Also time compute_rates() by id and month (slow)",
+    )
+    parser.add_argument(
+        "-keep",
+        action="store_true",
+        help="Keep the synthetic data",
+    )
+
+    args = parser.parse_args()
+    group = "BENCH"
+    year = args.year
+    reports = []
+
+    print("Generating synthetic data ...")
+    site_files = write_synthetic_group(
+        args.workdir,
+        year,
+        group,
+        args.sites,
+        args.measures,
+        state_mix=args.state_mix,
+        gap_rate=args.gap_rate,
+    )
+    first_site, first_file = next(iter(site_files.items()))
+    measures_id = [f"{first_site}_M{j:02d}" for j in range(args.measures)]
+
+    responses = [
+        synthetic_response(
+            measures_id,
+            *get_month_datetimes(f"{year}-01-01T00:00:00Z", month),
+            state_mix=args.state_mix,
+            gap_rate=args.gap_rate,
+        )
+        for month in range(1, 13)
+    ]
+    rows = sum(len(m["base"]) for response in responses for m in response)
+    out_file = f"{args.workdir}/build_csv_data.csv"
+    _, report = run_stage(
+        "build_csv_data", rows, build_month_files, responses, out_file
+    )
+    reports.append(report)
+    os.remove(out_file)
+
+    data, report = run_stage(
+        "load_site_csv",
+        None,
+        read_site_data,
+        first_file,
+        "csv",
+        ["date", "id", "value", "state"],
+    )
+    reports.append(report)
+    rows = len(data)
+
+    if args.legacy:
+        _, report = run_stage(
+            "compute_rates", rows, legacy_compute_rates, first_site, data, 12
+        )
+        reports.append(report)
+
+    counts, report = run_stage(
+        "aggregate_month_counts",
+        rows,
+        aggregate_month_counts,
+        first_site,
+        data,
+        12,
+    )
+    reports.append(report)
+
+    phy_names = {id: id[-4:] for id in measures_id}
+    _, report = run_stage(
+        "build_rate_tables",
+        rows,
+        build_rate_tables,
+        first_site,
+        counts,
+        phy_names,
+        year,
+        12,
+    )
+    reports.append(report)
+
+    _, report = run_stage("get_outliers", rows, legacy_outliers, data)
+    reports.append(report)
+
+    _, report = run_stage("find_outliers", rows, find_outliers, data)
+    reports.append(report)
+
+    total_rows = rows * len(site_files)
+    start = time.perf_counter()
+    subprocess.run(
+        [
+            sys.executable, "-m", "compute_rates",
+            "-y", str(year),
+            "-g", group,
+            "-i", args.workdir,
+            "-o", args.workdir,
+            "-sl", f"{args.workdir}/data",
+            "-full",
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    seconds = time.perf_counter() - start
+    reports.append(
+        {
+            "stage": "compute_rates_end_to_end",
+            "seconds": seconds,
+            "rows": total_rows,
+            "rows_per_second": total_rows / seconds,
+            "peak_memory_mb": None,
+        }
+    )
+    try:
+        import resource
+        reports[-1]["peak_memory_mb"] = (
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 2**10
+        )
+    except ImportError:
+        pass
+
+    print(f"{'stage':<26}{'seconds':>10}{'rows':>12}"
+          f"{'rows/s':>14}{'peak MB':>10}")
+    for report in reports:
+        peak = report["peak_memory_mb"]
+        print(
+            f"{report['stage']:<26}"
+            f"{report['seconds']:>10.3f}"
+            f"{report['rows']:>12}"
+            f"{report['rows_per_second']:>14.0f}"
+            f"{'' if peak is None else f'{peak:.1f}':>10}"
+        )
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(
+                {
+                    "date": dt.datetime.now().isoformat(),
+                    "sites": args.sites,
+                    "measures": args.measures,
+                    "gap_rate": args.gap_rate,
+                    "stages": reports,
+                },
+                f,
+                indent=1,
+            )
+
+    if not args.keep:
+        shutil.rmtree(args.workdir)
@@ -1,28 +1,299 @@
 import sys
 import os
+import io
 import shutil
 sys.path.insert(0, "./src")
 
-import pandas as pd
-import calendar
 import datetime as dt
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
 from tqdm import tqdm
 
 from src.dictionaries import (
+    DATA_FORMATS,
+    DATATYPE_SLOTS,
+    LEASE_TTL,
+    PERT_REPPORT_FILE_NAME,
     RATE_FILE_NAMES_DIC,
-    RATE_VAR_DIC,
     RATE_VARS,
     YEAR_NOW,
     GROUP_LIST,
     )
 
+from src.storage import group_folder, iter_site_data, site_data_path
+
+from src.manifest import read_manifest
+
+from src.metadata import load_metadata
+
+from src.metrics import (
+    add_records,
+    collect_records,
+    enable_metrics,
+    metrics_enabled,
+    timed,
+    write_run_report,
+)
+
+from src.workqueue import init_queue, run_queue, task_id, task_result
+
+from src.checkpoint import (
+    checkpoint_path,
+    read_checkpoint,
+    site_data_parts,
+    write_checkpoint,
+)
+
 from src.fonctions import (
-    compute_rates,
+    build_rate_tables,
+    combine_month_counts,
+    complete_month_counts,
+    count_months,
+    append_rate_table,
     list_of_strings,
-    current_days
+    write_rate_files,
 )
 
+
+# Columns read to compute rates
+RATE_COLUMNS = ["date", "id", "value", "state"]
+
+
+def compute_site(site, site_path, data_format, phy_names, year, month,
+                 entry=None, checkpoint_file=None, full=False, metrics=False,
+                 chunksize=None, datatype="base"):
+    """
+    Read a site data and compute its rate tables, see site_rate_tables()
+
+    Returns the rate tables, the pert repport and the metrics records of
+    the site only (empty when metrics is False), to be labelled with its
+    group and sent back to the main process when sites are computed in
+    worker processes.
+    """
+    if metrics and not metrics_enabled():
+        enable_metrics()
+    with collect_records() as records:
+        rate_tables, pert_repport = site_rate_tables(site,
+                                                     site_path,
+                                                     data_format,
+                                                     phy_names,
+                                                     year,
+                                                     month,
+                                                     entry,
+                                                     checkpoint_file,
+                                                     full,
+                                                     chunksize,
+                                                     datatype)
+    return rate_tables, pert_repport, records
+
+
+def site_rate_tables(site, site_path, data_format, phy_names, year, month,
+                     entry=None, checkpoint_file=None, full=False,
+                     chunksize=None, datatype="base"):
+    """
+    Read a site data and compute its rate tables, see build_rate_tables()
+
+    Monthly counts of each part of the site data are kept in checkpoint_file
+    (when given), so only the parts changed since the last run are read.
+    CSV parts are read by chunks of chunksize rows (when given), so the
+    memory of a site stays bounded whatever its number of measures.
+    datatype is the time step of the site data (base, hour or day).
+    """
+    if checkpoint_file is None or full:
+        checkpoint = {}
+    else:
+        checkpoint = read_checkpoint(checkpoint_file)
+
+    parts = {}
+    for key, fingerprint, read_kwargs in site_data_parts(site_path,
+                                                         data_format,
+                                                         entry,
+                                                         month):
+        part = checkpoint.get(key)
+        if part is None or part["fingerprint"] != fingerprint:
+            chunks = iter_site_data(
+                site_path,
+                data_format,
+                columns=RATE_COLUMNS,
+                chunksize=chunksize,
+                **read_kwargs
+                )
+            chunk_counts = []
+            while True:
+                with timed("load_site_data", site=site) as record:
+                    data = next(chunks, None)
+                    record["rows"] = 0 if data is None else len(data)
+                if data is None:
+                    break
+                with timed("compute_rates", site=site) as record:
+                    chunk_counts.append(count_months(data, month))
+                    record["rows"] = len(data)
+            if len(chunk_counts) == 0:
+                chunk_counts.append(
+                    count_months(pd.DataFrame(columns=RATE_COLUMNS), month)
+                )
+            part = {
+                "fingerprint": fingerprint,
+                "counts": combine_month_counts(chunk_counts),
+            }
+        parts[key] = part
+
+    if checkpoint_file is not None:
+        write_checkpoint(parts, checkpoint_file)
+
+    with timed("compute_rates", site=site):
+        counts = complete_month_counts(
+            site,
+            combine_month_counts([part["counts"] for part in parts.values()]),
+            month
+        )
+        rate_tables, pert_repport = build_rate_tables(
+            site,
+            counts,
+            phy_names,
+            year,
+            month,
+            datatype
+        )
+    return rate_tables, pert_repport
+
+
+def group_rate_buffers(site_tables):
+    """
+    CSV buffers of the rate files of a group, see write_rate_files()
+
+    input :
+    -------
+        site_tables : list
+            (rate_tables, pert_repport) of every site of the group, in site
+            order, from compute_site()
+    return :
+    --------
+        rate_buffers : dict
+            CSV text buffer by rate file name
+    """
+    rate_buffers = {
+        file_name: io.StringIO()
+        for file_name in RATE_FILE_NAMES_DIC.values()
+    }
+    rate_buffers[PERT_REPPORT_FILE_NAME] = io.StringIO()
+    for rate_tables, pert_repport in site_tables:
+        if len(pert_repport) > 0:
+            append_rate_table(
+                pert_repport,
+                rate_buffers[PERT_REPPORT_FILE_NAME]
+            )
+        for var in RATE_VARS:
+            if var not in rate_tables:
+                continue
+            file_name = RATE_FILE_NAMES_DIC[var]
+            append_rate_table(
+                rate_tables[var],
+                rate_buffers[file_name]
+            )
+    return rate_buffers
+
+
+def queue_rates(args, metadata, phy_names, year, month):
+    """
+    Compute the rates of groups as one worker of the queue in args.queue,
+    see queue_group_rates()
+
+    Returns the failed task ids and the metrics records of the worker only
+    (empty without args.metrics), to be merged in the main process when
+    workers run in worker processes (-j).
+    """
+    if args.metrics and not metrics_enabled():
+        enable_metrics()
+    with collect_records() as records:
+        failed = queue_group_rates(args, metadata, phy_names, year, month)
+    return failed, records
+
+
+def queue_group_rates(args, metadata, phy_names, year, month):
+    """
+    Compute the rates of groups as one worker of the queue in args.queue
+
+    Sites are leased one at a time to the workers sharing the queue folder
+    (processes or machines, see run_queue()), their rate tables kept as
+    task results. Once every site is done, a single worker merges them
+    into the group rate files. Groups with a failed site are not written.
+
+    return :
+    --------
+        failed : list
+            Failed task ids
+    """
+    folders = {group: group_folder(group, args.datatype)
+               for group in args.group}
+    group_tasks = {
+        group: [task_id("rates", year, folders[group], site)
+                for site in metadata["sites"][group]]
+        for group in args.group
+    }
+    init_queue(
+        args.queue,
+        {
+            id: {"group": group, "site": site}
+            for group in args.group
+            for id, site in zip(group_tasks[group],
+                                metadata["sites"][group])
+        }
+    )
+
+    def rate_task(id, spec):
+        group, site = spec["group"], spec["site"]
+        data_path = f"{args.indir}/data/{year}/{folders[group]}"
+        rate_tables, pert_repport, records = compute_site(
+            site,
+            site_data_path(data_path, site, args.format),
+            args.format,
+            phy_names,
+            year,
+            month,
+            read_manifest(data_path).get(site),
+            checkpoint_path(args.outdir, year, folders[group], site),
+            args.full,
+            bool(args.metrics),
+            args.chunksize,
+            args.datatype,
+        )
+        for record in records:
+            record["group"] = group
+        add_records(records)
+        print(f"{group} {site} done")
+        return rate_tables, pert_repport
+
+    states = run_queue(
+        args.queue,
+        rate_task,
+        [id for ids in group_tasks.values() for id in ids],
+        ttl=args.lease_ttl,
+    )
+    failed = [id for id, state in states.items() if state == "failed"]
+
+    def merge_task(id, spec):
+        for group in args.group:
+            if any(states[id] == "failed" for id in group_tasks[group]):
+                print(f"{group} has failed sites, rate files not written")
+                continue
+            rate_buffers = group_rate_buffers(
+                [task_result(args.queue, id) for id in group_tasks[group]]
+            )
+            with timed("write_rate_files", group=group):
+                write_rate_files(
+                    rate_buffers,
+                    f"{args.outdir}/rates/{year}/{folders[group]}"
+                )
+            print(f"{group} rate files written")
+
+    merge_id = task_id("rates", year, "merge")
+    init_queue(args.queue, {merge_id: {"groups": args.group}})
+    run_queue(args.queue, merge_task, [merge_id], ttl=args.lease_ttl)
+    return failed
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="""
@@ -78,12 +349,90 @@ This, for a group of measuring stations.
         default="./data",
         metavar="\b"
     )
+    parser.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        choices=DATA_FORMATS,
+        help="Data storage format (csv, parquet, feather)",
+        default="csv",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-dt",
+        "--datatype",
+        type=str,
+        choices=list(DATATYPE_SLOTS),
+        help="""Time step of the data (base, hour, day), only
+        tauxfo, dispo and monthly max from hour or day data""",
+        default="base",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of processes computing sites in parallel",
+        default=1,
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-cs",
+        "--chunksize",
+        type=int,
+        help="Read CSV data by chunks of this number of rows",
+        default=None,
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-full",
+        action="store_true",
+        help="Recount every month, ignoring the checkpoints",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        help="Write a json run report of stage timings",
+        default="",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "--metrics_prom",
+        type=str,
+        help="Also write the run report as a Prometheus textfile",
+        default="",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-q",
+        "--queue",
+        type=str,
+        help="""Work queue folder shared by the workers of a run
+        (one folder by run), see default_use_instructions""",
+        default="",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "--lease_ttl",
+        type=float,
+        help="Seconds after which the site of a dead worker is retried",
+        default=LEASE_TTL,
+        metavar="\b"
+    )
     parser.add_argument("-clean",
                         type=str,
                         help="clean retrived data by year from Xair rest api",
                         metavar="\b")
 
     args = parser.parse_args()
+    if args.metrics:
+        enable_metrics()
+    if args.jobs > 1 and not args.queue:
+        pool = ProcessPoolExecutor(max_workers=args.jobs)
+        site_map = pool.map
+    else:
+        pool = None
+        site_map = map
 
     if args.clean:
         if args.year:
@@ -98,145 +447,98 @@ This, for a group of measuring stations.
         else:
             sys.exit("Provide year to clean by setting [-y] option ")
 
-    for group in args.group:
-        print(f"Processing sites of {group} ...")
-        name_list = f"{args.station_list_path}/stations_{group}.csv"
-        site_list = pd.read_csv(name_list, usecols=["id"])["id"].tolist()
+    metadata = load_metadata(args.station_list_path, args.group)
+    phy_names = {
+        id: measure["phy_name"]
+        for id, measure in metadata["measures"].items()
+    }
 
-        poll_index = pd.read_csv(
-            f"{args.station_list_path}/measures_{group}.csv",
-            usecols=['id', 'phy_name']
-            )
+    if args.year != YEAR_NOW:
+        year = args.year
+        month = 12
+    else:
+        year = YEAR_NOW
+        month = dt.datetime.now().month
 
-        if args.year != YEAR_NOW:
-            year = args.year
-            month = 12
+    if args.queue:
+        # -j starts as many workers of the queue
+        if args.jobs > 1:
+            with ProcessPoolExecutor(max_workers=args.jobs) as workers:
+                futures = [
+                    workers.submit(queue_rates, args, metadata, phy_names,
+                                   year, month)
+                    for _ in range(args.jobs)
+                ]
+                results = [future.result() for future in futures]
         else:
-            year = YEAR_NOW
-            month = dt.datetime.now().month
+            results = [queue_rates(args, metadata, phy_names, year, month)]
+        failed = sorted({id for worker_failed, _ in results
+                         for id in worker_failed})
+        for _, records in results:
+            add_records(records)
+        if args.metrics:
+            write_run_report(args.metrics, "compute_rates",
+                             args.metrics_prom)
+        if len(failed) > 0:
+            sys.exit(f"Failed sites : {', '.join(failed)}")
+        print("DONE")
+        sys.exit()
 
-        out_dir = f"{args.outdir}/rates/{year}/{group}"
+    for group in args.group:
+        print(f"Processing sites of {group} ...")
+        site_list = metadata["sites"][group]
 
-        if os.path.exists(out_dir):
-            for file in os.listdir(out_dir):
-                os.remove(os.path.join(out_dir, file))
-        else:
-            os.makedirs(out_dir)
+        folder = group_folder(group, args.datatype)
+        data_path = f"{args.indir}/data/{year}/{folder}"
+        out_dir = f"{args.outdir}/rates/{year}/{folder}"
 
-        for site in tqdm(site_list,
-                         leave=False):
+        site_paths = []
+        for site in site_list:
 
-            csv_file = f"{args.indir}/data/{year}/{group}/{site}.csv"
+            site_path = site_data_path(data_path, site, args.format)
 
-            if os.path.exists(csv_file) is False:
+            if os.path.exists(site_path) is False:
                 csv_file_exit_text = (
-                    f"CSV file for {site} not found.",
-                    f" Run : python -m get_data -y {year} -g {group}"
+                    f"{args.format} data for {site} not found.",
+                    f" Run : python -m get_data -y {year} -g {group}",
+                    f" -f {args.format} -dt {args.datatype}"
                     )
                 sys.exit("".join(csv_file_exit_text))
+            site_paths.append(site_path)
 
-            data = pd.read_csv(
-                csv_file,
-                low_memory=False,
-                parse_dates=["date"]
-                )
-            ids = data["id"].unique()
-            for id in tqdm(ids,
-                           desc=site,
-                           leave=False):
-                model_df = pd.DataFrame(
-                        [
-                            {
-                                "id": id,
-                                "site": site,
-                                "polluant": (
-                                    poll_index[poll_index['id'] == id]
-                                    ['phy_name']
-                                    .values[0]
-                                )
-                            }
-                        ]
-                    )
-                rate_dfs = [
-                    model_df.copy(deep=True),
-                    model_df.copy(deep=True),
-                    model_df.copy(deep=True),
-                    model_df.copy(deep=True),
-                    model_df.copy(deep=True),
-                ]
-                acc_count = 2
-                acc_lost = 0
-                acc_indisponibility_lost = 0
-                all_valid_count = 0
-                all_disp_count = 0
-                id_data = data[data["id"] == id]
-
-                for m in range(1, month + 1):
-                    month_name = calendar.month_name[m]
-                    month_data = id_data[id_data["date"].dt.month == m]
-
-                    (month_rates,
-                     total_count,
-                     total_count_lost,
-                     total_indisponibility_lost,
-                     disponibility_count,
-                     valid_count
-                     ) = compute_rates(
-                            site,
-                            month_data,
-                            acc_count,
-                            acc_lost,
-                            acc_indisponibility_lost
-                        )
-                    acc_count = total_count
-                    acc_lost = total_count_lost
-                    acc_indisponibility_lost = total_indisponibility_lost
-                    all_valid_count = all_valid_count + valid_count
-                    all_disp_count = all_disp_count + disponibility_count
-
-                    for n in range(5):
-
-                        rate_dfs[n] = pd.concat(
-                            [
-                                rate_dfs[n],
-                                pd.DataFrame(
-                                    {
-                                        month_name: month_rates[
-                                            RATE_VAR_DIC[RATE_VARS[n]]
-                                        ]
-                                    }
-                                ),
-                            ],
-                            axis=1,
-                        )
-                for n in range(5):
-                    if RATE_VARS[n] == "dispo":
-                        rate_dfs[n][year] = (
-                            (
-                                all_disp_count/(current_days(year, month)*96)
-                             )
-                        )
-                    if RATE_VARS[n] == "tauxfo":
-                        rate_dfs[n][year] = (
-                            (
-                                all_valid_count/(current_days(year, month)*96)
-                             )
-                        )
-                    if RATE_VARS[n] == "pert":
-                        if rate_dfs[n][calendar.month_name[month]].values > 1:
-                            rate_dfs[n].to_csv(
-                                f"{out_dir}/pert_repport.csv",
-                                mode="a",
-                                header=(not os.path.exists(
-                                    f"{out_dir}/pert_repport.csv"
-                                        )
-                                    ),
-                            )
-                    file_name = RATE_FILE_NAMES_DIC[RATE_VARS[n]]
-                    out_file_to_append = f"{out_dir}/{file_name}"
-                    rate_dfs[n].to_csv(
-                        out_file_to_append,
-                        mode="a",
-                        header=(not os.path.exists(out_file_to_append))
-                    )
+        manifest = read_manifest(data_path)
+        site_results = site_map(
+            compute_site,
+            site_list,
+            site_paths,
+            [args.format] * len(site_list),
+            [phy_names] * len(site_list),
+            [year] * len(site_list),
+            [month] * len(site_list),
+            [manifest.get(site) for site in site_list],
+            [checkpoint_path(args.outdir, year, folder, site)
+             for site in site_list],
+            [args.full] * len(site_list),
+            [bool(args.metrics)] * len(site_list),
+            [args.chunksize] * len(site_list),
+            [args.datatype] * len(site_list),
+        )
+        site_tables = []
+        for rate_tables, pert_repport, records in tqdm(site_results,
+                                                       total=len(site_list),
+                                                       leave=False):
+            for record in records:
+                record["group"] = group
+            add_records(records)
+            site_tables.append((rate_tables, pert_repport))
+        rate_buffers = group_rate_buffers(site_tables)
+        with timed("write_rate_files", group=group) as record:
+            write_rate_files(rate_buffers, out_dir)
+            record["bytes"] = sum(
+                len(buffer.getvalue()) for buffer in rate_buffers.values()
+            )
+    if pool is not None:
+        pool.shutdown()
+    if args.metrics:
+        write_run_report(args.metrics, "compute_rates", args.metrics_prom)
     print("DONE")
@@ -0,0 +1,166 @@
+import sys
+import os
+import io
+sys.path.insert(0, "./src")
+
+import datetime as dt
+import argparse
+import pandas as pd
+
+from src.dictionaries import (
+    COMPLETENESS_FILE_NAME,
+    DATA_FORMATS,
+    DATATYPE_SLOTS,
+    GROUP_LIST,
+    YEAR_NOW,
+    )
+
+from src.storage import group_folder, site_data_path
+
+from src.metadata import load_metadata
+
+from src.gaps import completeness, site_gaps, write_gaps
+
+from src.fonctions import list_of_strings, write_rate_files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""
+This script align every measure of a
+group of measuring stations on its
+expected time steps, write the missing
+ranges to data/{year}/{group}/gaps.csv
+and the completeness of each measure to
+rates/{year}/{group}/completeness.csv.
+Missing ranges are refetched with :
+python -m get_data --fill-gaps
+            """,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "-i",
+        "--indir",
+        type=str,
+        default=".",
+        help="input data path directory",
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-o",
+        "--outdir",
+        type=str,
+        default=".",
+        help="Output path directory",
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-y",
+        "--year",
+        type=int,
+        help="Year to check",
+        default=YEAR_NOW,
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-g", "--group",
+        help="Station group to process",
+        type=list_of_strings,
+        default=GROUP_LIST,
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-sl",
+        "--station_list_path",
+        type=str,
+        help="""path/to/folder/stations_group.csv
+        from get_physicals_and_site_info.py""",
+        default="./data",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        choices=DATA_FORMATS,
+        help="Data storage format (csv, parquet, feather)",
+        default="csv",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-dt",
+        "--datatype",
+        type=str,
+        choices=list(DATATYPE_SLOTS),
+        help="Time step of the data (base, hour, day)",
+        default="base",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-cs",
+        "--chunksize",
+        type=int,
+        help="Read site CSV files by chunks of this number of rows",
+        default=None,
+        metavar="\b"
+    )
+
+    args = parser.parse_args()
+
+    if args.year != YEAR_NOW:
+        month = 12
+    else:
+        month = dt.datetime.now().month
+
+    metadata = load_metadata(args.station_list_path, args.group)
+
+    for group in args.group:
+        print(f"Checking sites of {group} ...")
+        in_path = (f"{args.indir}/data/{args.year}/"
+                   f"{group_folder(group, args.datatype)}")
+        if os.path.isdir(in_path) is False:
+            print(f"No data for {group} in {in_path}, skipped")
+            continue
+
+        gaps_list = []
+        reports = []
+        for site in metadata["sites"][group]:
+            measures_id = metadata["site_measures"][group].get(site, [])
+            gaps, n_slots = site_gaps(
+                site_data_path(in_path, site, args.format),
+                args.format,
+                measures_id,
+                args.year,
+                month,
+                args.datatype,
+                args.chunksize,
+            )
+            gaps_list.append(gaps.assign(site=site))
+            reports.append(
+                completeness(gaps, measures_id, n_slots)
+                .reset_index()
+                .assign(site=site)
+            )
+        gaps = pd.concat(gaps_list, ignore_index=True)
+        write_gaps(gaps, in_path)
+
+        report = pd.concat(reports, ignore_index=True)
+        report["phy_name"] = [
+            metadata["measures"].get(id, {}).get("phy_name")
+            for id in report["id"]
+        ]
+        report = report[
+            ["site", "id", "phy_name", "expected", "missing", "gaps",
+             "completeness"]
+        ]
+        print(f"{report['missing'].sum()} missing time steps in "
+              f"{len(gaps)} gaps of {len(report)} measures")
+
+        buffer = io.StringIO()
+        report.to_csv(buffer, index=False)
+        write_rate_files(
+            {COMPLETENESS_FILE_NAME: buffer},
+            f"{args.outdir}/rates/{args.year}/"
+            f"{group_folder(group, args.datatype)}"
+        )
+    print("DONE")
@@ -2,24 +2,388 @@ import sys
 import os
 sys.path.insert(0, "./src")
 
-import pandas as pd
 import datetime as dt
 import argparse
+import pandas as pd
 from tqdm import tqdm
-import sys
 
-from src.dictionaries import GROUP_LIST, YEAR_NOW
+from src.dictionaries import (
+    CACHE_MAX_BYTES,
+    DATA_FORMATS,
+    DATATYPE_FREQ,
+    DATATYPE_SLOTS,
+    GAP_MERGE_SLOTS,
+    GROUP_LIST,
+    LEASE_TTL,
+    MAX_POINTS,
+    MAX_URL_LENGTH,
+    YEAR_NOW,
+)
+
+from src.storage import (
+    group_folder,
+    month_file_path,
+    site_data_files,
+    site_data_path,
+    write_month_data,
+)
+
+from src.metadata import load_metadata
+
+from src.cache import open_cache, parse_ttl
+
+from src.metrics import (
+    enable_metrics,
+    label_http_calls,
+    timed,
+    write_run_report,
+)
+
+from src.manifest import (
+    entry_matches,
+    fetch_status,
+    read_manifest,
+    record_month,
+    resume_month,
+    stamp_entry,
+    truncate_site_file,
+    write_manifest,
+)
+
+from src.planner import fetch_units, plan_requests, plan_stats
+
+from src.workqueue import init_queue, run_queue, task_id, task_result
+
+from src.gaps import (
+    clip_response,
+    fill_site_months,
+    fillable_months,
+    gap_windows,
+    site_gaps,
+    write_gaps,
+)
 
 from src.fonctions import (
     build_csv_data,
     data_time_window,
     get_month_datetimes,
+    get_session,
     list_of_strings,
-    request_xr,
+    newer_rows,
     test_path,
 )
 
 
+def fetch_period(args):
+    """
+    Year folder, start date and last month of the fetched period
+    """
+    if args.year:
+        return str(args.year), f"{args.year}-01-01T00:00:00Z", 12
+    end_dto = dt.datetime.strptime(
+        args.enddate,
+        "%Y-%m-%dT%H:%M:%SZ"
+        )
+    return (args.startdate.split("-", 1)[0],
+            args.startdate,
+            int(end_dto.strftime('%m')))
+
+
+def measure_sites(metadata, groups):
+    """
+    [(group, site)] by measure id of groups, see label_http_calls()
+    """
+    sites = {}
+    for group in groups:
+        for s, measures_id in metadata["site_measures"][group].items():
+            for id in measures_id:
+                sites.setdefault(id, []).append((group, s))
+    return sites
+
+
+def site_units(args, group, s, measures_id, entry, out_path, start_date,
+               end_month):
+    """
+    Site months to fetch for a site, from its first month not completely
+    fetched (see resume_month()), its file being truncated to that month,
+    or after it when only its last time steps are fetched again
+
+    return :
+    --------
+        entry : dict
+            Truncated manifest entry of the site
+        units : list
+            ((group, site, month, since), fromtime, totime, measures_id)
+            planner units, since being the last fetched dates of a partly
+            fetched month (None for a whole month)
+    """
+    output_file_path = site_data_path(out_path, s, args.format)
+    if args.full:
+        start_month, since = 1, None
+    else:
+        start_month, since = resume_month(entry,
+                                          output_file_path,
+                                          measures_id,
+                                          end_month)
+    entry = truncate_site_file(entry,
+                               output_file_path,
+                               start_month + (since is not None))
+    units = []
+    for month in range(start_month, end_month+1):
+        sd, ed = get_month_datetimes(start_date, month)
+        if month == start_month and since is not None:
+            sd = min(since.values()) or sd
+            units.append(((group, s, month, since), sd, ed, measures_id))
+            continue
+        units.append(((group, s, month, None), sd, ed, measures_id))
+    return entry, units
+
+
+def write_unit(args, out_path, unit, request, entry):
+    """
+    Write a fetched site month and record it in the site manifest entry,
+    the new rows of a partly fetched month being added to it
+    """
+    (group, s, month, since), _, ed, measures_id = unit
+    output_file_path = site_data_path(out_path, s, args.format)
+    with timed("build_csv_data", group=group, site=s,
+               month=month) as record:
+        if since is not None:
+            size = sum(os.path.getsize(f) for f in
+                       site_data_files(output_file_path, args.format))
+            entry, record["rows"] = fill_site_months(
+                {month: newer_rows(request, since, args.datatype)},
+                output_file_path,
+                args.format,
+                entry,
+                args.datatype,
+            )
+            record["bytes"] = sum(
+                os.path.getsize(f) for f in
+                site_data_files(output_file_path, args.format)
+            ) - size
+            entry["months"][str(month)].update(fetch_status(ed))
+            return entry
+        if args.format == "csv":
+            offset = (os.path.getsize(output_file_path)
+                      if os.path.exists(output_file_path) else 0)
+            rows, last_date = build_csv_data(request,
+                                             output_file_path,
+                                             args.datatype)
+            written = os.path.getsize(output_file_path) - offset
+        else:
+            offset = 0
+            rows, last_date = write_month_data(request,
+                                               output_file_path,
+                                               month,
+                                               args.format,
+                                               args.datatype)
+            written = os.path.getsize(
+                month_file_path(output_file_path,
+                                month,
+                                args.format)
+            )
+        record["rows"] = sum(rows.values())
+        record["bytes"] = written
+    return record_month(entry,
+                        output_file_path,
+                        month,
+                        offset,
+                        rows,
+                        last_date,
+                        ed,
+                        measures_id)
+
+
+def queue_fetch(args, metadata, session):
+    """
+    Fetch the sites of groups as one worker of the queue in args.queue
+
+    Sites are leased one at a time to the workers sharing the queue folder
+    (processes or machines, see run_queue()), each writing the site files
+    and keeping the site manifest entry as task result. Once every site is
+    done, a single worker merges the entries into the group manifests.
+
+    return :
+    --------
+        failed : list
+            Failed task ids
+    """
+    year_folder, start_date, end_month = fetch_period(args)
+    out_paths = {
+        group: (f"{args.outdir}/data/{year_folder}/"
+                f"{group_folder(group, args.datatype)}")
+        for group in args.group
+    }
+    group_tasks = {
+        group: [task_id("data", year_folder,
+                        group_folder(group, args.datatype), s)
+                for s in metadata["sites"][group]]
+        for group in args.group
+    }
+    init_queue(
+        args.queue,
+        {
+            id: {"group": group, "site": s}
+            for group in args.group
+            for id, s in zip(group_tasks[group], metadata["sites"][group])
+        }
+    )
+
+    def fetch_task(id, spec):
+        group, s = spec["group"], spec["site"]
+        out_path = out_paths[group]
+        test_path(out_path, "makedirs")
+        entry, units = site_units(
+            args,
+            group,
+            s,
+            metadata["site_measures"][group].get(s, []),
+            read_manifest(out_path).get(s),
+            out_path,
+            start_date,
+            end_month,
+        )
+        plan = plan_requests(units,
+                             datatypes=args.datatype,
+                             base_url=args.api_url,
+                             max_url_length=args.max_url_length,
+                             max_points=args.max_points,
+                             stream=(args.workers <= 1
+                                     and args.format == "csv"))
+        for unit, request in fetch_units(plan,
+                                         session,
+                                         args.workers,
+                                         args.datatype):
+            entry = write_unit(args, out_path, unit, request, entry)
+        if len(units) > 0:
+            entry = stamp_entry(entry,
+                                site_data_path(out_path, s, args.format))
+        print(f"{group} {s} : {len(units)} months fetched")
+        return entry
+
+    states = run_queue(
+        args.queue,
+        fetch_task,
+        [id for ids in group_tasks.values() for id in ids],
+        ttl=args.lease_ttl,
+    )
+
+    def merge_task(id, spec):
+        for group in args.group:
+            if os.path.isdir(out_paths[group]) is False:
+                continue
+            manifest = read_manifest(out_paths[group])
+            for id, s in zip(group_tasks[group], metadata["sites"][group]):
+                if states[id] == "done":
+                    manifest[s] = task_result(args.queue, id)
+            write_manifest(manifest, out_paths[group])
+
+    merge_id = task_id("data", year_folder, "merge")
+    init_queue(args.queue, {merge_id: {"groups": args.group}})
+    run_queue(args.queue, merge_task, [merge_id], ttl=args.lease_ttl)
+    return [id for id, state in states.items() if state == "failed"]
+
+
+def fill_gaps(args, metadata, session, year, end_month):
+    """
+    Refetch only the missing time steps of the fetched months of each site
+
+    The gap index of every group folder is rebuilt from its site data (see
+    site_gaps()), the missing ranges are requested through the planner and
+    their rows added to the site data and its manifest. Ranges the api
+    still has no data for stay in the rewritten index.
+    """
+    step = pd.Timedelta(DATATYPE_FREQ[args.datatype])
+    manifests = {}
+    out_paths = {}
+    group_gaps = {}
+    units = []
+    missing = 0
+    for group in args.group:
+        out_path = (f"{args.outdir}/data/{year}/"
+                    f"{group_folder(group, args.datatype)}")
+        if os.path.isdir(out_path) is False:
+            print(f"No data for {group} in {out_path}, skipped")
+            continue
+        manifest = read_manifest(out_path)
+        gaps_list = []
+        for s in metadata["sites"][group]:
+            measures_id = metadata["site_measures"][group].get(s, [])
+            site_path = site_data_path(out_path, s, args.format)
+            gaps, _ = site_gaps(site_path,
+                                args.format,
+                                measures_id,
+                                year,
+                                end_month,
+                                args.datatype)
+            gaps_list.append(gaps.assign(site=s))
+            months = fillable_months(manifest.get(s),
+                                     site_path,
+                                     args.format,
+                                     end_month)
+            windows = gap_windows(gaps, step, args.gap_merge)
+            for (month, sd, ed), ranges in windows.items():
+                if month in months:
+                    units.append(
+                        ((group, s, month, ranges), sd, ed, list(ranges))
+                    )
+                    missing += sum(len(r) for r in ranges.values())
+        group_gaps[group] = pd.concat(gaps_list, ignore_index=True)
+        write_gaps(group_gaps[group], out_path)
+        manifests[group] = manifest
+        out_paths[group] = out_path
+
+    plan = plan_requests(units,
+                         datatypes=args.datatype,
+                         base_url=args.api_url,
+                         max_url_length=args.max_url_length,
+                         max_points=args.max_points)
+    stats = plan_stats(plan)
+    print(f"Retreving {missing} missing ranges of {len(units)} site months "
+          f"in {stats['requests']} requests ...")
+
+    fills = {}
+    for ((group, s, month, ranges), _, _, _), request in tqdm(
+            fetch_units(plan, session, args.workers, args.datatype),
+            total=len(units),
+            desc="GAPS"):
+        fills.setdefault((group, s), {}).setdefault(month, []).extend(
+            clip_response(request, ranges, args.datatype)
+        )
+
+    filled = 0
+    for (group, s), site_fills in fills.items():
+        out_path = out_paths[group]
+        manifest = manifests[group]
+        site_path = site_data_path(out_path, s, args.format)
+        matches = entry_matches(manifest.get(s), site_path)
+        entry, rows = fill_site_months(site_fills,
+                                       site_path,
+                                       args.format,
+                                       manifest.get(s),
+                                       args.datatype)
+        if matches:
+            manifest[s] = stamp_entry(entry, site_path)
+            write_manifest(manifest, out_path)
+        filled += rows
+        if rows == 0:
+            continue
+        gaps, _ = site_gaps(site_path,
+                            args.format,
+                            metadata["site_measures"][group].get(s, []),
+                            year,
+                            end_month,
+                            args.datatype)
+        index = group_gaps[group]
+        group_gaps[group] = pd.concat(
+            [index[index["site"] != s], gaps.assign(site=s)],
+            ignore_index=True
+        )
+        write_gaps(group_gaps[group], out_path)
+    print(f"{filled} rows filled")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="""
@@ -70,60 +434,220 @@ from Xair rest api
                         help="stations_GROUP.csv path",
                         default="./data",
                         metavar="\b")
+    parser.add_argument("-w",
+                        "--workers",
+                        type=int,
+                        help="Number of parallel requests",
+                        default=1,
+                        metavar="\b")
+    parser.add_argument("-mh",
+                        "--max_per_host",
+                        type=int,
+                        help="Max simultaneous connections to the api",
+                        default=4,
+                        metavar="\b")
+    parser.add_argument("-mu",
+                        "--max_url_length",
+                        type=int,
+                        help="Split requests with longer urls (0 no limit)",
+                        default=MAX_URL_LENGTH,
+                        metavar="\b")
+    parser.add_argument("-mp",
+                        "--max_points",
+                        type=int,
+                        help="""
+                        Split requests of more time steps (0 no limit)
+                        """,
+                        default=MAX_POINTS,
+                        metavar="\b")
+    parser.add_argument("-api",
+                        "--api_url",
+                        type=str,
+                        help="XR rest api root (default XR_API_URL)",
+                        default="",
+                        metavar="\b")
+    parser.add_argument("-f",
+                        "--format",
+                        type=str,
+                        choices=DATA_FORMATS,
+                        help="Data storage format (csv, parquet, feather)",
+                        default="csv",
+                        metavar="\b")
+    parser.add_argument("-dt",
+                        "--datatype",
+                        type=str,
+                        choices=list(DATATYPE_SLOTS),
+                        help="""
+                        Time step to fetch : base (15 min), hour or day
+                        aggregates, stored in data/{year}/{group}/{datatype}
+                        """,
+                        default="base",
+                        metavar="\b")
+    parser.add_argument("-full",
+                        action="store_true",
+                        help="Refetch every month, ignoring the manifest")
+    parser.add_argument("--fill_gaps", "--fill-gaps",
+                        action="store_true",
+                        help="""
+                        Only refetch the missing time steps of the
+                        fetched months (see data/{year}/{group}/gaps.csv)
+                        """)
+    parser.add_argument("-gm",
+                        "--gap_merge",
+                        type=int,
+                        help="""
+                        With --fill_gaps, gaps closer than this number of
+                        time steps are requested together
+                        """,
+                        default=GAP_MERGE_SLOTS,
+                        metavar="\b")
+    parser.add_argument("-q",
+                        "--queue",
+                        type=str,
+                        help="""
+                        Work queue folder shared by the workers of a run
+                        (one folder by run), see default_use_instructions
+                        """,
+                        default="",
+                        metavar="\b")
+    parser.add_argument("--lease_ttl",
+                        type=float,
+                        help="""
+                        Seconds after which the site of a dead worker is
+                        fetched again
+                        """,
+                        default=LEASE_TTL,
+                        metavar="\b")
+    parser.add_argument("--cache",
+                        type=str,
+                        help="""
+                        Folder of an api response cache, reruns only
+                        request what is not in it (default no cache)
+                        """,
+                        default="",
+                        metavar="\b")
+    parser.add_argument("--cache_size",
+                        type=int,
+                        help="Max size of the cache in MB",
+                        default=CACHE_MAX_BYTES // 1024 ** 2,
+                        metavar="\b")
+    parser.add_argument("--cache_ttl",
+                        type=parse_ttl,
+                        help="""
+                        Time to live in seconds by endpoint, like
+                        data=2592000,current=900 (see CACHE_TTL)
+                        """,
+                        default={},
+                        metavar="\b")
+    parser.add_argument("--metrics",
+                        type=str,
+                        help="Write a json run report of stage timings",
+                        default="",
+                        metavar="\b")
+    parser.add_argument("--metrics_prom",
+                        type=str,
+                        help="Also write the run report as a Prometheus "
+                        "textfile",
+                        default="",
+                        metavar="\b")
 
     args = parser.parse_args()
+    cache = None
+    if args.cache:
+        cache = open_cache(args.cache,
+                           args.cache_size * 1024 ** 2,
+                           args.cache_ttl)
+    session = get_session(max_per_host=args.max_per_host, cache=cache)
+    if args.metrics:
+        enable_metrics(session=session)
 
-    for group in args.group:
-        print(f"Retreving {group} group ...")
-        if args.year:
-            year_folder = str(args.year)
+    metadata = load_metadata(args.station_list_path, args.group)
+
+    if args.fill_gaps or args.queue:
+        if args.fill_gaps:
+            year_folder, _, end_month = fetch_period(args)
+            fill_gaps(args, metadata, session, int(year_folder), end_month)
+            failed = []
         else:
-            year_folder = args.startdate.split("-", 1)[0]
+            failed = queue_fetch(args, metadata, session)
+        if cache is not None:
+            print(f"Cache : {cache['hits']} hits, {cache['misses']} misses")
+        if args.metrics:
+            label_http_calls(measure_sites(metadata, args.group))
+            write_run_report(args.metrics, "get_data", args.metrics_prom)
+        if len(failed) > 0:
+            sys.exit(f"Failed sites : {', '.join(failed)}")
+        print("Done.")
+        sys.exit()
 
-        out_path = f"{args.outdir}/data/{year_folder}/{group}"
+    # Site months to fetch of every group, packed into shared requests
+    year_folder, start_date, end_month = fetch_period(args)
+    manifests = {}
+    out_paths = {}
+    units = []
+    for group in args.group:
+        out_path = (f"{args.outdir}/data/{year_folder}/"
+                    f"{group_folder(group, args.datatype)}")
         test_path(out_path, "makedirs")
+        out_paths[group] = out_path
 
-        sites_file_path = os.path.join(
-            args.station_list_path,
-            f"stations_{group}.csv"
-            )
+        sites = metadata["sites"][group]
 
-        sites = pd.read_csv(
-            sites_file_path,
-            usecols=["id"]
-            )["id"].tolist()
+        manifest = read_manifest(out_path)
+        for s in sites:
+            manifest[s], site_months = site_units(
+                args,
+                group,
+                s,
+                metadata["site_measures"][group].get(s, []),
+                manifest.get(s),
+                out_path,
+                start_date,
+                end_month,
+            )
+            units.extend(site_months)
+        write_manifest(manifest, out_path)
+        manifests[group] = manifest
 
-        for s in tqdm(sites, desc="SITES"):
+    # Sequential CSV fetches parse responses incrementally, see request_xr()
+    plan = plan_requests(units,
+                         datatypes=args.datatype,
+                         base_url=args.api_url,
+                         max_url_length=args.max_url_length,
+                         max_points=args.max_points,
+                         stream=args.workers <= 1 and args.format == "csv")
+    stats = plan_stats(plan)
+    print(f"Retreving {stats['site_months']} site months of "
+          f"{', '.join(args.group)} : {stats['unique_measures']} unique of "
+          f"{stats['measures']} measure months in {stats['requests']} "
+          "requests ...")
 
-            df = pd.read_csv(
-                os.path.join(
-                    args.station_list_path, f"measures_{group}.csv"
-                    )
-                )
-            measures_id = df[df['id_site'] == s]['id'].to_list()
-
-            output_file_path = f"{out_path}/{s}.csv"
-            test_path(output_file_path, "remove_file")
-
-            if args.year:
-                end_month = 12
-                start_date = f"{args.year}-01-01T00:00:00Z"
-            else:
-                start_date = args.startdate
-                end_dto = dt.datetime.strptime(
-                    args.enddate,
-                    "%Y-%m-%dT%H:%M:%SZ"
-                    )
-                end_month = int(end_dto.strftime('%m'))
-
-            for month in tqdm(range(1, end_month+1),
-                              desc=f"Retreving Data for {s}",
-                              leave=False):
-                sd, ed = get_month_datetimes(start_date, month)
-                request = request_xr(folder="data",
-                                     fromtime=sd,
-                                     totime=ed,
-                                     measures=",".join(measures_id),
-                                     )
-                build_csv_data(request, output_file_path)
+    # A site is hashed and its group manifest written once its last month
+    # is written
+    remaining = {}
+    for (group, s, _, _), _, _, _ in units:
+        remaining[group, s] = remaining.get((group, s), 0) + 1
+    for unit, request in tqdm(
+            fetch_units(plan, session, args.workers, args.datatype),
+            total=len(units),
+            desc="SITES x MONTHS"):
+        (group, s, _, _), _, _, _ = unit
+        manifests[group][s] = write_unit(args,
+                                         out_paths[group],
+                                         unit,
+                                         request,
+                                         manifests[group][s])
+        remaining[group, s] -= 1
+        if remaining[group, s] > 0:
+            continue
+        manifests[group][s] = stamp_entry(
+            manifests[group][s],
+            site_data_path(out_paths[group], s, args.format)
+        )
+        write_manifest(manifests[group], out_paths[group])
+    if cache is not None:
+        print(f"Cache : {cache['hits']} hits, {cache['misses']} misses")
+    if args.metrics:
+        label_http_calls(measure_sites(metadata, args.group))
+        write_run_report(args.metrics, "get_data", args.metrics_prom)
     print("Done.")
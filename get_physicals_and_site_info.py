@@ -1,9 +1,9 @@
 import sys
-import os
 sys.path.insert(0, "./src")
-from src.fonctions import request_xr, list_of_strings
+from src.fonctions import get_session, list_of_strings
+from src.metadata import fetch_metadata
+from src.cache import open_cache
 from src.dictionaries import GROUP_LIST
-import pandas as pd
 import argparse
 
 if __name__ == "__main__":
@@ -26,22 +26,24 @@ and a list of sites by GROUPS
         help="Stations group",
         default=GROUP_LIST,
         metavar="\b")
+    parser.add_argument(
+        "-api",
+        "--api_url",
+        type=str,
+        help="XR rest api root (default XR_API_URL)",
+        default="",
+        metavar="\b")
 
-    args = parser.parse_args()
-
-    out_dir_data = f"{args.outdir}/data"
-    if os.path.exists(out_dir_data) is False:
-        os.makedirs(f"{out_dir_data}")
-
-    for group in args.group:
-        sites_json = request_xr(folder="sites",
-                                groups=group
-                                )
-        pd.DataFrame(sites_json).to_csv(f"{out_dir_data}/stations_{group}.csv")
+    parser.add_argument(
+        "--cache",
+        type=str,
+        help="Folder of an api response cache (default no cache)",
+        default="",
+        metavar="\b")
 
-        measures_json = request_xr(folder="measures",
-                                   groups=group,)
-        pd.DataFrame(measures_json).to_csv(f"{out_dir_data}/measures_{group}.csv")
+    args = parser.parse_args()
 
-    physicals_json = request_xr(folder="physicals")
-    pd.DataFrame(physicals_json).to_csv(f"{out_dir_data}/physicals.csv")
+    session = None
+    if args.cache:
+        session = get_session(cache=open_cache(args.cache))
+    fetch_metadata(f"{args.outdir}/data", args.group, args.api_url, session)
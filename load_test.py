@@ -0,0 +1,202 @@
+import sys
+sys.path.insert(0, "./src")
+
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from src.dictionaries import YEAR_NOW
+
+from src.fonctions import (
+    get_month_datetimes,
+    get_session,
+    request_xr,
+)
+
+from src.mock_api import start_mock_server
+
+
+def timed_request(session, kwargs):
+    """
+    request_xr() latency in seconds, returned rows and error if any
+    """
+    start = time.perf_counter()
+    try:
+        data = request_xr(session=session, **kwargs)
+        rows = sum(len(measure["base"]) for measure in data)
+        error = None
+    except Exception as e:
+        rows = 0
+        error = type(e).__name__
+    return time.perf_counter() - start, rows, error
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""
+This script measure request_xr() fetch throughput
+and tail latency of get_data.py (site x month) requests,
+against an api or an embedded mock api.
+        """,
+        formatter_class=argparse.RawTextHelpFormatter,)
+    parser.add_argument("-api",
+                        "--api_url",
+                        type=str,
+                        help="XR rest api root (default : embedded mock)",
+                        default="",
+                        metavar="\b")
+    parser.add_argument("-g",
+                        "--group",
+                        type=str,
+                        help="Station group",
+                        default="MOCK",
+                        metavar="\b")
+    parser.add_argument("-y",
+                        "--year",
+                        type=int,
+                        help="Year to fetch",
+                        default=YEAR_NOW - 1,
+                        metavar="\b")
+    parser.add_argument("-mo",
+                        "--months",
+                        type=int,
+                        help="Months to fetch by site",
+                        default=12,
+                        metavar="\b")
+    parser.add_argument("-w",
+                        "--workers",
+                        type=int,
+                        help="Number of parallel requests",
+                        default=4,
+                        metavar="\b")
+    parser.add_argument("-mh",
+                        "--max_per_host",
+                        type=int,
+                        help="Max simultaneous connections to the api",
+                        default=4,
+                        metavar="\b")
+    parser.add_argument("-n",
+                        "--sites",
+                        type=int,
+                        help="Mock sites",
+                        default=3,
+                        metavar="\b")
+    parser.add_argument("-m",
+                        "--measures",
+                        type=int,
+                        help="Mock measures by site",
+                        default=4,
+                        metavar="\b")
+    parser.add_argument("-l",
+                        "--latency",
+                        type=float,
+                        help="Mock response delay in seconds",
+                        default=0.05,
+                        metavar="\b")
+    parser.add_argument("-j",
+                        "--jitter",
+                        type=float,
+                        help="Mock random extra delay in seconds",
+                        default=0.05,
+                        metavar="\b")
+    parser.add_argument("-e",
+                        "--error_rate",
+                        type=float,
+                        help="Mock share of 503 responses",
+                        default=0.0,
+                        metavar="\b")
+    parser.add_argument("-c",
+                        "--max_concurrent",
+                        type=int,
+                        help="Mock simultaneous requests before 429",
+                        default=0,
+                        metavar="\b")
+    parser.add_argument("-r",
+                        "--report",
+                        type=str,
+                        help="Write the load test report as json",
+                        default=None,
+                        metavar="\b")
+
+    args = parser.parse_args()
+
+    server = None
+    api_url = args.api_url
+    if not api_url:
+        server = start_mock_server(
+            groups=[args.group],
+            n_sites=args.sites,
+            n_measures=args.measures,
+            latency=args.latency,
+            jitter=args.jitter,
+            error_rate=args.error_rate,
+            max_concurrent=args.max_concurrent,
+        )
+        api_url = server.url
+
+    session = get_session(max_per_host=args.max_per_host)
+    transferred = []
+    session.hooks["response"].append(
+        lambda response, *a, **k: transferred.append(len(response.content))
+    )
+
+    measures = request_xr(folder="measures",
+                          groups=args.group,
+                          session=session,
+                          base_url=api_url)
+    site_measures = {}
+    for measure in measures:
+        site_measures.setdefault(measure["id_site"], []).append(measure["id"])
+
+    requests_kwargs = []
+    for site, measures_id in site_measures.items():
+        for month in range(1, args.months + 1):
+            sd, ed = get_month_datetimes(f"{args.year}-01-01T00:00:00Z",
+                                         month)
+            requests_kwargs.append(
+                dict(folder="data",
+                     fromtime=sd,
+                     totime=ed,
+                     measures=",".join(measures_id),
+                     base_url=api_url)
+            )
+    transferred.clear()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(lambda kwargs: timed_request(session,
+                                                             kwargs),
+                                requests_kwargs))
+    wall = time.perf_counter() - start
+
+    latencies = np.array([r[0] for r in results])
+    rows = sum(r[1] for r in results)
+    errors = [r[2] for r in results if r[2] is not None]
+    report = {
+        "api_url": api_url,
+        "workers": args.workers,
+        "max_per_host": args.max_per_host,
+        "requests": len(results),
+        "errors": len(errors),
+        "http_calls": len(transferred),
+        "seconds": wall,
+        "requests_per_second": len(results) / wall,
+        "rows_per_second": rows / wall,
+        "mb_per_second": sum(transferred) / 2**20 / wall,
+        "latency_p50": float(np.percentile(latencies, 50)),
+        "latency_p90": float(np.percentile(latencies, 90)),
+        "latency_p99": float(np.percentile(latencies, 99)),
+        "latency_max": float(latencies.max()),
+    }
+    if server is not None:
+        report["mock_stats"] = dict(server.stats)
+        server.shutdown()
+
+    for key, value in report.items():
+        print(f"{key:<22}{value}")
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=1)
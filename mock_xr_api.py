@@ -0,0 +1,89 @@
+import sys
+sys.path.insert(0, "./src")
+
+import argparse
+
+from src.fonctions import list_of_strings
+
+from src.mock_api import make_mock_server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""
+This script serve a local mock of the XR rest api
+(/data, /sites, /measures, /physicals) with synthetic data.
+Use the printed url as --api_url or XR_API_URL.
+        """,
+        formatter_class=argparse.RawTextHelpFormatter,)
+    parser.add_argument("-p",
+                        "--port",
+                        type=int,
+                        help="Listening port",
+                        default=8443,
+                        metavar="\b")
+    parser.add_argument("-g", "--group",
+                        type=list_of_strings,
+                        help="Synthetic station groups",
+                        default=["MOCK"],
+                        metavar="\b")
+    parser.add_argument("-n",
+                        "--sites",
+                        type=int,
+                        help="Sites by group",
+                        default=3,
+                        metavar="\b")
+    parser.add_argument("-m",
+                        "--measures",
+                        type=int,
+                        help="Measures by site",
+                        default=4,
+                        metavar="\b")
+    parser.add_argument("-l",
+                        "--latency",
+                        type=float,
+                        help="Response delay in seconds",
+                        default=0.0,
+                        metavar="\b")
+    parser.add_argument("-j",
+                        "--jitter",
+                        type=float,
+                        help="Random extra delay in seconds",
+                        default=0.0,
+                        metavar="\b")
+    parser.add_argument("-e",
+                        "--error_rate",
+                        type=float,
+                        help="Share of requests failing with a 503",
+                        default=0.0,
+                        metavar="\b")
+    parser.add_argument("-c",
+                        "--max_concurrent",
+                        type=int,
+                        help="Simultaneous requests before 429 (0 : none)",
+                        default=0,
+                        metavar="\b")
+    parser.add_argument("-gr",
+                        "--gap_rate",
+                        type=float,
+                        help="Share of missing time steps",
+                        default=0.0,
+                        metavar="\b")
+
+    args = parser.parse_args()
+    server = make_mock_server(
+        host="127.0.0.1",
+        port=args.port,
+        groups=args.group,
+        n_sites=args.sites,
+        n_measures=args.measures,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        max_concurrent=args.max_concurrent,
+        gap_rate=args.gap_rate,
+    )
+    print(f"Mock XR api on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(server.stats)
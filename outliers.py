@@ -0,0 +1,157 @@
+import sys
+import os
+import io
+sys.path.insert(0, "./src")
+
+import argparse
+import pandas as pd
+
+from src.dictionaries import (
+    DATA_FORMATS,
+    GROUP_LIST,
+    OUTLIER_METHODS,
+    OUTLIERS_FILE_NAME,
+    YEAR_NOW,
+    )
+
+from src.storage import read_site_data, site_data_path
+
+from src.metadata import load_metadata
+
+from src.fonctions import find_outliers, list_of_strings, write_rate_files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""
+This script screen every measure
+of a group of measuring stations
+for outliers (z-score or median/MAD)
+and write rates/{year}/{group}/outliers.csv
+            """,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "-i",
+        "--indir",
+        type=str,
+        default=".",
+        help="input data path directory",
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-o",
+        "--outdir",
+        type=str,
+        default=".",
+        help="Output path directory",
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-y",
+        "--year",
+        type=int,
+        help="Year to screen",
+        default=YEAR_NOW,
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-g", "--group",
+        help="Station group to process",
+        type=list_of_strings,
+        default=GROUP_LIST,
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-sl",
+        "--station_list_path",
+        type=str,
+        help="""path/to/folder/stations_group.csv
+        from get_physicals_and_site_info.py""",
+        default="./data",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        choices=DATA_FORMATS,
+        help="Data storage format (csv, parquet, feather)",
+        default="csv",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-m",
+        "--method",
+        type=str,
+        choices=OUTLIER_METHODS,
+        help="Score (zscore, mad)",
+        default="zscore",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=float,
+        help="Absolute score above which a value is an outlier",
+        default=1.5,
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-w",
+        "--window",
+        type=int,
+        help="Rolling window in time steps (96 = 1 day of base data)",
+        default=None,
+        metavar="\b"
+    )
+
+    args = parser.parse_args()
+
+    metadata = load_metadata(args.station_list_path, args.group)
+
+    for group in args.group:
+        print(f"Screening sites of {group} ...")
+        in_path = f"{args.indir}/data/{args.year}/{group}"
+
+        frames = []
+        for site in metadata["sites"][group]:
+            site_path = site_data_path(in_path, site, args.format)
+            if os.path.exists(site_path) is False:
+                print(f"{args.format} data for {site} not found, skipped")
+                continue
+            frames.append(
+                read_site_data(
+                    site_path,
+                    args.format,
+                    columns=["date", "id", "value", "state"],
+                )
+            )
+        if len(frames) == 0:
+            continue
+        data = pd.concat(frames, ignore_index=True)
+
+        outliers = find_outliers(
+            data,
+            threshold=args.threshold,
+            method=args.method,
+            window=args.window,
+        )
+        measures = [metadata["measures"].get(id, {}) for id in outliers["id"]]
+        outliers["site"] = [m.get("site") for m in measures]
+        outliers["phy_name"] = [m.get("phy_name") for m in measures]
+        outliers = outliers[
+            ["site", "id", "phy_name", "date", "value", "state", "score"]
+        ]
+        print(f"{len(outliers)} outliers in {data['id'].nunique()} measures")
+
+        buffer = io.StringIO()
+        outliers.sort_values(["site", "id", "date"]).to_csv(
+            buffer,
+            index=False
+        )
+        write_rate_files(
+            {OUTLIERS_FILE_NAME: buffer},
+            f"{args.outdir}/rates/{args.year}/{group}"
+        )
+    print("DONE")
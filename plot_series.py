@@ -0,0 +1,146 @@
+import sys
+import os
+sys.path.insert(0, "./src")
+
+import argparse
+
+from src.dictionaries import (
+    DATA_FORMATS,
+    DATATYPE_SLOTS,
+    DOWNSAMPLE_LEVELS,
+    GROUP_LIST,
+    YEAR_NOW,
+    )
+
+from src.storage import group_folder, site_data_path
+
+from src.metadata import load_metadata
+
+from src.downsample import downsampled_path, series_figure, site_series
+
+from src.fonctions import list_of_strings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""
+This script build the downsampled
+plotting series of every measure of
+a group of measuring stations (LTTB
+points colored by state and min/max
+envelope, at several zoom levels),
+cached in downsampled/{year}/{group}
+and rebuilt when the site data changed.
+            """,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "-i",
+        "--indir",
+        type=str,
+        default=".",
+        help="input data path directory",
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-o",
+        "--outdir",
+        type=str,
+        default=".",
+        help="Output path directory",
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-y",
+        "--year",
+        type=int,
+        help="Year to plot",
+        default=YEAR_NOW,
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-g", "--group",
+        help="Station group to process",
+        type=list_of_strings,
+        default=GROUP_LIST,
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-sl",
+        "--station_list_path",
+        type=str,
+        help="""path/to/folder/stations_group.csv
+        from get_physicals_and_site_info.py""",
+        default="./data",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        choices=DATA_FORMATS,
+        help="Data storage format (csv, parquet, feather)",
+        default="csv",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-dt",
+        "--datatype",
+        type=str,
+        choices=list(DATATYPE_SLOTS),
+        help="Time step of the data (base, hour, day)",
+        default="base",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-l",
+        "--levels",
+        type=list_of_strings,
+        help="Points by measure of each zoom level, like 500,2000,8000",
+        default=DOWNSAMPLE_LEVELS,
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-html",
+        action="store_true",
+        help="Also write a plotly html page by site (coarsest level)",
+    )
+    parser.add_argument(
+        "-build",
+        action="store_true",
+        help="Rebuild the series even if the data did not change",
+    )
+
+    args = parser.parse_args()
+    levels = sorted(int(level) for level in args.levels)
+
+    metadata = load_metadata(args.station_list_path, args.group)
+
+    for group in args.group:
+        print(f"Downsampling sites of {group} ...")
+        folder = group_folder(group, args.datatype)
+        in_path = f"{args.indir}/data/{args.year}/{folder}"
+
+        for site in metadata["sites"][group]:
+            site_path = site_data_path(in_path, site, args.format)
+            if os.path.exists(site_path) is False:
+                print(f"{args.format} data for {site} not found, skipped")
+                continue
+            cache_file = downsampled_path(args.outdir, args.year, folder,
+                                          site)
+            series = site_series(
+                site_path,
+                args.format,
+                cache_file,
+                levels,
+                rebuild=args.build,
+            )
+            if args.html:
+                figure = series_figure(
+                    series[levels[0]]["points"],
+                    series[levels[0]]["envelope"],
+                    title=f"{group} {site} {args.year}",
+                )
+                figure.write_html(cache_file.replace(".pkl", ".html"))
+            print(f"{group} {site} : {cache_file}")
+    print("DONE")
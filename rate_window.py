@@ -0,0 +1,180 @@
+import sys
+import os
+sys.path.insert(0, "./src")
+
+import argparse
+
+from src.dictionaries import (
+    CUBE_RESOLUTIONS,
+    DATA_FORMATS,
+    GROUP_LIST,
+    )
+
+from src.metadata import load_metadata
+
+from src.cube import (
+    build_cube,
+    cube_sources,
+    open_cube,
+    window_rates,
+)
+
+from src.fonctions import list_of_strings
+
+
+def data_years(indir, group):
+    """
+    Years of data/{year}/{group} folders found in indir
+    """
+    data_dir = f"{indir}/data"
+    if os.path.isdir(data_dir) is False:
+        return []
+    return sorted(
+        year for year in os.listdir(data_dir)
+        if year.isdigit() and os.path.isdir(f"{data_dir}/{year}/{group}")
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""
+This script compute operational,
+disponibility and lost rates of a
+group of measuring stations over
+any [from, to) window, possibly
+spanning several years, from a
+cube of cumulative state counts
+(built at the first run, rebuilt
+when the data changed).
+            """,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "-i",
+        "--indir",
+        type=str,
+        default=".",
+        help="input data path directory",
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-o",
+        "--outdir",
+        type=str,
+        default=".",
+        help="Cube and output path directory",
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-g", "--group",
+        help="Station group to process",
+        type=list_of_strings,
+        default=GROUP_LIST,
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-sl",
+        "--station_list_path",
+        type=str,
+        help="""path/to/folder/stations_group.csv
+        from get_physicals_and_site_info.py""",
+        default="./data",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-y",
+        "--years",
+        type=list_of_strings,
+        help="Years of data in the cube (default all fetched years)",
+        default=None,
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-from",
+        "--fromtime",
+        type=str,
+        help="Window start, like YYYY-MM-DD[Thh:mm:ssZ] (included)",
+        required=True,
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-to",
+        "--totime",
+        type=str,
+        help="Window end, like YYYY-MM-DD[Thh:mm:ssZ] (excluded)",
+        required=True,
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        choices=DATA_FORMATS,
+        help="Data storage format (csv, parquet, feather)",
+        default="csv",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-r",
+        "--resolution",
+        type=str,
+        choices=CUBE_RESOLUTIONS,
+        help="Cube slot length (base, hour, day), windows are floored to it",
+        default="day",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-build",
+        action="store_true",
+        help="Rebuild the cube even if the data did not change",
+    )
+
+    args = parser.parse_args()
+
+    metadata = load_metadata(args.station_list_path, args.group)
+
+    for group in args.group:
+        years = args.years or data_years(args.indir, group)
+        if len(years) == 0:
+            sys.exit(f"No data for {group}. "
+                     f"Run : python -m get_data -g {group}")
+        years = sorted(int(year) for year in years)
+        site_measures = metadata["site_measures"][group]
+
+        cube = open_cube(args.outdir, group)
+        if (
+            args.build
+            or cube is None
+            or cube["years"] != years
+            or cube["resolution"] != args.resolution
+            or cube["data_format"] != args.format
+            or cube["ids"] != [
+                id for measures in site_measures.values() for id in measures
+            ]
+            or cube["sources"] != cube_sources(args.indir, group, years,
+                                               site_measures, args.format)
+        ):
+            print(f"Building {group} cube ...")
+            cube = build_cube(
+                args.indir,
+                args.outdir,
+                group,
+                years,
+                site_measures,
+                args.format,
+                args.resolution,
+            )
+
+        rates = window_rates(cube, args.fromtime, args.totime)
+        measures = [metadata["measures"].get(id, {}) for id in rates.index]
+        rates.insert(0, "site", [m.get("site") for m in measures])
+        rates.insert(1, "polluant", [m.get("phy_name") for m in measures])
+        out_dir = f"{args.outdir}/rates/window/{group}"
+        os.makedirs(out_dir, exist_ok=True)
+        out_file = (
+            f"{out_dir}/{args.fromtime[:10]}_{args.totime[:10]}.csv"
+        )
+        rates.to_csv(out_file)
+        print(f"{group} rates over [{args.fromtime}, {args.totime}) : "
+              f"{out_file}")
+    print("DONE")
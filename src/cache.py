@@ -0,0 +1,169 @@
+import datetime as dt
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from dictionaries import (
+    CACHE_CLOSED_DELAY,
+    CACHE_FILE_NAME,
+    CACHE_MAX_BYTES,
+    CACHE_TTL,
+)
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    expires REAL,
+    used REAL NOT NULL
+)
+"""
+
+
+def open_cache(path, max_bytes=CACHE_MAX_BYTES, ttl=None):
+    """
+    Open (or create) the request_xr() response cache of a folder
+
+    Response bodies are stored zlib compressed in a sqlite file, under the
+    sha256 of their request url, so several processes can share it. The
+    least recently used responses are evicted when the cache outgrows
+    max_bytes.
+
+    input :
+    -------
+        path : str
+            Cache folder
+        max_bytes : int
+            Max size of the stored (compressed) bodies
+        ttl : dict
+            Time to live by endpoint, overriding CACHE_TTL
+    return :
+    --------
+        cache : dict
+            To give to get_session(cache=...), counts its "hits" and
+            "misses"
+    """
+    os.makedirs(path, exist_ok=True)
+    db = sqlite3.connect(os.path.join(path, CACHE_FILE_NAME),
+                         timeout=60,
+                         check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(CACHE_SCHEMA)
+    db.commit()
+    return {
+        "db": db,
+        "lock": threading.Lock(),
+        "max_bytes": max_bytes,
+        "ttl": dict(CACHE_TTL, **(ttl or {})),
+        "hits": 0,
+        "misses": 0,
+    }
+
+
+def parse_ttl(arg):
+    """
+    Time to live by endpoint from a "data=2592000,current=900" argument,
+    "none" for no limit
+    """
+    ttl = {}
+    for item in arg.split(","):
+        if not item:
+            continue
+        endpoint, seconds = item.split("=")
+        ttl[endpoint] = None if seconds.lower() == "none" else float(seconds)
+    return ttl
+
+
+def request_key(url):
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def response_ttl(cache, folder, totime=""):
+    """
+    Time to live of a response : by endpoint, data windows ended more than
+    CACHE_CLOSED_DELAY seconds ago being "data", the others "current"
+    """
+    if folder != "data":
+        return cache["ttl"].get(folder)
+    try:
+        end = dt.datetime.strptime(
+            totime,
+            "%Y-%m-%dT%H:%M:%SZ"
+        ).replace(tzinfo=dt.timezone.utc)
+    except ValueError:
+        return cache["ttl"]["current"]
+    age = dt.datetime.now(dt.timezone.utc) - end
+    if age.total_seconds() > CACHE_CLOSED_DELAY:
+        return cache["ttl"]["data"]
+    return cache["ttl"]["current"]
+
+
+def cache_get(cache, key):
+    """
+    Cached body of a request key, None if missing or expired
+    """
+    now = time.time()
+    with cache["lock"]:
+        db = cache["db"]
+        row = db.execute(
+            "SELECT body, expires FROM responses WHERE key = ?",
+            (key,)
+        ).fetchone()
+        if row is not None and row[1] is not None and row[1] < now:
+            db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            row = None
+        if row is None:
+            cache["misses"] += 1
+        else:
+            cache["hits"] += 1
+            db.execute("UPDATE responses SET used = ? WHERE key = ?",
+                       (now, key))
+        db.commit()
+    if row is None:
+        return None
+    return zlib.decompress(row[0])
+
+
+def cache_put(cache, key, body, ttl=None):
+    """
+    Store a response body for ttl seconds (None for no limit, 0 to skip),
+    then evict the least recently used bodies beyond max_bytes
+    """
+    if ttl == 0:
+        return
+    blob = zlib.compress(body)
+    now = time.time()
+    with cache["lock"]:
+        db = cache["db"]
+        db.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+            (key, blob, len(blob), None if ttl is None else now + ttl, now)
+        )
+        evict_cache(db, cache["max_bytes"], now)
+        db.commit()
+
+
+def evict_cache(db, max_bytes, now):
+    """
+    Drop expired bodies, then the least recently used ones until the
+    cache fits max_bytes
+    """
+    db.execute("DELETE FROM responses WHERE expires < ?", (now,))
+    total = db.execute(
+        "SELECT COALESCE(SUM(size), 0) FROM responses"
+    ).fetchone()[0]
+    if total <= max_bytes:
+        return
+    evicted = []
+    for key, size in db.execute(
+            "SELECT key, size FROM responses ORDER BY used"):
+        if total <= max_bytes:
+            break
+        evicted.append((key,))
+        total -= size
+    db.executemany("DELETE FROM responses WHERE key = ?", evicted)
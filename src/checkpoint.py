@@ -0,0 +1,87 @@
+import json
+import os
+
+import pandas as pd
+
+from manifest import entry_matches, file_checksum
+
+
+def checkpoint_path(outdir, year, group, site):
+    return f"{outdir}/checkpoints/{year}/{group}/{site}.pkl"
+
+
+def read_checkpoint(path):
+    """
+    Read the monthly counts checkpoint of a site
+
+    return :
+    --------
+        checkpoint : dict
+            By part of the site data (fetched month, or "file") :
+            {"fingerprint": str, "counts": dataframe from count_months()}
+            Empty dict when no checkpoint was written yet
+    """
+    if os.path.exists(path) is False:
+        return {}
+    return pd.read_pickle(path)
+
+
+def write_checkpoint(checkpoint, path):
+    """
+    Write the checkpoint of a site, replacing the former one atomically
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_file = f"{path}.tmp"
+    pd.to_pickle(checkpoint, tmp_file)
+    os.replace(tmp_file, path)
+
+
+def site_data_parts(site_path, data_format, entry, month):
+    """
+    Split a site data into the parts that can be counted separately
+
+    When the fetch manifest entry still matches the site data (see
+    entry_matches(), the data is not hashed while its size and mtime are
+    unchanged), each fetched month is a part, fingerprinted by its
+    manifest record, so only refetched months have to be read again.
+    Otherwise the whole site data is one part fingerprinted by its
+    checksum.
+
+    input :
+    -------
+        site_path : str
+            From site_data_path()
+        data_format : str
+            csv, parquet or feather
+        entry : dict
+            Site entry of the fetch manifest (None if missing)
+        month : int
+            Last month to process
+    return :
+    --------
+        parts : list
+            (key, fingerprint, read_site_data() keyword arguments)
+    """
+    if not entry_matches(entry, site_path):
+        read_kwargs = {}
+        if data_format != "csv":
+            read_kwargs["months"] = list(range(1, month + 1))
+        return [("file", file_checksum(site_path), read_kwargs)]
+
+    parts = []
+    for m in range(1, month + 1):
+        month_entry = entry["months"].get(str(m))
+        if month_entry is None:
+            continue
+        if data_format == "csv":
+            next_entry = entry["months"].get(str(m + 1))
+            end = None if next_entry is None else next_entry["offset"]
+            read_kwargs = {"byte_range": (month_entry["offset"], end)}
+        else:
+            read_kwargs = {"months": [m]}
+        fingerprint = json.dumps(
+            [month_entry, read_kwargs],
+            sort_keys=True
+        )
+        parts.append((str(m), fingerprint, read_kwargs))
+    return parts
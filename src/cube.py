@@ -0,0 +1,284 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from dictionaries import (
+    CUBE_COUNTS_FILE_NAME,
+    CUBE_INDEX_FILE_NAME,
+    DATATYPE_FREQ,
+    DISPONIBILITY_STATES,
+    INDISPONIBILITY_LOST_STATES,
+    LOST_STATES,
+    OPERATIONAL_STATES,
+    STATE_CODES,
+)
+from fonctions import encode_states
+from storage import (
+    files_signature,
+    iter_site_data,
+    site_data_files,
+    site_data_path,
+)
+
+N_CODES = len(STATE_CODES) + 1
+
+
+def cube_path(outdir, group):
+    return f"{outdir}/cube/{group}"
+
+
+def cube_sources(indir, group, years, sites, data_format):
+    """
+    Site data files of a group over years, with their (size, mtime)
+    """
+    signature = {}
+    for year in years:
+        for site in sites:
+            site_path = site_data_path(
+                f"{indir}/data/{year}/{group}",
+                site,
+                data_format
+            )
+            signature.update(
+                files_signature(site_data_files(site_path, data_format))
+            )
+    return signature
+
+
+def build_cube(
+    indir: str,
+    outdir: str,
+    group: str,
+    years: list,
+    site_measures: dict,
+    data_format: str = "csv",
+    resolution: str = "day",
+    chunksize: int = None,
+):
+    """
+    Build the cumulative state counts cube of a group
+
+    cube[i, t, c] is the number of rows of measure i with state code c
+    (STATE_CODES order, last code for unknown states) dated before slot t,
+    slot 0 being January 1st of the first year. Counts over [t0, t1) are
+    cube[:, t1] - cube[:, t0] whatever the length of the window.
+
+    input :
+    -------
+        indir : str
+            Folder of the data/{year}/{group} site data
+        outdir : str
+            The cube is written to {outdir}/cube/{group}
+        group : str
+            Station group
+        years : list
+            Years of data to include, consecutive or not
+        site_measures : dict
+            Measure ids by site, from load_metadata()
+        data_format : str
+            csv, parquet or feather
+        resolution : str
+            Slot length, "base" (15 minutes), "hour" or "day",
+            Default = "day"
+        chunksize : int
+            CSV chunk size in rows, see iter_site_data()
+    return :
+    --------
+        cube : dict
+            See open_cube()
+    """
+    years = sorted(int(year) for year in years)
+    start = pd.Timestamp(f"{years[0]}-01-01", tz="UTC")
+    end = pd.Timestamp(f"{years[-1] + 1}-01-01", tz="UTC")
+    step = pd.Timedelta(DATATYPE_FREQ[resolution])
+    n_slots = (end - start) // step
+
+    ids = [id for measures in site_measures.values() for id in measures]
+    id_index = {id: i for i, id in enumerate(ids)}
+
+    path = cube_path(outdir, group)
+    os.makedirs(path, exist_ok=True)
+    counts_file = f"{path}/{CUBE_COUNTS_FILE_NAME}"
+    tmp_counts = f"{path}/.{CUBE_COUNTS_FILE_NAME}.tmp"
+    cube = np.lib.format.open_memmap(
+        tmp_counts,
+        mode="w+",
+        dtype=np.int32,
+        shape=(len(ids), n_slots + 1, N_CODES),
+    )
+
+    # Rows are counted by slot straight into the memory mapped cube (only
+    # the slots of a chunk are touched), then accumulated measure by
+    # measure, so memory does not grow with the number of slots
+    for site, measures in site_measures.items():
+        if len(measures) == 0:
+            continue
+        first = id_index[measures[0]]
+        for year in years:
+            site_path = site_data_path(
+                f"{indir}/data/{year}/{group}",
+                site,
+                data_format
+            )
+            if os.path.exists(site_path) is False:
+                continue
+            for data in iter_site_data(
+                site_path,
+                data_format,
+                columns=["date", "id", "state"],
+                chunksize=chunksize,
+            ):
+                slots = ((data["date"] - start) // step).to_numpy()
+                rows = (
+                    data["id"].isin(measures).to_numpy()
+                    & (slots >= 0) & (slots < n_slots)
+                )
+                ids_codes = pd.Categorical(
+                    data["id"][rows], categories=measures
+                ).codes
+                codes = encode_states(data["state"][rows])
+                cells, counts = np.unique(
+                    (ids_codes.astype(np.int64) * n_slots + slots[rows])
+                    * N_CODES + codes,
+                    return_counts=True,
+                )
+                measure, cells = np.divmod(cells, n_slots * N_CODES)
+                slot, code = np.divmod(cells, N_CODES)
+                cube[first + measure, slot + 1, code] += counts.astype(
+                    np.int32
+                )
+        for i in range(first, first + len(measures)):
+            np.cumsum(cube[i, 1:], axis=0, out=cube[i, 1:])
+    cube.flush()
+    del cube
+    os.replace(tmp_counts, counts_file)
+
+    index = {
+        "ids": ids,
+        "start": start.isoformat(),
+        "resolution": resolution,
+        "years": years,
+        "data_format": data_format,
+        "sources": cube_sources(indir, group, years, site_measures,
+                                data_format),
+    }
+    tmp_file = f"{path}/.{CUBE_INDEX_FILE_NAME}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_file, f"{path}/{CUBE_INDEX_FILE_NAME}")
+    return open_cube(outdir, group)
+
+
+def open_cube(outdir, group):
+    """
+    Memory map the cube of a group
+
+    return :
+    --------
+        cube : dict
+            "counts" : read only np.memmap (ids, slots + 1, codes)
+            "ids" : list, "start" : Timestamp, "step" : Timedelta, and the
+            other index.json keys. None when no cube was built.
+    """
+    path = cube_path(outdir, group)
+    index_file = f"{path}/{CUBE_INDEX_FILE_NAME}"
+    if os.path.exists(index_file) is False:
+        return None
+    with open(index_file) as f:
+        cube = json.load(f)
+    cube["start"] = pd.Timestamp(cube["start"])
+    cube["step"] = pd.Timedelta(DATATYPE_FREQ[cube["resolution"]])
+    cube["counts"] = np.load(f"{path}/{CUBE_COUNTS_FILE_NAME}",
+                             mmap_mode="r")
+    return cube
+
+
+def window_slot(cube, time):
+    """
+    Cube slot of a time, floored to the cube resolution and clipped to the
+    cube years
+    """
+    time = pd.Timestamp(time)
+    if time.tzinfo is None:
+        time = time.tz_localize("UTC")
+    slot = (time - cube["start"]) // cube["step"]
+    return int(min(max(slot, 0), cube["counts"].shape[1] - 1))
+
+
+def window_counts(cube, fromtime, totime, ids=None):
+    """
+    State counts of every measure over [fromtime, totime), two cube
+    lookups by measure
+
+    return :
+    --------
+        counts : dataframe
+            Indexed by id, a column by state code, "count" (rows in the
+            window) and "expected" (slots of 15 minutes in the window)
+    """
+    t0 = window_slot(cube, fromtime)
+    t1 = window_slot(cube, totime)
+    if ids is None:
+        rows = slice(None)
+        ids = cube["ids"]
+    else:
+        index = {id: i for i, id in enumerate(cube["ids"])}
+        ids = [id for id in ids if id in index]
+        rows = [index[id] for id in ids]
+    state_counts = cube["counts"][rows, t1] - cube["counts"][rows, t0]
+    counts = pd.DataFrame(
+        state_counts[:, :len(STATE_CODES)],
+        columns=STATE_CODES,
+        index=pd.Index(ids, name="id"),
+    )
+    counts["count"] = state_counts.sum(axis=1)
+    counts["expected"] = (t1 - t0) * (cube["step"] // pd.Timedelta("15min"))
+    return counts
+
+
+def window_rates(cube, fromtime, totime, ids=None):
+    """
+    Rates of every measure over [fromtime, totime)
+
+    tauxfo and dispo are rates of the rows present in the window, as the
+    monthly columns of compute_rates.py. tauxfo_expected and
+    dispo_expected are rates of the expected time steps of the window
+    (missing rows count as lost), as the year column of compute_rates.py,
+    which is the one to compare to for a full year. It divides by
+    current_days() * 96, so partial years differ by that day.
+
+    pert and pert_indi are the lost counts of the window over its hours
+    (0.4 of them for pert_indi). compute_rates.py divides the lost counts
+    since January 1st by 8760 (3504), whatever the month, so only a non
+    leap full year window gives its December pert; a one month window is
+    the loss rate of that month alone.
+
+    return :
+    --------
+        rates : dataframe
+            Indexed by id, with tauxfo, dispo, tauxfo_expected,
+            dispo_expected, pert, pert_indi, count and expected columns
+    """
+    counts = window_counts(cube, fromtime, totime, ids)
+    expected = counts["expected"].where(counts["expected"] > 0)
+    hours = expected / 4
+    valid_count = counts[OPERATIONAL_STATES].sum(axis=1)
+    disponibility_count = counts[DISPONIBILITY_STATES].sum(axis=1)
+    rates = pd.DataFrame(
+        {
+            "tauxfo": valid_count / counts["count"],
+            "dispo": disponibility_count / counts["count"],
+            "tauxfo_expected": valid_count / expected,
+            "dispo_expected": disponibility_count / expected,
+            "pert": counts[LOST_STATES].sum(axis=1) / hours,
+            "pert_indi": (
+                counts[INDISPONIBILITY_LOST_STATES].sum(axis=1)
+                / (hours * 0.4)
+            ),
+            "count": counts["count"],
+            "expected": counts["expected"],
+        }
+    )
+    return rates
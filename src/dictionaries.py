@@ -1,10 +1,16 @@
+import os
 from datetime import datetime
 
+API_URL = os.environ.get(
+    "XR_API_URL",
+    "https://172.16.13.224:8443/dms-api/public/v1"
+)
+
 URL_DICT = {
-    "data": "https://172.16.13.224:8443/dms-api/public/v1/data?",
-    "sites": "https://172.16.13.224:8443/dms-api/public/v1/sites?",
-    "physicals": "https://172.16.13.224:8443/dms-api/public/v1/physicals?",
-    "measures": "https://172.16.13.224:8443/dms-api/public/v1/measures?",
+    "data": f"{API_URL}/data?",
+    "sites": f"{API_URL}/sites?",
+    "physicals": f"{API_URL}/physicals?",
+    "measures": f"{API_URL}/measures?",
 }
 
 DATA_KEYS = {
@@ -14,10 +20,80 @@ DATA_KEYS = {
     "measures": "measures"
 }
 
+TRANSIENT_HTTP_STATUS = [429, 500, 502, 503, 504]
+
+# Default bounds of a single XR data request, see split_xr_request()
+MAX_URL_LENGTH = 2000
+MAX_POINTS = 200000
+
+# Requests submitted ahead of the consumer by worker thread, see
+# map_request_xr() : at most workers * REQUESTS_AHEAD responses are held
+REQUESTS_AHEAD = 2
+
+# Response cache of request_xr(), see cache.py
+CACHE_FILE_NAME = "responses.sqlite"
+
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Time to live of cached responses in seconds by endpoint (None : kept
+# until evicted). "data" is for windows ended more than CACHE_CLOSED_DELAY
+# seconds ago, "current" for the others, still filling or being validated
+CACHE_TTL = {
+    "data": 30 * 86400,
+    "current": 900,
+    "sites": 86400,
+    "measures": 86400,
+    "physicals": 86400,
+}
+
+CACHE_CLOSED_DELAY = 86400
+
+# Work queue of several workers sharing a run, see workqueue.py : a lease
+# not renewed for LEASE_TTL seconds is taken over by another worker, a task
+# is given up after LEASE_MAX_ATTEMPTS leases
+LEASE_TTL = 300
+
+LEASE_MAX_ATTEMPTS = 3
+
+QUEUE_POLL = 5
+
+DATATYPE_FREQ = {
+    "base": "15min",
+    "hour": "1h",
+    "day": "1D",
+    "month": "MS",
+}
+
+# Fetchable time steps of site data, with their number by day
+DATATYPE_SLOTS = {
+    "base": 96,
+    "hour": 24,
+    "day": 1,
+}
+
+DATA_FORMATS = ["csv", "parquet", "feather"]
+
+DATA_COLUMNS = ["date", "id", "value", "state", "validated"]
+
+PARQUET_ROW_GROUP_SIZE = 2976
+
+METADATA_CACHE_FILE_NAME = "metadata_cache.pkl"
+
+MANIFEST_FILE_NAME = "manifest.json"
+
+# A fetched month is only complete (never fetched again, see
+# resume_month()) MONTH_SETTLE_DELAY seconds after its end, once its last
+# time steps and validations reached the api, as CACHE_CLOSED_DELAY
+MONTH_SETTLE_DELAY = CACHE_CLOSED_DELAY
+
 GROUP_LIST = ["DIDON", "V_NICE", "V_MARS", "V_MART"]
 
 RATE_VARS = ["tauxfo", "dispo", "pert", "pert_indi", "max"]
 
+# Rates still meaningful on hour or day aggregates : pert and pert_indi are
+# counts of lost quarter-hours
+AGGREGATE_RATE_VARS = ["tauxfo", "dispo", "max"]
+
 RATE_FILE_NAMES_DIC = {
     "tauxfo": "tauxfo.csv",
     "pert": "pert.csv",
@@ -26,6 +102,32 @@ RATE_FILE_NAMES_DIC = {
     "max": "monthly_max.csv",
 }
 
+PERT_REPPORT_FILE_NAME = "pert_repport.csv"
+
+OUTLIERS_FILE_NAME = "outliers.csv"
+
+# Missing time step ranges of a data folder, and their summary by measure
+GAPS_FILE_NAME = "gaps.csv"
+
+COMPLETENESS_FILE_NAME = "completeness.csv"
+
+# Gaps closer than this number of time steps are refetched together
+GAP_MERGE_SLOTS = 96
+
+# Points by measure of the downsampled plotting series, coarse to fine
+DOWNSAMPLE_LEVELS = [500, 2000, 8000]
+
+CUBE_COUNTS_FILE_NAME = "counts.npy"
+
+CUBE_INDEX_FILE_NAME = "index.json"
+
+CUBE_RESOLUTIONS = ["base", "hour", "day"]
+
+OUTLIER_METHODS = ["zscore", "mad"]
+
+# MAD to standard deviation of a normal distribution
+MAD_SCALE = 1.4826
+
 RATE_VAR_DIC = {
     "tauxfo": "month_operational_rate",
     "dispo": "month_disponibility_rate",
@@ -34,4 +136,44 @@ RATE_VAR_DIC = {
     "max": "max",
 }
 
+STATE_CODES = ["A", "O", "R", "P", "N", "Z", "C", "D", "M", "I"]
+
+VALID_STATES = ["A", "O", "R"]
+
+OPERATIONAL_STATES = ["A", "O", "R", "P"]
+
+DISPONIBILITY_STATES = ["A", "O", "R", "P", "C", "Z", "M"]
+
+LOST_STATES = ["C", "Z", "M", "D", "N", "I"]
+
+INDISPONIBILITY_LOST_STATES = ["D", "N", "I"]
+
+# Plot color of each state code, "" for unknown states
+STATE_COLORS = {
+    "A": "#1a9850",
+    "O": "#66bd63",
+    "R": "#a6d96a",
+    "P": "#4575b4",
+    "N": "#d73027",
+    "Z": "#f46d43",
+    "C": "#fdae61",
+    "D": "#a50026",
+    "M": "#fee08b",
+    "I": "#762a83",
+    "": "#999999",
+}
+
+DEFAULT_STATE_MIX = {
+    "A": 0.86,
+    "O": 0.02,
+    "R": 0.03,
+    "P": 0.01,
+    "N": 0.02,
+    "Z": 0.01,
+    "C": 0.01,
+    "D": 0.01,
+    "M": 0.02,
+    "I": 0.01,
+}
+
 YEAR_NOW = int(datetime.now().strftime("%Y"))
@@ -0,0 +1,331 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from dictionaries import DOWNSAMPLE_LEVELS, STATE_CODES, STATE_COLORS
+from fonctions import VALID_CODES, count_states, encode_states
+from storage import files_signature, iter_site_data, site_data_files
+
+# State labels of encode_states() codes, "" for unknown states
+STATE_LABELS = np.array(STATE_CODES + [""], dtype=object)
+
+POINT_COLUMNS = ["date", "value", "state"]
+
+ENVELOPE_COLUMNS = ["date", "min", "max", "count", "state", "invalid"]
+
+# Version of the downsampled series, cached series of another version are
+# rebuilt, see site_series()
+SERIES_VERSION = 2
+
+
+def downsampled_path(outdir, year, group, site):
+    return f"{outdir}/downsampled/{year}/{group}/{site}.pkl"
+
+
+def lttb(x, y, n_out):
+    """
+    Largest-triangle-three-buckets downsampling
+
+    The first and last points are kept, the others are split into
+    n_out - 2 buckets, each giving the point making the largest triangle
+    with the point kept from the previous bucket and the mean of the next
+    one. Peaks and drops of the series are kept, unlike a mean.
+
+    input :
+    -------
+        x, y : np.ndarray
+            Sorted abscissas (time as numbers) and values, without NaN
+        n_out : int
+            Number of points to keep
+    return :
+    --------
+        index : np.ndarray
+            Positions of the kept points
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = (np.asarray(x) - x[0]).astype(np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    edges = np.append(edges, n)
+    index = np.empty(n_out, dtype=np.int64)
+    index[0] = 0
+    index[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_x = x[end:edges[i + 2]].mean()
+        next_y = y[end:edges[i + 2]].mean()
+        area = np.abs(
+            (x[a] - next_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (next_y - y[a])
+        )
+        a = start + int(np.argmax(area))
+        index[i + 1] = a
+    return index
+
+
+def time_buckets(dates, n_buckets):
+    """
+    Split sorted dates into n_buckets buckets of the same time span
+
+    return :
+    --------
+        start : pd.Timestamp
+            Start of the first bucket
+        span : pd.Timedelta
+            Time span of a bucket
+        buckets : np.ndarray
+            Bucket of each date
+    """
+    start = dates.iloc[0]
+    span = ((dates.iloc[-1] - start) / n_buckets).ceil("s")
+    buckets = np.zeros(len(dates), dtype=np.int64)
+    if span > pd.Timedelta(0):
+        buckets = np.minimum(((dates - start) // span).to_numpy(),
+                             n_buckets - 1)
+    return start, span, buckets
+
+
+def minmax_envelope(data, n_buckets):
+    """
+    Min and max of a measure series over n_buckets time buckets
+
+    return :
+    --------
+        envelope : dataframe
+            By non empty bucket : date (bucket start), min, max, count,
+            state (most frequent state code) and invalid (count of rows
+            without a VALID_STATES state)
+    """
+    start, span, buckets = time_buckets(data["date"], n_buckets)
+    codes = encode_states(data["state"])
+    state_counts = count_states(codes, buckets, n_buckets)
+    by_bucket = data["value"].groupby(buckets)
+    envelope = pd.DataFrame(
+        {
+            "min": by_bucket.min(),
+            "max": by_bucket.max(),
+        }
+    )
+    envelope["count"] = state_counts.sum(axis=1)[envelope.index]
+    envelope = envelope[envelope["count"] > 0]
+    envelope.insert(0, "date", start + envelope.index * span)
+    envelope["state"] = STATE_LABELS[
+        state_counts[envelope.index].argmax(axis=1)
+    ]
+    envelope["invalid"] = (
+        envelope["count"]
+        - state_counts[envelope.index][:, VALID_CODES].sum(axis=1)
+    )
+    return envelope.reset_index(drop=True)
+
+
+def downsample_measure(data, n_points):
+    """
+    LTTB points and min/max envelope of one measure
+
+    input :
+    -------
+        data : dataframe
+            date, value, state rows of the measure
+        n_points : int
+            Points of the LTTB series, the envelope takes n_points / 2
+            buckets (two values each)
+    return :
+    --------
+        points : dataframe
+            date, value and state of the kept rows, in date order. Rows
+            without value (N, I states) are not part of the LTTB series,
+            the first one of each state of an envelope bucket is kept with
+            a NaN value so their states are still drawn
+        envelope : dataframe
+            See minmax_envelope()
+    """
+    data = data.dropna(subset=["date"]).sort_values("date", kind="stable")
+    if len(data) == 0:
+        return data[POINT_COLUMNS], pd.DataFrame(columns=ENVELOPE_COLUMNS)
+    n_buckets = max(n_points // 2, 1)
+    missing = data["value"].isna().to_numpy()
+    valued = data[~missing]
+    index = lttb(valued["date"].astype("int64").to_numpy(),
+                 valued["value"].to_numpy(),
+                 n_points)
+    points = valued[POINT_COLUMNS].iloc[index]
+    if missing.any():
+        _, _, buckets = time_buckets(data["date"], n_buckets)
+        no_value = data[POINT_COLUMNS][missing]
+        first = ~pd.DataFrame(
+            {
+                "bucket": buckets[missing],
+                "state": no_value["state"].astype(str).to_numpy(),
+            }
+        ).duplicated().to_numpy()
+        points = pd.concat([points, no_value[first]]).sort_values(
+            "date", kind="stable"
+        )
+    return (points.reset_index(drop=True),
+            minmax_envelope(data, n_buckets))
+
+
+def downsample_site(site_path, data_format, levels=DOWNSAMPLE_LEVELS,
+                    chunksize=None):
+    """
+    Downsampled series of every measure of a site at each zoom level
+
+    input :
+    -------
+        site_path : str
+            From site_data_path()
+        data_format : str
+            csv, parquet or feather
+        levels : list
+            Points by measure of each level, see downsample_measure()
+        chunksize : int
+            CSV chunk size in rows, see iter_site_data()
+    return :
+    --------
+        series : dict
+            By level : {"points": dataframe, "envelope": dataframe}, the
+            downsample_measure() frames of every measure with an id column
+    """
+    data = pd.concat(
+        iter_site_data(site_path,
+                       data_format,
+                       columns=["date", "id", "value", "state"],
+                       chunksize=chunksize),
+        ignore_index=True,
+    )
+    series = {}
+    for level in levels:
+        points = []
+        envelopes = []
+        for id, measure in data.groupby("id", observed=True, sort=False):
+            measure_points, envelope = downsample_measure(measure, level)
+            points.append(measure_points.assign(id=id))
+            envelopes.append(envelope.assign(id=id))
+        series[level] = {
+            "points": pd.concat(
+                points or [pd.DataFrame(columns=POINT_COLUMNS + ["id"])],
+                ignore_index=True
+            ),
+            "envelope": pd.concat(
+                envelopes or [pd.DataFrame(columns=ENVELOPE_COLUMNS + ["id"])],
+                ignore_index=True
+            ),
+        }
+    return series
+
+
+def site_series(site_path, data_format, cache_file,
+                levels=DOWNSAMPLE_LEVELS, rebuild=False, chunksize=None):
+    """
+    downsample_site() series kept in cache_file, rebuilt when the site
+    data files, the levels or SERIES_VERSION changed
+    """
+    signature = files_signature(site_data_files(site_path, data_format))
+    if not rebuild and os.path.exists(cache_file):
+        cache = pd.read_pickle(cache_file)
+        if (
+            cache.get("version") == SERIES_VERSION
+            and cache["signature"] == signature
+            and cache["levels"] == list(levels)
+        ):
+            return cache["series"]
+
+    series = downsample_site(site_path, data_format, levels, chunksize)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = f"{cache_file}.tmp"
+    pd.to_pickle(
+        {
+            "version": SERIES_VERSION,
+            "signature": signature,
+            "levels": list(levels),
+            "series": series,
+        },
+        tmp_file
+    )
+    os.replace(tmp_file, cache_file)
+    return series
+
+
+def series_figure(points, envelope=None, title=""):
+    """
+    plotly figure of downsampled series : by measure, the min/max envelope
+    as a band, the LTTB points colored by state (STATE_COLORS) and the
+    rows without value as crosses colored by state at the bottom of the
+    series. The band hover gives the invalid rows of each bucket.
+
+    input :
+    -------
+        points : dataframe
+            "points" of a site_series() level, for one or more measures
+            (and sites)
+        envelope : dataframe
+            "envelope" of the same level, Default = None (no band)
+    return :
+    --------
+        figure : plotly.graph_objects.Figure
+    """
+    # plotly is only imported here, it is slow to import
+    import plotly.graph_objects as go
+
+    figure = go.Figure()
+    for id, measure in points.groupby("id", observed=True, sort=False):
+        if envelope is not None:
+            band = envelope[envelope["id"] == id]
+            figure.add_trace(
+                go.Scattergl(x=band["date"], y=band["max"], mode="lines",
+                             line={"width": 0}, legendgroup=str(id),
+                             showlegend=False, hoverinfo="skip")
+            )
+            figure.add_trace(
+                go.Scattergl(x=band["date"], y=band["min"], mode="lines",
+                             line={"width": 0}, fill="tonexty",
+                             legendgroup=str(id), showlegend=False,
+                             text=[f"{n} invalid" for n in band["invalid"]],
+                             hoverinfo="x+text")
+            )
+        missing = measure["value"].isna()
+        valued = measure[~missing]
+        states = valued["state"].astype(str)
+        figure.add_trace(
+            go.Scattergl(
+                x=valued["date"],
+                y=valued["value"],
+                mode="lines+markers",
+                name=str(id),
+                legendgroup=str(id),
+                line={"width": 1},
+                marker={
+                    "size": 4,
+                    "color": [STATE_COLORS.get(state, STATE_COLORS[""])
+                              for state in states],
+                },
+                text=states,
+            )
+        )
+        if missing.any():
+            baseline = valued["value"].min() if len(valued) > 0 else 0
+            states = measure["state"][missing].astype(str)
+            figure.add_trace(
+                go.Scattergl(
+                    x=measure["date"][missing],
+                    y=[baseline] * len(states),
+                    mode="markers",
+                    name=f"{id} no value",
+                    legendgroup=str(id),
+                    marker={
+                        "size": 6,
+                        "symbol": "x",
+                        "color": [STATE_COLORS.get(state, STATE_COLORS[""])
+                                  for state in states],
+                    },
+                    text=states,
+                    hoverinfo="x+text",
+                )
+            )
+    figure.update_layout(title=title)
+    return figure
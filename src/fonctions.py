@@ -1,4 +1,7 @@
 import calendar
+import csv
+from collections import deque
+import json
 from calendar import monthrange
 from datetime import date
 import os
@@ -7,15 +10,42 @@ import warnings
 import numpy as np
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 import datetime as dt
-from scipy import stats
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 
 from dictionaries import (
     URL_DICT,
     DATA_KEYS,
+    DATA_COLUMNS,
+    DATATYPE_FREQ,
+    TRANSIENT_HTTP_STATUS,
+    REQUESTS_AHEAD,
+    RATE_VARS,
+    AGGREGATE_RATE_VARS,
+    DATATYPE_SLOTS,
+    MAD_SCALE,
+    STATE_CODES,
+    VALID_STATES,
+    OPERATIONAL_STATES,
+    DISPONIBILITY_STATES,
+    LOST_STATES,
+    INDISPONIBILITY_LOST_STATES,
     )
 
+from cache import cache_get, cache_put, request_key, response_ttl
+
+STATE_DTYPE = pd.CategoricalDtype(STATE_CODES)
+
+VALID_CODES = [STATE_CODES.index(state) for state in VALID_STATES]
+
 
 def compute_rates(
     site: str,
@@ -60,16 +90,9 @@ def compute_rates(
         total_indisponibility_lost : int
             accumulated lost du to indi. count over the months
     """
-    A = data[data["state"] == "A"]["state"].count()
-    O_ = data[data["state"] == "O"]["state"].count()
-    R = data[data["state"] == "R"]["state"].count()
-    P = data[data["state"] == "P"]["state"].count()
-    N = data[data["state"] == "N"]["state"].count()
-    Z = data[data["state"] == "Z"]["state"].count()
-    C = data[data["state"] == "C"]["state"].count()
-    D = data[data["state"] == "D"]["state"].count()
-    M = data[data["state"] == "M"]["state"].count()
-    I_ = data[data["state"] == "I"]["state"].count()
+    codes = encode_states(data["state"])
+    state_counts = count_states(codes)
+    (A, O_, R, P, N, Z, C, D, M, I_) = state_counts[:len(STATE_CODES)]
 
     month_count = data["id"].count()
     if month_count == 0:
@@ -92,7 +115,7 @@ def compute_rates(
         "month_operational_rate": [month_operational_rate],
         "overall_lost_rate": [overall_lost_rate],
         "overall_indisponibility_lost": [overall_indisponibility_lost],
-        "max": [data[data['state'].isin(['A', 'O', 'R'])]['value'].max()],
+        "max": [data["value"][np.isin(codes, VALID_CODES)].max()],
     }
 
     return (
@@ -104,13 +127,426 @@ def compute_rates(
         valid_count)
 
 
+def encode_states(states):
+    """
+    Encode state codes as uint8 following STATE_CODES order
+
+    INPUTS
+    ------
+        states : series
+            State codes, as strings or as STATE_DTYPE categorical
+
+    RETURN
+    ------
+        codes : np.ndarray
+            uint8 codes, unknown or missing states are coded
+            len(STATE_CODES)
+    """
+    if not isinstance(states.dtype, pd.CategoricalDtype) or (
+        list(states.cat.categories) != STATE_CODES
+    ):
+        states = states.astype(STATE_DTYPE)
+    codes = states.cat.codes.to_numpy()
+    return np.where(codes < 0, len(STATE_CODES), codes).astype(np.uint8)
+
+
+def count_states(codes, groups=None, n_groups=1):
+    """
+    Count every state code in a single pass
+
+    INPUTS
+    ------
+        codes : np.ndarray
+            uint8 state codes from encode_states()
+        groups : np.ndarray
+            Optional group number (month, id, ...) of each code,
+            from 0 to n_groups-1
+        n_groups : int
+            Number of groups
+
+    RETURN
+    ------
+        counts : np.ndarray
+            Counts by state code in STATE_CODES order, last column is the
+            count of unknown states. Shape (len(STATE_CODES)+1,) without
+            groups, (n_groups, len(STATE_CODES)+1) otherwise.
+    """
+    n_codes = len(STATE_CODES) + 1
+    if groups is None:
+        return np.bincount(codes, minlength=n_codes)
+    flat = np.asarray(groups, dtype=np.int64) * n_codes + codes
+    return np.bincount(
+        flat,
+        minlength=n_groups * n_codes
+    ).reshape(n_groups, n_codes)
+
+
+def count_months(
+    data: pd.DataFrame,
+    month: int,
+):
+    """
+    Count state codes and monthly max for every (id, month) found in data,
+    from January to month, without checking that every month is present.
+    Counts of several parts of a site data add up with
+    combine_month_counts().
+
+    INPUTS
+    ------
+        data : dataframe
+            Dataframe of site data with state code of measuring stations
+        month : int
+            Last month to process
+
+    RETURN
+    ------
+        counts : dataframe
+            Indexed by (id, month), with a column by state code, the total
+            count of the month ("count") and the max of valid data ("max").
+            Ids keep their order of appearance in data.
+    """
+    if len(data) == 0:
+        counts = pd.DataFrame(
+            columns=STATE_CODES + ["count", "max"],
+            index=pd.MultiIndex.from_arrays([[], []], names=["id", "month"]),
+        )
+        return counts.astype("int64").astype({"max": data["value"].dtype})
+    id_codes, ids = pd.factorize(data["id"], sort=False)
+    months = data["date"].dt.month.to_numpy()
+    in_range = months <= month
+    groups = id_codes[in_range] * month + (months[in_range] - 1)
+    codes = encode_states(data["state"])[in_range]
+
+    state_counts = count_states(codes, groups, len(ids) * month)
+    counts = pd.DataFrame(
+        state_counts[:, :len(STATE_CODES)],
+        columns=STATE_CODES,
+        index=pd.MultiIndex.from_product(
+            [ids, range(1, month + 1)],
+            names=["id", "month"],
+        ),
+    )
+    counts["count"] = state_counts.sum(axis=1)
+
+    valid = np.isin(codes, VALID_CODES)
+    month_max = (
+        pd.Series(data["value"].to_numpy()[in_range][valid])
+        .groupby(groups[valid])
+        .max()
+    )
+    counts["max"] = month_max.reindex(range(len(counts))).to_numpy()
+    return counts[counts["count"] > 0]
+
+
+def combine_month_counts(counts_list):
+    """
+    Add up count_months() results of several parts of a site data
+    """
+    counts = pd.concat(counts_list)
+    grouped = counts.groupby(level=["id", "month"], sort=False)
+    combined = grouped[STATE_CODES + ["count"]].sum()
+    combined["max"] = grouped["max"].max()
+    return combined
+
+
+def complete_month_counts(
+    site: str,
+    counts: pd.DataFrame,
+    month: int,
+):
+    """
+    Align counts on every month from January to month for each id, exit
+    when an id has no data for one of them.
+    """
+    ids = counts.index.get_level_values("id").unique()
+    counts = counts.reindex(
+        pd.MultiIndex.from_product(
+            [ids, range(1, month + 1)],
+            names=["id", "month"],
+        )
+    )
+    if counts["count"].isna().any():
+        sys.exit(f"Corrupted or incomplete CSV file for site : {site}")
+    state_cols = STATE_CODES + ["count"]
+    counts[state_cols] = counts[state_cols].astype("int64")
+    return counts
+
+
+def aggregate_month_counts(
+    site: str,
+    data: pd.DataFrame,
+    month: int,
+):
+    """
+    Count state codes and monthly max for every (id, month) of a site
+    in one pass, from January to month.
+
+    INPUTS
+    ------
+        site : str
+            Processing site
+        data : dataframe
+            Dataframe of a site data with state code of measuring stations
+        month : int
+            Last month to process
+
+    RETURN
+    ------
+        counts : dataframe
+            See count_months(), with a row for every month of every id.
+    """
+    return complete_month_counts(site, count_months(data, month), month)
+
+
+def build_rate_tables(
+    site: str,
+    counts: pd.DataFrame,
+    phy_names: dict,
+    year: int,
+    month: int,
+    datatype: str = "base",
+):
+    """
+    Derive the wide rate tables of a site from its monthly counts
+
+    INPUTS
+    ------
+        site : str
+            Processing site
+        counts : dataframe
+            Monthly counts from aggregate_month_counts()
+        phy_names : dict
+            Physical name by measure id
+        year : int
+            Processed year
+        month : int
+            Last processed month
+        datatype : str
+            Time step of the counted data (base, hour, day), only the
+            AGGREGATE_RATE_VARS are computed from hour or day aggregates
+            Default = "base"
+
+    RETURN
+    ------
+        rate_tables : dict
+            One dataframe by RATE_VARS key, one row by id and one column by
+            month name, plus the year column for tauxfo and dispo.
+        pert_repport : dataframe
+            Rows of the pert table with a lost rate over 1 on the last month
+            (empty for aggregates)
+    """
+    if datatype == "base":
+        rate_vars = RATE_VARS
+    else:
+        rate_vars = AGGREGATE_RATE_VARS
+    ids = counts.index.get_level_values("id").unique()
+    month_names = [calendar.month_name[m] for m in range(1, month + 1)]
+
+    disponibility_count = counts[DISPONIBILITY_STATES].sum(axis=1)
+    valid_count = counts[OPERATIONAL_STATES].sum(axis=1)
+    lost_count = counts[LOST_STATES].sum(axis=1)
+    indisponibility_lost = counts[INDISPONIBILITY_LOST_STATES].sum(axis=1)
+
+    month_values = {
+        "tauxfo": valid_count / counts["count"],
+        "dispo": disponibility_count / counts["count"],
+        "pert": lost_count.groupby(level="id", sort=False).cumsum() / 8760,
+        "pert_indi": (
+            indisponibility_lost.groupby(level="id", sort=False).cumsum()
+            / 3504
+        ),
+        "max": counts["max"],
+    }
+
+    model_df = pd.DataFrame(
+        {
+            "id": ids,
+            "site": site,
+            "polluant": [phy_names.get(id) for id in ids],
+        }
+    )
+
+    year_slots = current_days(year, month) * DATATYPE_SLOTS[datatype]
+    year_values = {
+        "tauxfo": valid_count.groupby(level="id", sort=False).sum(),
+        "dispo": disponibility_count.groupby(level="id", sort=False).sum(),
+    }
+
+    rate_tables = {}
+    for var in rate_vars:
+        wide = month_values[var].unstack("month").reindex(ids)
+        wide.columns = month_names
+        table = pd.concat(
+            [model_df, wide.reset_index(drop=True)],
+            axis=1,
+        )
+        if var in year_values:
+            table[year] = year_values[var].reindex(ids).values / year_slots
+        rate_tables[var] = table
+
+    if "pert" not in rate_tables:
+        return rate_tables, model_df.iloc[:0]
+    pert = rate_tables["pert"]
+    pert_repport = pert[pert[calendar.month_name[month]] > 1]
+    return rate_tables, pert_repport
+
+
+def append_rate_table(table, buffer):
+    """
+    Append a rate table to an in-memory CSV buffer, with the header when
+    the buffer is empty. Every row keeps the 0 index written by the former
+    per-id appends.
+    """
+    table = table.set_axis([0] * len(table), axis=0)
+    table.to_csv(
+        buffer,
+        header=(buffer.tell() == 0)
+    )
+
+
+def write_rate_files(buffers, out_dir):
+    """
+    Write rate CSV buffers to out_dir, one file by buffer name
+
+    Every file is first written to a temporary file, then all of them are
+    renamed over the former files, so an interrupted run leaves the former
+    results in place. Files of empty buffers are removed.
+
+    input :
+    -------
+        buffers : dict
+            CSV text buffers by file name
+        out_dir : str
+            rates/{year}/{group} folder
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    tmp_files = {}
+    for file_name, buffer in buffers.items():
+        if buffer.tell() == 0:
+            continue
+        tmp_file = os.path.join(out_dir, f".{file_name}.tmp")
+        with open(tmp_file, "w", newline="") as f:
+            f.write(buffer.getvalue())
+        tmp_files[file_name] = tmp_file
+
+    for file_name in buffers:
+        out_file = os.path.join(out_dir, file_name)
+        if file_name in tmp_files:
+            os.replace(tmp_files[file_name], out_file)
+        elif os.path.exists(out_file):
+            os.remove(out_file)
+
+
 def get_outliers(in_data, threshold=1.5):
+    # scipy is only imported here, it is slow to import
+    from scipy import stats
+
     data = in_data[(in_data['state'].isin(['A', 'O', 'R']))]
     z = np.abs(stats.zscore(data['value']))
     outliers = data[z > threshold]
     return (outliers)
 
 
+def find_outliers(data, threshold=1.5, method="zscore", window=None):
+    """
+    get_outliers() of every measure id of data in one groupby pass
+
+    input :
+    -------
+        data : dataframe
+            Site or group data with date, id, value and state columns
+        threshold : float
+            Absolute score above which a value is an outlier,
+            Default = 1.5
+        method : str
+            "zscore" : (value - mean) / std by id
+            "mad" : (value - median) / (MAD * MAD_SCALE) by id, robust to
+            the outliers themselves
+            Default = "zscore"
+        window : int
+            Number of time steps of a rolling window (centered) to compute
+            the mean/std or median/MAD over, see rolling_mad(),
+            Default = None (whole data)
+    return :
+    --------
+        outliers : dataframe
+            Rows of data with valid states (VALID_STATES) and an absolute
+            score above threshold, with their score
+    """
+    data = data[data["state"].isin(VALID_STATES) & data["value"].notna()]
+    if window is not None:
+        data = data.sort_values(["id", "date"], kind="stable")
+    values = data["value"].astype("float64")
+    ids = data["id"]
+
+    def by_id(series, stat):
+        grouped = series.groupby(ids, observed=True, sort=False)
+        if window is None:
+            if stat == "std":
+                return grouped.transform("std", ddof=0)
+            return grouped.transform(stat)
+        rolling = grouped.rolling(window, min_periods=1, center=True)
+        if stat == "std":
+            result = rolling.std(ddof=0)
+        else:
+            result = getattr(rolling, stat)()
+        return result.droplevel(0).reindex(series.index)
+
+    if method == "zscore":
+        center = by_id(values, "mean")
+        scale = by_id(values, "std")
+    elif window is None:
+        center = by_id(values, "median")
+        scale = by_id((values - center).abs(), "median") * MAD_SCALE
+    else:
+        center, scale = rolling_mad(values, ids, window)
+        scale = scale * MAD_SCALE
+
+    score = (values - center) / scale.where(scale > 0)
+    outliers = data[score.abs() > threshold].copy()
+    outliers["score"] = score[outliers.index]
+    return outliers
+
+
+def rolling_mad(values, ids, window):
+    """
+    Median and median absolute deviation of values by id over centered
+    rolling windows (as pandas rolling(window, center=True, min_periods=1))
+
+    The deviations of a window are taken from the median of that window,
+    as the MAD of each window on its own would be. Windows are numpy views
+    of each id values, NaN padded at the edges.
+
+    input :
+    -------
+        values : pd.Series
+            float values, the rows of an id in time order
+        ids : pd.Series
+            Measure id of each value
+        window : int
+            Number of values by window
+    return :
+    --------
+        center, mad : pd.Series
+            Rolling median and MAD, on the values index
+    """
+    center = np.full(len(values), np.nan)
+    mad = np.full(len(values), np.nan)
+    before = window // 2
+    after = window - 1 - before
+    grouped = values.groupby(ids, observed=True, sort=False)
+    for rows in grouped.indices.values():
+        padded = np.pad(values.to_numpy()[rows],
+                        (before, after),
+                        constant_values=np.nan)
+        windows = np.lib.stride_tricks.sliding_window_view(padded, window)
+        medians = np.nanmedian(windows, axis=1)
+        center[rows] = medians
+        mad[rows] = np.nanmedian(np.abs(windows - medians[:, None]), axis=1)
+    return (pd.Series(center, index=values.index),
+            pd.Series(mad, index=values.index))
+
+
 def request_xr(
     fromtime: str = "",
     totime: str = "",
@@ -118,7 +554,12 @@ def request_xr(
     datatypes: str = "base",
     groups: str = "",
     sites: str = "",
-    measures: str = ""
+    measures: str = "",
+    session: requests.Session = None,
+    stream: bool = False,
+    base_url: str = "",
+    max_url_length: int = 0,
+    max_points: int = 0,
 ):
     """
     Get json objects from XR rest api
@@ -144,13 +585,82 @@ def request_xr(
         measures : str
             list of measure ids
             Default : str
+        session : requests.Session
+            Keep-alive session from get_session(), responses are looked up
+            in and added to its cache if it has one
+            Default = None (one connection by request)
+        stream : bool
+            Parse the response body incrementally and return an iterator
+            of items (needs ijson, ignored otherwise and with a cache)
+            Default = False
+        base_url : str
+            XR rest api root, like https://host:port/dms-api/public/v1
+            Default = "" (URL_DICT, see XR_API_URL environment variable)
+        max_url_length, max_points : int
+            Bounds of a single data request, larger requests are split by
+            measures then by time windows and their responses merged, see
+            split_xr_request(). Default = 0 (no bound)
     return :
     --------
         csv : csv file
             File in ../data directory
     """
-    url = (
-        f"{URL_DICT[folder]}&"
+    if max_url_length or max_points:
+        parts = split_xr_request(
+            dict(fromtime=fromtime, totime=totime, folder=folder,
+                 datatypes=datatypes, groups=groups, sites=sites,
+                 measures=measures, stream=stream, base_url=base_url,
+                 max_url_length=max_url_length, max_points=max_points)
+        )
+        if len(parts) > 1 or len(parts[0]) > 1:
+            return merge_xr_responses(
+                (
+                    (request_xr(session=session, **kwargs)
+                     for kwargs in windows)
+                    for windows in parts
+                ),
+                datatypes,
+            )
+    url = xr_url(folder, base_url, fromtime, totime, sites, datatypes,
+                 groups, measures)
+    cache = getattr(session, "xr_cache", None)
+    if cache is not None:
+        key = request_key(url)
+        body = cache_get(cache, key)
+        if body is not None:
+            return json.loads(body)[DATA_KEYS[folder]]
+    # SECURITY RISK IF IN PRODUCTION - ADD CERTIFICATE SSL VERIFICATION
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore")
+        stream = stream and ijson is not None and cache is None
+        if session is None:
+            response = requests.get(url, verify=False, stream=stream)
+        else:
+            response = session.get(url, stream=stream)
+        response.raise_for_status()
+        if stream:
+            response.raw.decode_content = True
+            return ijson.items(response.raw,
+                               f"{DATA_KEYS[folder]}.item",
+                               use_float=True)
+        if cache is not None:
+            cache_put(cache, key, response.content,
+                      response_ttl(cache, folder, totime))
+        data = response.json()
+    return data[DATA_KEYS[folder]]
+
+
+def xr_url(folder, base_url="", fromtime="", totime="", sites="",
+           datatypes="base", groups="", measures=""):
+    """
+    Url of a request_xr() request
+    """
+    if base_url:
+        folder_url = f"{base_url.rstrip('/')}/{folder}?"
+    else:
+        folder_url = URL_DICT[folder]
+    return (
+        f"{folder_url}&"
         f"from={fromtime}&"
         f"to={totime}&"
         f"sites={sites}&"
@@ -158,34 +668,292 @@ def request_xr(
         f"groups={groups}&"
         f"measures={measures}"
     )
+
+
+def split_xr_request(kwargs):
+    """
+    Split a request_xr() data request to keep its url under max_url_length
+    characters and its response under max_points time steps
+
+    Measures are first split into chunks whose url fits max_url_length
+    and whose points fit max_points. The time window of a chunk is only
+    split when a single measure exceeds max_points.
+
+    input :
+    -------
+        kwargs : dict
+            request_xr() keyword arguments, with max_url_length and
+            max_points (0 for no bound)
+    return :
+    --------
+        parts : list
+            By chunk of measures, in measure order, the list of request_xr()
+            kwargs of its time windows, in time order
+    """
+    kwargs = dict(kwargs)
+    max_url_length = kwargs.pop("max_url_length", 0)
+    max_points = kwargs.pop("max_points", 0)
+    measures = [m for m in kwargs.get("measures", "").split(",") if m]
+    datatype = kwargs.get("datatypes", "base")
+    if kwargs.get("folder") != "data" or len(measures) == 0:
+        return [[kwargs]]
+
+    if datatype in DATATYPE_SLOTS:
+        step = pd.Timedelta(DATATYPE_FREQ[datatype])
+        start = pd.Timestamp(kwargs["fromtime"])
+        end = pd.Timestamp(kwargs["totime"])
+        n_slots = (end - start) // step + 1
+    else:
+        n_slots = 1
+    chunk_points = max(max_points // n_slots, 1) if max_points else None
+
+    url_length = len(
+        xr_url(kwargs["folder"], kwargs.get("base_url", ""),
+               kwargs.get("fromtime", ""), kwargs.get("totime", ""),
+               kwargs.get("sites", ""), datatype, kwargs.get("groups", ""))
+    )
+    chunks = [[]]
+    length = url_length
+    for measure in measures:
+        chunk = chunks[-1]
+        too_long = (
+            max_url_length and length + len(measure) + 1 > max_url_length
+        )
+        too_large = chunk_points and len(chunk) >= chunk_points
+        if len(chunk) > 0 and (too_long or too_large):
+            chunks.append([])
+            length = url_length
+        chunks[-1].append(measure)
+        length += len(measure) + 1
+
+    n_windows = 1
+    if max_points and n_slots > max_points:
+        n_windows = -(-n_slots // max_points)
+    window_slots = -(-n_slots // n_windows)
+
+    parts = []
+    for chunk in chunks:
+        windows = []
+        for k in range(n_windows):
+            window = dict(kwargs, measures=",".join(chunk))
+            if n_windows > 1:
+                first = start + k * window_slots * step
+                last = min(first + (window_slots - 1) * step, end)
+                window["fromtime"] = first.strftime("%Y-%m-%dT%H:%M:%SZ")
+                window["totime"] = last.strftime("%Y-%m-%dT%H:%M:%SZ")
+            windows.append(window)
+        parts.append(windows)
+    return parts
+
+
+def merge_xr_responses(parts, datatype="base"):
+    """
+    Merge the responses of split_xr_request() parts into one data
+    response, measure by measure in request order
+
+    input :
+    -------
+        parts : iterable
+            By chunk of measures, an iterable of the responses of its time
+            windows, in time order
+        datatype : str
+            Time step key of the measures
+    return :
+    --------
+        data : iterator
+            One dict by measure, only one chunk of measures is held in
+            memory at a time
+    """
+    for windows in parts:
+        merged = {}
+        for response in windows:
+            for measure in response:
+                if measure["id"] not in merged:
+                    merged[measure["id"]] = dict(measure, **{datatype: []})
+                merged[measure["id"]][datatype].extend(measure[datatype])
+        yield from merged.values()
+
+
+def newer_rows(data, since, datatype="base"):
+    """
+    Rows of a request_xr() data response after the last fetched date of
+    their measure
+
+    input :
+    -------
+        data : iterable
+            request_xr() data response, one dict by measure
+        since : dict
+            Last fetched date by measure id, "" to keep every row
+    return :
+    --------
+        data : iterator
+            One dict by measure with only its new rows
+    """
+    for measure in data:
+        last = since.get(measure["id"], "")
+        yield dict(
+            measure,
+            **{datatype: [d for d in measure[datatype]
+                          if d.get("date", "") > last]}
+        )
+
+
+def get_session(max_per_host=4, retries=3, backoff=0.5, cache=None):
+    """
+    Keep-alive session for XR rest api requests
+
+    input :
+    -------
+        max_per_host : int
+            Max simultaneous connections to the api host, further
+            requests wait for a free connection
+        retries : int
+            Retries on connection errors and transient HTTP status
+        backoff : float
+            Backoff factor in seconds between retries (exponential)
+        cache : dict
+            Response cache from open_cache(), used by request_xr()
+            Default = None (no cache)
+    return :
+    --------
+        session : requests.Session
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=TRANSIENT_HTTP_STATUS,
+        allowed_methods=["GET"],
+    )
+    adapter = HTTPAdapter(
+        pool_maxsize=max_per_host,
+        pool_block=True,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
     # SECURITY RISK IF IN PRODUCTION - ADD CERTIFICATE SSL VERIFICATION
-    with warnings.catch_warnings():
-        warnings.filterwarnings("ignore")
-        data = requests.get(url, verify=False).json()
-    return data[DATA_KEYS[folder]]
+    session.verify = False
+    session.xr_cache = cache
+    return session
+
+
+def bounded_map(pool, function, items, ahead):
+    """
+    pool.map() submitting items at most ahead calls before the one being
+    consumed, results in the order of items
+    """
+    pending = deque()
+    for item in items:
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+        pending.append(pool.submit(function, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def map_request_xr(requests_kwargs, session, workers=1):
+    """
+    Run request_xr() for each kwargs dict on a thread pool
+
+    input :
+    -------
+        requests_kwargs : list
+            request_xr() keyword arguments, one dict by request
+        session : requests.Session
+            Session shared by the workers
+        workers : int
+            Number of threads, 1 runs requests one after another
+    return :
+    --------
+        responses : iterator
+            request_xr() results in the order of requests_kwargs
+
+    Requests are only submitted workers * REQUESTS_AHEAD ahead of the
+    consumer, so the responses of a whole plan are not held in memory
+    before they are written.
+    """
+    if workers <= 1:
+        for kwargs in requests_kwargs:
+            yield request_xr(session=session, **kwargs)
+        return
+    # Parts of split requests go to the pool separately, so one slow part
+    # does not hold a whole request
+    parts = [split_xr_request(kwargs) for kwargs in requests_kwargs]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        responses = bounded_map(
+            pool,
+            lambda kwargs: request_xr(session=session, **kwargs),
+            (kwargs for request in parts
+             for windows in request
+             for kwargs in windows),
+            workers * REQUESTS_AHEAD,
+        )
+        for request, kwargs in zip(parts, requests_kwargs):
+            if len(request) == 1 and len(request[0]) == 1:
+                yield next(responses)
+                continue
+            yield list(
+                merge_xr_responses(
+                    [
+                        [next(responses) for _ in windows]
+                        for windows in request
+                    ],
+                    kwargs.get("datatypes", "base"),
+                )
+            )
+
+
+def build_csv_data(data, outfile, datatype="base"):
+    """
+    Append a request_xr() data response to a site CSV file
 
+    Rows of every measure go through a single csv writer, without
+    intermediate dataframes. With request_xr(stream=True) only one measure
+    is held in memory at a time.
 
-def build_csv_data(data, outfile):
-    for i in range(len(data[:])):
-        cols = ['date', 'id', 'value', 'state', 'validated']
-        header_df = pd.DataFrame(columns=cols
-                                 )
-        df = pd.DataFrame(data[i]["base"])
-        df["id"] = data[i]["id"]
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore", category=FutureWarning)
-            out_df = pd.concat([header_df, df],
-                               join="inner",
-                               ignore_index=True,
-                               sort=False)
-            for col in cols:
-                if col not in out_df.columns:
-                    out_df.insert(2, col, None)
-
-        out_df.to_csv(outfile,
-                      mode='a',
-                      header=(not os.path.exists(outfile))
-                      )
+    input :
+    -------
+        data : list or iterator
+            request_xr() data response, one dict by measure
+        outfile : str
+            Site CSV file, created with its header if missing
+        datatype : str
+            Time step key of the measures (base, hour, day, month)
+    return :
+    --------
+        rows : dict
+            Written rows by measure id
+        last_date : dict
+            Last written date by measure id
+    """
+    rows = {}
+    last_date = {}
+    new_file = not os.path.exists(outfile)
+    with open(outfile, "a", newline="") as f:
+        writer = csv.writer(f, lineterminator=os.linesep)
+        if new_file:
+            writer.writerow([""] + DATA_COLUMNS)
+        for measure in data:
+            id = measure["id"]
+            base = measure[datatype]
+            writer.writerows(
+                (
+                    i,
+                    d.get("date"),
+                    id,
+                    None if d.get("value") is None else float(d["value"]),
+                    d.get("state"),
+                    d.get("validated"),
+                )
+                for i, d in enumerate(base)
+            )
+            rows[id] = len(base)
+            if len(base) > 0:
+                last_date[id] = max(d["date"] for d in base)
+    return rows, last_date
 
 
 def data_time_window():
@@ -0,0 +1,381 @@
+import bisect
+import os
+
+import numpy as np
+import pandas as pd
+
+from dictionaries import DATATYPE_FREQ, GAPS_FILE_NAME
+from fonctions import build_csv_data
+from manifest import entry_matches, update_entry_totals
+from storage import (
+    iter_site_data,
+    measures_to_frame,
+    month_file_path,
+    site_data_files,
+    site_data_months,
+    type_site_data,
+    write_month_frame,
+)
+
+GAP_COLUMNS = ["site", "id", "start", "end", "slots"]
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def slot_grid(year, month, datatype="base", now=None):
+    """
+    Expected time steps of a year from January to month, stopped at now
+    for the current period
+
+    return :
+    --------
+        start : Timestamp
+            First slot, January 1st of year (UTC)
+        step : Timedelta
+            Slot length of datatype
+        n_slots : int
+            Number of slots
+    """
+    start = pd.Timestamp(f"{year}-01-01", tz="UTC")
+    step = pd.Timedelta(DATATYPE_FREQ[datatype])
+    end = start + pd.DateOffset(months=month)
+    if now is None:
+        now = pd.Timestamp.now(tz="UTC")
+    end = min(end, now.floor(step))
+    return start, step, max((end - start) // step, 0)
+
+
+def mark_present(present, data, ids, start, step):
+    """
+    Set present[i, t] for every row of data of measure ids[i] at slot t
+    """
+    slots = ((data["date"] - start) // step).to_numpy()
+    rows = pd.Categorical(data["id"], categories=ids).codes
+    found = (rows >= 0) & (slots >= 0) & (slots < present.shape[1])
+    present[rows[found], slots[found].astype(np.int64)] = True
+
+
+def gap_ranges(present, ids, start, step):
+    """
+    Run length encoding of the missing slots of a presence matrix
+
+    return :
+    --------
+        gaps : dataframe
+            One row by missing range : id, start, end (excluded) and the
+            number of missing slots, by id then time
+    """
+    missing = np.zeros((present.shape[0], present.shape[1] + 2), np.int8)
+    missing[:, 1:-1] = ~present
+    edges = np.diff(missing, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return pd.DataFrame(
+        {
+            "id": np.asarray(ids, dtype=object)[rows],
+            "start": start + starts * step,
+            "end": start + ends * step,
+            "slots": ends - starts,
+        }
+    )
+
+
+def site_gaps(site_path, data_format, measures_id, year, month,
+              datatype="base", chunksize=None):
+    """
+    Missing time steps of each measure of a site, from January to month
+
+    Each measure is aligned on the expected grid of its time step (96
+    slots a day for base data), see slot_grid(), whatever rows the api
+    did return. Site data is read by parts, see iter_site_data().
+
+    return :
+    --------
+        gaps : dataframe
+            See gap_ranges()
+        n_slots : int
+            Expected slots by measure
+    """
+    start, step, n_slots = slot_grid(year, month, datatype)
+    present = np.zeros((len(measures_id), n_slots), bool)
+    if len(site_data_files(site_path, data_format)) > 0:
+        read_kwargs = {}
+        if data_format != "csv":
+            read_kwargs["months"] = list(range(1, month + 1))
+        for data in iter_site_data(site_path,
+                                   data_format,
+                                   columns=["date", "id"],
+                                   chunksize=chunksize,
+                                   **read_kwargs):
+            mark_present(present, data, measures_id, start, step)
+    return gap_ranges(present, measures_id, start, step), n_slots
+
+
+def completeness(gaps, measures_id, n_slots):
+    """
+    Expected and missing slots, gap count and completeness by measure
+    """
+    by_id = gaps.groupby("id")
+    report = pd.DataFrame(
+        {
+            "expected": n_slots,
+            "missing": by_id["slots"].sum(),
+            "gaps": by_id.size(),
+        },
+        index=pd.Index(measures_id, name="id"),
+    )
+    report[["missing", "gaps"]] = (
+        report[["missing", "gaps"]].fillna(0).astype("int64")
+    )
+    report["completeness"] = 1 - report["missing"] / max(n_slots, 1)
+    return report
+
+
+def read_gaps(out_path):
+    """
+    Read the gap index of a data/{year}/{group} folder, see write_gaps()
+    """
+    gaps_file = os.path.join(out_path, GAPS_FILE_NAME)
+    if os.path.exists(gaps_file) is False:
+        return pd.DataFrame(columns=GAP_COLUMNS)
+    gaps = pd.read_csv(gaps_file, dtype={"site": str, "id": str})
+    for column in ["start", "end"]:
+        gaps[column] = pd.to_datetime(gaps[column], utc=True)
+    return gaps
+
+
+def write_gaps(gaps, out_path):
+    """
+    Write the gap index (GAP_COLUMNS rows) of a data/{year}/{group}
+    folder, replacing the former one atomically
+    """
+    gaps_file = os.path.join(out_path, GAPS_FILE_NAME)
+    tmp_file = f"{gaps_file}.tmp"
+    gaps[GAP_COLUMNS].to_csv(tmp_file, index=False, date_format=DATE_FORMAT)
+    os.replace(tmp_file, gaps_file)
+
+
+def gap_windows(gaps, step, merge_slots=0):
+    """
+    Request windows of the gaps of a site
+
+    Gaps are cut at month ends, then the gaps of a month closer than
+    merge_slots slots, whatever their measure, share a window, so scattered
+    missing time steps take a few requests rather than one each.
+
+    return :
+    --------
+        windows : dict
+            By (month, fromtime, totime), totime being the last slot of the
+            window (api windows are inclusive) : the missing ranges of each
+            id over it, {id: [(first, last) slot dates]}
+    """
+    pieces = []
+    for id, start, end in gaps[["id", "start", "end"]].itertuples(
+            index=False):
+        while start < end:
+            month_end = min(start + pd.offsets.MonthBegin(), end)
+            pieces.append((start.month, start, month_end, id))
+            start = month_end
+
+    windows = []
+    for month, start, end, id in sorted(pieces, key=lambda p: p[:3]):
+        if (
+            len(windows) == 0
+            or month != windows[-1][0]
+            or start - windows[-1][2] > merge_slots * step
+        ):
+            windows.append([month, start, end, {}])
+        window = windows[-1]
+        window[2] = max(window[2], end)
+        window[3].setdefault(id, []).append(
+            (start.strftime(DATE_FORMAT), (end - step).strftime(DATE_FORMAT))
+        )
+    return {
+        (month, start.strftime(DATE_FORMAT),
+         (end - step).strftime(DATE_FORMAT)): ranges
+        for month, start, end, ranges in windows
+    }
+
+
+def clip_response(data, ranges, datatype="base"):
+    """
+    Rows of a request_xr() data response within the missing ranges of
+    their measure, see gap_windows()
+    """
+    clipped = []
+    for measure in data:
+        id_ranges = sorted(ranges.get(measure["id"], []))
+        firsts = [first for first, _ in id_ranges]
+        rows = []
+        for d in measure[datatype]:
+            i = bisect.bisect_right(firsts, d.get("date", "")) - 1
+            if i >= 0 and d["date"] <= id_ranges[i][1]:
+                rows.append(d)
+        clipped.append(dict(measure, **{datatype: rows}))
+    return clipped
+
+
+def join_measures(data, datatype="base"):
+    """
+    One dict by measure id from responses holding several parts of a
+    measure, rows by date
+    """
+    measures = {}
+    for measure in data:
+        measures.setdefault(measure["id"], []).extend(measure[datatype])
+    return [
+        {"id": id, datatype: sorted(rows, key=lambda d: d.get("date", ""))}
+        for id, rows in measures.items()
+    ]
+
+
+def fillable_months(entry, site_path, data_format, month):
+    """
+    Fetched months of a site, up to month, whose gaps can be filled
+    """
+    if data_format != "csv":
+        return [m for m in site_data_months(site_path, data_format)
+                if m <= month]
+    if entry_matches(entry, site_path):
+        return sorted(int(m) for m in entry["months"] if int(m) <= month)
+    if os.path.exists(site_path):
+        return list(range(1, month + 1))
+    return []
+
+
+def fill_site_months(fills, site_path, data_format, entry,
+                     datatype="base"):
+    """
+    Add fetched gap rows to the months of a site data
+
+    CSV months are rewritten after the first filled one, through a
+    temporary copy replacing the file once written : the rows of a month
+    are kept as they are and its gap rows appended after them, so the
+    byte ranges of the manifest still hold one month each (filling the
+    last fetched month only appends to the file). Without a matching
+    manifest entry the gap rows are appended at the end of the file.
+    Parquet and feather month files are rewritten with their gap
+    rows, measures in their order and rows by date.
+
+    input :
+    -------
+        fills : dict
+            request_xr() data response of the gap rows by month
+        site_path : str
+            From site_data_path()
+        data_format : str
+            csv, parquet or feather
+        entry : dict
+            Site entry of the manifest (None if missing)
+    return :
+    --------
+        entry : dict
+            The updated entry, unchanged when it did not match the data
+        rows : int
+            Added rows
+    """
+    fills = {
+        month: join_measures(data, datatype) for month, data in fills.items()
+    }
+    matches = entry_matches(entry, site_path)
+    added = 0
+    if data_format == "csv" and not matches:
+        for month in sorted(fills):
+            rows, _ = build_csv_data(fills[month], site_path, datatype)
+            added += sum(rows.values())
+        return entry, added
+
+    if data_format == "csv":
+        first = min(fills)
+        later = sorted(int(m) for m in entry["months"] if int(m) > first)
+        # Later months are streamed to a temporary copy with their gap
+        # rows, which replaces the file once complete
+        blocks = [(first, None, None)]
+        tmp_file = site_path
+        if later:
+            offsets = [entry["months"][str(m)]["offset"] for m in later]
+            blocks += zip(later,
+                          offsets,
+                          offsets[1:] + [os.path.getsize(site_path)])
+            tmp_file = os.path.join(os.path.dirname(site_path),
+                                    f".{os.path.basename(site_path)}.tmp")
+            with open(site_path, "rb") as f, open(tmp_file, "wb") as tmp:
+                copy_bytes(f, tmp, 0, offsets[0])
+        for month, offset, end in blocks:
+            month_entry = entry["months"][str(month)]
+            if offset is not None:
+                month_entry["offset"] = os.path.getsize(tmp_file)
+                with open(site_path, "rb") as f, open(tmp_file, "ab") as tmp:
+                    copy_bytes(f, tmp, offset, end)
+            if month not in fills:
+                continue
+            rows, last_date = build_csv_data(fills[month],
+                                             tmp_file,
+                                             datatype)
+            added += add_month_rows(month_entry, rows, last_date)
+        if later:
+            os.replace(tmp_file, site_path)
+    else:
+        for month in sorted(fills):
+            month_file = month_file_path(site_path, month, data_format)
+            if data_format == "parquet":
+                data = pd.read_parquet(month_file)
+            else:
+                data = pd.read_feather(month_file)
+            new_rows = measures_to_frame(fills[month], datatype)
+            data = pd.concat([data.astype({"id": str}),
+                              new_rows.astype({"id": str})],
+                             ignore_index=True)
+            order = pd.factorize(data["id"], sort=False)[0]
+            data = (
+                data.assign(order=order)
+                .sort_values(["order", "date"], kind="stable")
+                .drop(columns="order")
+                .reset_index(drop=True)
+            )
+            write_month_frame(type_site_data(data),
+                              site_path,
+                              month,
+                              data_format)
+            by_id = new_rows.groupby("id", observed=True)["date"]
+            rows = by_id.size().to_dict()
+            if matches and str(month) in entry["months"]:
+                add_month_rows(
+                    entry["months"][str(month)],
+                    rows,
+                    by_id.max().dt.strftime(DATE_FORMAT).to_dict()
+                )
+            added += sum(rows.values())
+
+    if matches:
+        entry = update_entry_totals(entry, site_path)
+    return entry, added
+
+
+def copy_bytes(src, dst, start, end, block=1 << 20):
+    """
+    Copy the [start, end) bytes of an open file to another one, by blocks
+    """
+    src.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        data = src.read(min(block, remaining))
+        if not data:
+            break
+        dst.write(data)
+        remaining -= len(data)
+
+
+def add_month_rows(month_entry, rows, last_date):
+    """
+    Add filled rows to a month of a manifest entry, return their number
+    """
+    for id, n in rows.items():
+        month_entry["rows"][id] = month_entry["rows"].get(id, 0) + n
+    for id, date in last_date.items():
+        month_entry["last_date"][id] = max(
+            month_entry["last_date"].get(id, ""),
+            date
+        )
+    return sum(rows.values())
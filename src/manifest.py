@@ -0,0 +1,287 @@
+import datetime as dt
+import hashlib
+import json
+import os
+import shutil
+
+from dictionaries import MANIFEST_FILE_NAME, MONTH_SETTLE_DELAY
+
+
+def read_manifest(out_path):
+    """
+    Read the fetch manifest of a data/{year}/{group} folder
+
+    input :
+    -------
+        out_path : str
+            data/{year}/{group} folder
+    return :
+    --------
+        manifest : dict
+            By site : {"checksum": str, "signature": list, "rows": int,
+                       "measure_ids": list,
+                       "measures": {id: {"last_date": str, "rows": int}},
+                       "months": {month: {"offset": int, "complete": bool,
+                                          "ended": bool, "fetched_at": str,
+                                          "rows": {id: int},
+                                          "last_date": {id: str}}}}
+            Empty dict when no manifest was written yet
+    """
+    manifest_file = os.path.join(out_path, MANIFEST_FILE_NAME)
+    if os.path.exists(manifest_file) is False:
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, out_path):
+    """
+    Write the fetch manifest, replacing the former one atomically
+    """
+    manifest_file = os.path.join(out_path, MANIFEST_FILE_NAME)
+    tmp_file = f"{manifest_file}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def data_files(path):
+    """
+    A site file, or the files of a site folder in name order
+    """
+    if os.path.exists(path) is False:
+        return []
+    if os.path.isdir(path):
+        return [os.path.join(path, f) for f in sorted(os.listdir(path))]
+    return [path]
+
+
+def file_checksum(path):
+    """
+    sha256 of a file, or of the files of a folder in name order,
+    "" if the path does not exist
+    """
+    if os.path.exists(path) is False:
+        return ""
+    sha = hashlib.sha256()
+    for file in data_files(path):
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def file_signature(path):
+    """
+    [name, size, mtime] of a file, or of the files of a folder
+    """
+    signature = []
+    for file in data_files(path):
+        stat = os.stat(file)
+        signature.append(
+            [os.path.basename(file), stat.st_size, stat.st_mtime_ns]
+        )
+    return signature
+
+
+def stamp_entry(entry, file_path):
+    """
+    Record the checksum and signature of the site data in its manifest
+    entry, see entry_matches()
+    """
+    entry["checksum"] = file_checksum(file_path)
+    entry["signature"] = file_signature(file_path)
+    return entry
+
+
+def sign_entry(entry, file_path):
+    """
+    Record the signature of the site data in its manifest entry, without
+    reading it : while a site is being written its checksum is cleared,
+    stamp_entry() computing it once the site is written
+    """
+    signature = file_signature(file_path)
+    if entry.get("signature") != signature:
+        entry["checksum"] = ""
+        entry["signature"] = signature
+    return entry
+
+
+def entry_matches(entry, file_path):
+    """
+    True when a manifest entry still describes the site data
+
+    The size and mtime of its files are checked first, the data is only
+    hashed and compared to the entry checksum when they changed (files
+    copied or touched), so an unchanged site is not read. An entry without
+    checksum (see sign_entry()) only matches by signature.
+    """
+    if not entry:
+        return False
+    if entry.get("signature") == file_signature(file_path):
+        return True
+    if not entry["checksum"]:
+        return False
+    return file_checksum(file_path) == entry["checksum"]
+
+
+def resume_month(entry, file_path, measures_id, end_month):
+    """
+    First month to fetch for a site, and where to resume it
+
+    The site file is kept up to the first month that was not completely
+    fetched (see fetch_status()). When that month had not ended yet when
+    it was fetched and has rows, it is kept too, only the time steps after the
+    last fetched date of each measure being requested again (see
+    newer_rows()). An ended month not settled yet is fetched again whole,
+    for the states validated since. The file is fully rebuilt when it
+    changed since the last fetch or when the site measures changed.
+
+    input :
+    -------
+        entry : dict
+            Site entry of the manifest (None if missing)
+        file_path : str
+            Site file
+        measures_id : list
+            Current measure ids of the site
+        end_month : int
+            Last month to fetch
+    return :
+    --------
+        month : int
+            From 1 (full fetch) to end_month + 1 (nothing to fetch)
+        since : dict
+            Last fetched date by measure id of a partly fetched month
+            ("" for measures without rows), None to fetch the whole month
+    """
+    if not entry_matches(entry, file_path):
+        return 1, None
+    if sorted(measures_id) != entry["measure_ids"]:
+        return 1, None
+    for month in range(1, end_month + 1):
+        month_entry = entry["months"].get(str(month))
+        if month_entry is None:
+            return month, None
+        if not month_entry["complete"]:
+            if (
+                not month_entry["last_date"]
+                or month_entry.get("ended", False)
+            ):
+                return month, None
+            return month, {
+                id: month_entry["last_date"].get(id, "")
+                for id in measures_id
+            }
+    return end_month + 1, None
+
+
+def truncate_site_file(entry, file_path, month):
+    """
+    Drop the rows of month and the following months from a site file
+    (or the month files of a site folder) and from its manifest entry,
+    see sign_entry()
+    """
+    if month <= 1 or not entry:
+        if os.path.isdir(file_path):
+            shutil.rmtree(file_path)
+        elif os.path.exists(file_path):
+            os.remove(file_path)
+        return {
+            "checksum": "",
+            "signature": [],
+            "rows": 0,
+            "measure_ids": [],
+            "measures": {},
+            "months": {},
+        }
+
+    if os.path.isdir(file_path):
+        for f in os.listdir(file_path):
+            if int(f.split(".")[0]) >= month:
+                os.remove(os.path.join(file_path, f))
+    else:
+        offset = entry["months"].get(str(month), {}).get("offset")
+        if offset is not None:
+            os.truncate(file_path, offset)
+    entry["months"] = {
+        m: month_entry for m, month_entry in entry["months"].items()
+        if int(m) < month
+    }
+    return sign_entry(entry, file_path)
+
+
+def record_month(entry, file_path, month, offset, rows, last_date,
+                 totime, measures_id):
+    """
+    Add a fetched month to a site manifest entry, its checksum being left
+    to stamp_entry() once every month of the site is written
+
+    input :
+    -------
+        entry : dict
+            Site entry of the manifest
+        file_path : str
+            Site file, already written
+        month : int
+            Fetched month
+        offset : int
+            Size of the site file before the month was written
+            (0 for parquet/feather site folders)
+        rows : dict
+            Written rows by measure id
+        last_date : dict
+            Last written date by measure id
+        totime : str
+            End of the requested window, YYYY-MM-DDThh:mm:ssZ
+        measures_id : list
+            Requested measure ids
+    return :
+    --------
+        entry : dict
+    """
+    entry["months"][str(month)] = dict(
+        fetch_status(totime),
+        offset=offset,
+        rows=rows,
+        last_date=last_date,
+    )
+
+    entry["measure_ids"] = sorted(measures_id)
+    return update_entry_totals(entry, file_path)
+
+
+def fetch_status(totime):
+    """
+    complete, ended and fetched_at of a month entry fetched now up to
+    totime, complete once MONTH_SETTLE_DELAY seconds passed after totime
+    """
+    now = dt.datetime.now(dt.timezone.utc)
+    end = dt.datetime.strptime(
+        totime,
+        "%Y-%m-%dT%H:%M:%SZ"
+    ).replace(tzinfo=dt.timezone.utc)
+    return {
+        "complete": (now - end).total_seconds() > MONTH_SETTLE_DELAY,
+        "ended": now > end,
+        "fetched_at": now.strftime("%Y-%m-%dT%H:%M:%SZ"),
+    }
+
+
+def update_entry_totals(entry, file_path):
+    """
+    Refresh the rows, last dates and signature of a site manifest entry
+    from its months, see sign_entry()
+    """
+    measures = {}
+    for month_entry in entry["months"].values():
+        for id, n in month_entry["rows"].items():
+            measure = measures.setdefault(id, {"last_date": "", "rows": 0})
+            measure["rows"] += n
+            measure["last_date"] = max(
+                measure["last_date"],
+                month_entry["last_date"].get(id, "")
+            )
+    entry["measures"] = measures
+    entry["rows"] = sum(m["rows"] for m in measures.values())
+    return sign_entry(entry, file_path)
@@ -0,0 +1,155 @@
+import os
+import time
+
+import pandas as pd
+
+from dictionaries import METADATA_CACHE_FILE_NAME
+from fonctions import request_xr
+
+
+def fetch_metadata(station_list_path, groups, base_url="", session=None):
+    """
+    Fetch sites and measures of groups and the physicals from XR rest api
+    to station_list_path (stations_{group}.csv, measures_{group}.csv,
+    physicals.csv)
+    """
+    os.makedirs(station_list_path, exist_ok=True)
+    for group in groups:
+        sites_json = request_xr(folder="sites",
+                                groups=group,
+                                session=session,
+                                base_url=base_url)
+        pd.DataFrame(sites_json).to_csv(
+            f"{station_list_path}/stations_{group}.csv"
+        )
+
+        measures_json = request_xr(folder="measures",
+                                   groups=group,
+                                   session=session,
+                                   base_url=base_url)
+        pd.DataFrame(measures_json).to_csv(
+            f"{station_list_path}/measures_{group}.csv"
+        )
+
+    physicals_json = request_xr(folder="physicals",
+                                session=session,
+                                base_url=base_url)
+    pd.DataFrame(physicals_json).to_csv(f"{station_list_path}/physicals.csv")
+
+
+def metadata_sources(station_list_path, groups):
+    """
+    Files written by get_physicals_and_site_info.py for groups
+    """
+    sources = []
+    for group in groups:
+        sources.append(f"{station_list_path}/stations_{group}.csv")
+        sources.append(f"{station_list_path}/measures_{group}.csv")
+    physicals = f"{station_list_path}/physicals.csv"
+    if os.path.exists(physicals):
+        sources.append(physicals)
+    return sources
+
+
+def source_signature(sources):
+    signature = {}
+    for source in sources:
+        stat = os.stat(source)
+        signature[source] = (stat.st_size, stat.st_mtime_ns)
+    return signature
+
+
+def build_metadata(station_list_path, groups):
+    """
+    Load stations, measures and physicals of groups into lookup dicts
+
+    return :
+    --------
+        metadata : dict
+            "sites" : {group: [site ids]}
+            "site_measures" : {group: {site: [measure ids]}}
+            "measures" : {measure id: {"site": str, "phy_name": str}}
+            "physicals" : {physical id: {column: value}}
+    """
+    metadata = {
+        "sites": {},
+        "site_measures": {},
+        "measures": {},
+        "physicals": {},
+    }
+    for group in groups:
+        metadata["sites"][group] = pd.read_csv(
+            f"{station_list_path}/stations_{group}.csv",
+            usecols=["id"]
+        )["id"].tolist()
+
+        measures = pd.read_csv(
+            f"{station_list_path}/measures_{group}.csv",
+            usecols=["id", "id_site", "phy_name"]
+        )
+        metadata["site_measures"][group] = {
+            site: site_measures["id"].tolist()
+            for site, site_measures in measures.groupby("id_site", sort=False)
+        }
+        # usecols keeps the file column order, which follows the api
+        for id, site, phy_name in measures[
+            ["id", "id_site", "phy_name"]
+        ].itertuples(index=False):
+            metadata["measures"].setdefault(
+                id,
+                {"site": site, "phy_name": phy_name}
+            )
+
+    physicals = f"{station_list_path}/physicals.csv"
+    if os.path.exists(physicals):
+        physicals_df = pd.read_csv(physicals, index_col=0)
+        if "id" in physicals_df.columns:
+            metadata["physicals"] = (
+                physicals_df.drop_duplicates("id")
+                .set_index("id")
+                .to_dict(orient="index")
+            )
+    return metadata
+
+
+def load_metadata(station_list_path, groups, max_age=None):
+    """
+    Station metadata of groups, cached in station_list_path
+
+    The cache is rebuilt when one of the station, measure or physical
+    files changed, when a group is missing from it, or when it is older
+    than max_age.
+
+    input :
+    -------
+        station_list_path : str
+            Folder of the files from get_physicals_and_site_info.py
+        groups : list
+            Station groups
+        max_age : float
+            Max age of the cache in seconds, Default = None (no limit)
+    return :
+    --------
+        metadata : dict
+            See build_metadata()
+    """
+    cache_file = f"{station_list_path}/{METADATA_CACHE_FILE_NAME}"
+    signature = source_signature(metadata_sources(station_list_path, groups))
+
+    if os.path.exists(cache_file):
+        cache = pd.read_pickle(cache_file)
+        fresh = (
+            max_age is None
+            or time.time() - os.path.getmtime(cache_file) < max_age
+        )
+        if fresh and all(
+            cache["signature"].get(source) == value
+            for source, value in signature.items()
+        ):
+            return cache["metadata"]
+
+    metadata = build_metadata(station_list_path, groups)
+    tmp_file = f"{cache_file}.tmp"
+    pd.to_pickle({"signature": signature, "metadata": metadata}, tmp_file)
+    os.replace(tmp_file, cache_file)
+    return metadata
@@ -0,0 +1,197 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlparse
+
+METRICS = {
+    "enabled": False,
+    "started": None,
+    "records": [],
+}
+
+METRIC_FIELDS = ["seconds", "rows", "bytes", "http_calls"]
+
+
+def enable_metrics(enabled=True, session=None):
+    """
+    Start recording metrics, and HTTP calls of session if given
+    """
+    METRICS["enabled"] = enabled
+    METRICS["started"] = time.time()
+    METRICS["records"] = []
+    if enabled and session is not None:
+        session.hooks["response"].append(record_http_call)
+
+
+def metrics_enabled():
+    return METRICS["enabled"]
+
+
+@contextmanager
+def timed(stage, **labels):
+    """
+    Record wall time of a block when metrics are enabled
+
+    The yielded dict takes the rows, bytes and http_calls of the block,
+    it is discarded when metrics are disabled.
+
+        with timed("build_csv_data", group=group, site=site) as record:
+            ...
+            record["rows"] = rows
+    """
+    if not METRICS["enabled"]:
+        yield {}
+        return
+    record = {"stage": stage, **labels, "rows": 0, "bytes": 0,
+              "http_calls": 0}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        METRICS["records"].append(record)
+
+
+def record_http_call(response, *args, **kwargs):
+    """
+    requests response hook recording the time to response headers, the
+    announced size and the requested measures of every HTTP call, see
+    enable_metrics(session=...) and label_http_calls()
+    """
+    query = parse_qs(urlparse(response.request.url).query)
+    METRICS["records"].append(
+        {
+            "stage": "request_xr",
+            "seconds": response.elapsed.total_seconds(),
+            "rows": 0,
+            "bytes": int(response.headers.get("Content-Length", 0)),
+            "http_calls": 1,
+            "status": response.status_code,
+            "measures": [
+                id for id in query.get("measures", [""])[0].split(",") if id
+            ],
+        }
+    )
+
+
+def label_http_calls(measure_sites):
+    """
+    Label the HTTP call records with the sites they fetched measures of
+
+    A request packing the measures of several sites (see plan_requests())
+    is counted once by stage and once for each of its sites.
+
+    input :
+    -------
+        measure_sites : dict
+            [(group, site)] by measure id
+    """
+    for record in METRICS["records"]:
+        if "measures" not in record:
+            continue
+        record["sites"] = sorted(
+            {
+                site
+                for id in record.pop("measures")
+                for site in measure_sites.get(id, [])
+            }
+        )
+
+
+@contextmanager
+def collect_records():
+    """
+    Records of a block only, kept apart from those of the process (to
+    label them, or send them back from a worker process)
+
+        with collect_records() as records:
+            ...
+        add_records(records)
+    """
+    records = METRICS["records"]
+    METRICS["records"] = []
+    try:
+        yield METRICS["records"]
+    finally:
+        METRICS["records"] = records
+
+
+def add_records(records):
+    METRICS["records"].extend(records)
+
+
+def summarize(records):
+    """
+    Sum records by stage and by (group, site, stage)
+    """
+    stages = {}
+    sites = {}
+    for record in records:
+        keys = [(stages, record["stage"])]
+        if "site" in record:
+            keys.append(
+                (sites, (record.get("group"), record["site"],
+                         record["stage"]))
+            )
+        for group, site in record.get("sites", []):
+            keys.append((sites, (group, site, record["stage"])))
+        for table, key in keys:
+            total = table.setdefault(
+                key,
+                dict({field: 0 for field in METRIC_FIELDS}, count=0)
+            )
+            total["count"] += 1
+            for field in METRIC_FIELDS:
+                total[field] += record.get(field, 0)
+
+    for total in list(stages.values()) + list(sites.values()):
+        seconds = total["seconds"]
+        total["rows_per_second"] = total["rows"] / seconds if seconds else 0
+    return {
+        "stages": stages,
+        "sites": [
+            dict(total, group=group, site=site, stage=stage)
+            for (group, site, stage), total in sites.items()
+        ],
+    }
+
+
+def write_run_report(path, script, prometheus_path=None):
+    """
+    Write the recorded metrics as a json run report, and optionally as a
+    Prometheus textfile (node_exporter textfile collector)
+    """
+    finished = time.time()
+    summary = summarize(METRICS["records"])
+    report = {
+        "script": script,
+        "started": METRICS["started"],
+        "finished": finished,
+        "wall_seconds": finished - METRICS["started"],
+        **summary,
+    }
+    tmp_file = f"{path}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(report, f, indent=1, default=str)
+    os.replace(tmp_file, path)
+
+    if prometheus_path:
+        lines = [
+            "# TYPE tauxfo_run_wall_seconds gauge",
+            f'tauxfo_run_wall_seconds{{script="{script}"}} '
+            f'{report["wall_seconds"]}',
+        ]
+        for field in METRIC_FIELDS + ["count"]:
+            name = f"tauxfo_stage_{field}_total"
+            lines.append(f"# TYPE {name} counter")
+            for stage, total in summary["stages"].items():
+                lines.append(
+                    f'{name}{{script="{script}",stage="{stage}"}} '
+                    f'{total[field]}'
+                )
+        tmp_file = f"{prometheus_path}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_file, prometheus_path)
+    return report
@@ -0,0 +1,174 @@
+import gzip
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from dictionaries import DATA_KEYS
+from synthetic import synthetic_network, synthetic_response
+
+MOCK_API_PATH = "/dms-api/public/v1"
+
+
+class MockXRHandler(BaseHTTPRequestHandler):
+    """
+    Local stand-in for the XR rest api /data, /sites, /measures and
+    /physicals endpoints, serving synthetic data (see make_mock_server())
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        folder = url.path.rstrip("/").rsplit("/", 1)[-1]
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        with server.lock:
+            server.stats["requests"] += 1
+            server.active += 1
+            throttled = (
+                server.max_concurrent > 0
+                and server.active > server.max_concurrent
+            )
+        try:
+            if folder not in DATA_KEYS:
+                return self.send_json(404, {"error": "unknown endpoint"})
+            if throttled:
+                return self.send_json(429, {"error": "too many requests"},
+                                      {"Retry-After": "1"})
+            if random.random() < server.error_rate:
+                return self.send_json(503, {"error": "injected failure"})
+            time.sleep(server.latency + random.uniform(0, server.jitter))
+            self.send_json(200, {DATA_KEYS[folder]: self.payload(folder,
+                                                                 query)})
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def payload(self, folder, query):
+        network = self.server.network
+        groups = [g for g in query.get("groups", "").split(",") if g]
+        if not groups:
+            groups = list(network)
+
+        if folder == "sites":
+            return [site for g in groups for site in network[g][0]]
+        if folder == "measures":
+            return [measure for g in groups for measure in network[g][1]]
+        if folder == "physicals":
+            phy_names = sorted({
+                measure["phy_name"]
+                for g in network
+                for measure in network[g][1]
+            })
+            return [{"id": name, "name": name} for name in phy_names]
+
+        measures_id = [m for m in query.get("measures", "").split(",") if m]
+        datatype = query.get("dataTypes", "base") or "base"
+        data = []
+        for id in measures_id:
+            seed = zlib.crc32(f"{id}|{query.get('from')}".encode())
+            data.extend(
+                synthetic_response(
+                    [id],
+                    query["from"],
+                    query["to"],
+                    gap_rate=self.server.gap_rate,
+                    rng=np.random.default_rng(seed),
+                    datatype=datatype,
+                )
+            )
+        return data
+
+    def send_json(self, status, body, headers=None):
+        content = json.dumps(body).encode()
+        gzipped = "gzip" in self.headers.get("Accept-Encoding", "")
+        if gzipped:
+            content = gzip.compress(content, compresslevel=5)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+        with self.server.lock:
+            self.server.stats["bytes"] += len(content)
+            self.server.stats[f"status_{status}"] = (
+                self.server.stats.get(f"status_{status}", 0) + 1
+            )
+
+
+def make_mock_server(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    groups: list = None,
+    n_sites: int = 3,
+    n_measures: int = 4,
+    latency: float = 0.0,
+    jitter: float = 0.0,
+    error_rate: float = 0.0,
+    max_concurrent: int = 0,
+    gap_rate: float = 0.0,
+):
+    """
+    Build a local mock XR rest api server
+
+    input :
+    -------
+        host, port : str, int
+            Listening address, port 0 picks a free port
+        groups : list
+            Synthetic station groups, Default = ["MOCK"]
+        n_sites, n_measures : int
+            Sites by group and measures by site
+        latency, jitter : float
+            Delay of every response, latency + uniform(0, jitter) seconds
+        error_rate : float
+            Share of requests answered with a 503
+        max_concurrent : int
+            Requests over this number of simultaneous requests are
+            answered with a 429, 0 for no limit
+        gap_rate : float
+            Share of missing time steps in data responses
+    return :
+    --------
+        server : ThreadingHTTPServer
+            server.url is the api root to use as request_xr() base_url,
+            server.stats counts requests, bytes and status codes
+    """
+    server = ThreadingHTTPServer((host, port), MockXRHandler)
+    server.daemon_threads = True
+    server.network = {
+        group: synthetic_network(group, n_sites, n_measures)
+        for group in (groups or ["MOCK"])
+    }
+    server.latency = latency
+    server.jitter = jitter
+    server.error_rate = error_rate
+    server.max_concurrent = max_concurrent
+    server.gap_rate = gap_rate
+    server.lock = threading.Lock()
+    server.active = 0
+    server.stats = {"requests": 0, "bytes": 0}
+    server.url = f"http://{host}:{server.server_port}{MOCK_API_PATH}"
+    return server
+
+
+def start_mock_server(**kwargs):
+    """
+    make_mock_server() running in a background thread
+    """
+    server = make_mock_server(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,131 @@
+from fonctions import map_request_xr, merge_xr_responses, split_xr_request
+
+
+def plan_requests(units, **request_kwargs):
+    """
+    Pack the measures of site months into shared data requests
+
+    Units asking for the same time window are packed together, windows
+    in time order so the months of a site come in order. Each measure id
+    is requested once whatever the number of groups and sites asking for
+    it. The measures of a window are then split into requests within
+    max_url_length and max_points (see split_xr_request()), following the
+    order of the units so a site spans few requests.
+
+    input :
+    -------
+        units : list
+            (key, fromtime, totime, measures_id) by site month, key being
+            any identifier of the site month
+        request_kwargs :
+            Other request_xr() keyword arguments (datatypes, base_url,
+            max_url_length, max_points, ...)
+    return :
+    --------
+        plan : list
+            By time window : {"fromtime", "totime", "units": [units],
+            "requests": [(measures_id, [request_xr() kwargs by window])]}
+    """
+    windows = {}
+    for unit in units:
+        _, fromtime, totime, _ = unit
+        windows.setdefault((fromtime, totime), []).append(unit)
+
+    plan = []
+    for (fromtime, totime), window_units in sorted(windows.items()):
+        measures = list(
+            dict.fromkeys(
+                id for _, _, _, measures_id in window_units
+                for id in measures_id
+            )
+        )
+        parts = split_xr_request(
+            dict(request_kwargs,
+                 folder="data",
+                 fromtime=fromtime,
+                 totime=totime,
+                 measures=",".join(measures))
+        ) if measures else []
+        plan.append(
+            {
+                "fromtime": fromtime,
+                "totime": totime,
+                "units": window_units,
+                "requests": [
+                    (windows_kwargs[0]["measures"].split(","),
+                     windows_kwargs)
+                    for windows_kwargs in parts
+                ],
+            }
+        )
+    return plan
+
+
+def plan_stats(plan):
+    """
+    Requested measures of a plan, with and without packing
+    """
+    return {
+        "site_months": sum(len(window["units"]) for window in plan),
+        "measures": sum(
+            len(measures_id)
+            for window in plan
+            for _, _, _, measures_id in window["units"]
+        ),
+        "unique_measures": sum(
+            len(measures) for window in plan
+            for measures, _ in window["requests"]
+        ),
+        "requests": sum(
+            len(windows_kwargs) for window in plan
+            for _, windows_kwargs in window["requests"]
+        ),
+    }
+
+
+def fetch_units(plan, session, workers=1, datatype="base"):
+    """
+    Run the requests of a plan and split their responses back by unit
+
+    A unit is yielded as soon as every request holding one of its
+    measures is done, units of a window in their order, windows one after
+    the other. Only the measures still needed by a unit are kept.
+
+    return :
+    --------
+        results : iterator
+            (unit, data) with data the request_xr() data response of the
+            unit measures, in their order
+    """
+    requests_kwargs = [
+        kwargs
+        for window in plan
+        for _, windows_kwargs in window["requests"]
+        for kwargs in windows_kwargs
+    ]
+    responses = map_request_xr(requests_kwargs, session, workers=workers)
+
+    for window in plan:
+        fetched = set()
+        received = {}
+        units = list(window["units"])
+        for measures, windows_kwargs in window["requests"]:
+            merged = merge_xr_responses(
+                [[next(responses) for _ in windows_kwargs]],
+                datatype,
+            )
+            for measure in merged:
+                received[measure["id"]] = measure
+            fetched.update(measures)
+            while units and fetched.issuperset(units[0][3]):
+                unit = units.pop(0)
+                yield unit, [
+                    received[id] for id in unit[3] if id in received
+                ]
+            needed = {id for unit in units for id in unit[3]}
+            received = {
+                id: measure for id, measure in received.items()
+                if id in needed
+            }
+        for unit in units:
+            yield unit, [received[id] for id in unit[3] if id in received]
@@ -0,0 +1,108 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from dictionaries import RATE_VARS
+
+
+class RateHandler(BaseHTTPRequestHandler):
+    """
+    Read only json api over the rates kept in memory by watch.py
+
+        GET /rates                  groups, year and update times
+        GET /rates/{group}          every rate table of a group
+        GET /rates/{group}/{var}    one rate table (RATE_VARS or pert_repport)
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        parts = [p for p in urlparse(self.path).path.split("/") if p]
+        if len(parts) == 0 or parts[0] != "rates" or len(parts) > 3:
+            return self.send_json(404, {"error": "unknown endpoint"})
+
+        with self.server.lock:
+            rates = self.server.rates
+        if len(parts) == 1:
+            return self.send_json(
+                200,
+                {
+                    group: {
+                        key: value for key, value in group_rates.items()
+                        if key != "tables"
+                    }
+                    for group, group_rates in rates.items()
+                },
+            )
+        group_rates = rates.get(parts[1])
+        if group_rates is None:
+            return self.send_json(404, {"error": "unknown group"})
+        if len(parts) == 2:
+            return self.send_json(200, group_rates)
+        table = group_rates["tables"].get(parts[2])
+        if table is None:
+            return self.send_json(404, {"error": "unknown rate"})
+        self.send_json(200, table)
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def table_records(table):
+    """
+    json ready records of a rate table (NaN as null)
+    """
+    return json.loads(table.to_json(orient="records"))
+
+
+def make_rate_server(host="127.0.0.1", port=8080):
+    """
+    Build the rate api server, see RateHandler and set_group_rates()
+    """
+    server = ThreadingHTTPServer((host, port), RateHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.rates = {}
+    server.url = f"http://{host}:{server.server_port}/rates"
+    return server
+
+
+def start_rate_server(**kwargs):
+    """
+    make_rate_server() running in a background thread
+    """
+    server = make_rate_server(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def set_group_rates(server, group, year, month, rate_tables, pert_repport):
+    """
+    Publish the rate tables of a group, replacing the former ones
+
+    input :
+    -------
+        rate_tables : dict
+            Group rate table by RATE_VARS key
+        pert_repport : dataframe
+            Group pert repport
+    """
+    tables = {var: table_records(rate_tables[var]) for var in RATE_VARS}
+    tables["pert_repport"] = table_records(pert_repport)
+    group_rates = {
+        "year": year,
+        "month": month,
+        "updated": time.time(),
+        "tables": tables,
+    }
+    with server.lock:
+        server.rates = dict(server.rates, **{group: group_rates})
@@ -0,0 +1,301 @@
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+from dictionaries import DATA_COLUMNS, PARQUET_ROW_GROUP_SIZE
+from fonctions import STATE_DTYPE
+
+
+# Column dtypes of site data, whatever its storage format
+SITE_DATA_DTYPES = {
+    "id": "category",
+    "value": "float32",
+    "state": STATE_DTYPE,
+    "validated": "boolean",
+}
+
+
+def group_folder(group, datatype="base"):
+    """
+    data/{year}/ (and rates/{year}/, checkpoints/{year}/) sub folder of a
+    group : {group} for base data, {group}/{datatype} for aggregates
+    """
+    if datatype == "base":
+        return group
+    return f"{group}/{datatype}"
+
+
+def site_data_path(path, site, data_format="csv"):
+    """
+    Site data location in a data/{year}/{group} folder
+
+    csv : one {site}.csv file appended month after month
+    parquet, feather : a {site} folder with one {month}.{format} file
+    by fetched month
+    """
+    if data_format == "csv":
+        return f"{path}/{site}.csv"
+    return f"{path}/{site}"
+
+
+def month_file_path(site_path, month, data_format):
+    return f"{site_path}/{str(month).zfill(2)}.{data_format}"
+
+
+def site_data_months(site_path, data_format):
+    """
+    Fetched months of a parquet/feather site folder
+    """
+    if os.path.isdir(site_path) is False:
+        return []
+    suffix = f".{data_format}"
+    return sorted(
+        int(f[:-len(suffix)]) for f in os.listdir(site_path)
+        if f.endswith(suffix)
+    )
+
+
+def site_data_files(site_path, data_format):
+    """
+    Files holding the data of a site, empty when it was not fetched yet
+    """
+    if data_format == "csv":
+        return [site_path] if os.path.exists(site_path) else []
+    return [
+        month_file_path(site_path, month, data_format)
+        for month in site_data_months(site_path, data_format)
+    ]
+
+
+def files_signature(files):
+    """
+    [size, mtime] of files, to tell when one of them changed
+    """
+    signature = {}
+    for file in files:
+        stat = os.stat(file)
+        signature[file] = [stat.st_size, stat.st_mtime_ns]
+    return signature
+
+
+def measures_to_frame(data, datatype="base"):
+    """
+    Typed dataframe from a request_xr() data response
+
+    input :
+    -------
+        data : list
+            request_xr() response, one dict by measure
+        datatype : str
+            Time step key of the measures (base, hour, day, month)
+    return :
+    --------
+        df : dataframe
+            DATA_COLUMNS with date as UTC datetime64 and the
+            SITE_DATA_DTYPES dtypes
+    """
+    rows = [
+        (
+            d.get("date"),
+            measure["id"],
+            d.get("value"),
+            d.get("state"),
+            d.get("validated"),
+        )
+        for measure in data
+        for d in measure[datatype]
+    ]
+    df = pd.DataFrame.from_records(rows, columns=DATA_COLUMNS)
+    return df.astype({"date": "datetime64[ns, UTC]", **SITE_DATA_DTYPES})
+
+
+def write_month_data(data, site_path, month, data_format, datatype="base"):
+    """
+    Write one fetched month of a site as a parquet or feather file
+
+    return :
+    --------
+        rows : dict
+            Written rows by measure id
+        last_date : dict
+            Last written date by measure id
+    """
+    return write_month_frame(measures_to_frame(data, datatype),
+                             site_path,
+                             month,
+                             data_format)
+
+
+def write_month_frame(df, site_path, month, data_format):
+    """
+    Write a month of site data, from measures_to_frame(), as a parquet or
+    feather file, see write_month_data()
+    """
+    os.makedirs(site_path, exist_ok=True)
+    out_file = month_file_path(site_path, month, data_format)
+    if data_format == "parquet":
+        df.to_parquet(
+            out_file,
+            index=False,
+            row_group_size=PARQUET_ROW_GROUP_SIZE,
+        )
+    else:
+        df.to_feather(out_file)
+
+    by_id = df.groupby("id", observed=True)["date"]
+    rows = by_id.size().to_dict()
+    last_date = by_id.max().dt.strftime("%Y-%m-%dT%H:%M:%SZ").to_dict()
+    return rows, last_date
+
+
+def csv_source(site_path, byte_range=None):
+    """
+    site CSV file, or the header and the byte_range rows of it
+    """
+    if byte_range is None:
+        return site_path
+    start, end = byte_range
+    with open(site_path, "rb") as f:
+        header = f.readline()
+        f.seek(max(start, f.tell()))
+        size = -1 if end is None else end - f.tell()
+        return io.BytesIO(header + f.read(size))
+
+
+def site_data_dtypes(columns):
+    return {c: SITE_DATA_DTYPES[c] for c in columns if c in SITE_DATA_DTYPES}
+
+
+def parse_site_dates(dates):
+    """
+    UTC timestamps of the YYYY-MM-DDThh:mm:ssZ dates of site data
+
+    A date is shared by every measure of a site, so each distinct date is
+    parsed once, by numpy fixed-format parsing (pandas ISO8601 parsing for
+    other formats), then mapped back to the rows.
+    """
+    dates = dates.astype("category")
+    categories = dates.cat.categories.astype(str)
+    try:
+        parsed = pd.DatetimeIndex(
+            np.array(categories.str.removesuffix("Z"), dtype="datetime64[s]")
+        ).tz_localize("UTC")
+    except ValueError:
+        parsed = pd.DatetimeIndex(
+            pd.to_datetime(categories, format="ISO8601", utc=True)
+        )
+    return pd.Series(
+        parsed.take(dates.cat.codes, allow_fill=True, fill_value=pd.NaT),
+        index=dates.index,
+        name=dates.name,
+    )
+
+
+def type_site_data(data):
+    return data.astype(site_data_dtypes(data.columns))
+
+
+def iter_site_data(
+    site_path: str,
+    data_format: str = "csv",
+    columns: list = None,
+    ids: list = None,
+    months: list = None,
+    byte_range: tuple = None,
+    chunksize: int = None,
+):
+    """
+    Read the data of a site part by part, see read_site_data()
+
+    CSV files are read by chunks of chunksize rows (one chunk when
+    chunksize is None), parquet and feather folders by month file, so
+    memory is bounded by the largest part rather than by the site.
+    Every part has the SITE_DATA_DTYPES dtypes.
+    """
+    if columns is None:
+        columns = DATA_COLUMNS
+    if data_format == "csv":
+        reader = pd.read_csv(
+            csv_source(site_path, byte_range),
+            usecols=columns,
+            dtype=dict(site_data_dtypes(columns), date="category"),
+            chunksize=chunksize,
+        )
+        chunks = [reader] if chunksize is None else reader
+        for data in chunks:
+            if "date" in columns:
+                data["date"] = parse_site_dates(data["date"])
+            if ids is not None:
+                data = data[data["id"].isin(ids)]
+            yield data
+        return
+
+    if months is None:
+        months = site_data_months(site_path, data_format)
+    for month in months:
+        month_file = month_file_path(site_path, month, data_format)
+        if os.path.exists(month_file) is False:
+            continue
+        if data_format == "parquet":
+            data = pd.read_parquet(
+                month_file,
+                columns=columns,
+                filters=None if ids is None else [("id", "in", ids)],
+            )
+        else:
+            data = pd.read_feather(month_file, columns=columns)
+            if ids is not None:
+                data = data[data["id"].isin(ids)]
+        yield type_site_data(data)
+
+
+def read_site_data(
+    site_path: str,
+    data_format: str = "csv",
+    columns: list = None,
+    ids: list = None,
+    months: list = None,
+    byte_range: tuple = None,
+):
+    """
+    Read the data of a site
+
+    input :
+    -------
+        site_path : str
+            From site_data_path()
+        data_format : str
+            csv, parquet or feather
+        columns : list
+            Columns to read, Default = None (DATA_COLUMNS)
+        ids : list
+            Measure ids to keep, Default = None (all)
+        months : list
+            Fetched months to read (parquet and feather only),
+            Default = None (all)
+        byte_range : tuple
+            (start, end) bytes of the CSV rows to read, end None for the
+            end of file (csv only, see the fetch manifest offsets),
+            Default = None (all)
+    return :
+    --------
+        data : dataframe
+            With the SITE_DATA_DTYPES dtypes
+    """
+    frames = list(
+        iter_site_data(
+            site_path,
+            data_format,
+            columns=columns,
+            ids=ids,
+            months=months,
+            byte_range=byte_range,
+        )
+    )
+    if len(frames) == 0:
+        return pd.DataFrame(columns=columns or DATA_COLUMNS)
+    if len(frames) == 1:
+        return frames[0]
+    return type_site_data(pd.concat(frames, ignore_index=True))
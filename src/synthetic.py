@@ -0,0 +1,162 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from dictionaries import DATATYPE_FREQ, DEFAULT_STATE_MIX
+from fonctions import build_csv_data, get_month_datetimes
+
+
+def synthetic_response(
+    measures_id: list,
+    fromtime: str,
+    totime: str,
+    state_mix: dict = None,
+    gap_rate: float = 0.0,
+    gap_length: int = 16,
+    rng: np.random.Generator = None,
+    datatype: str = "base",
+):
+    """
+    Synthetic request_xr() data response
+
+    input :
+    -------
+        measures_id : list
+            Measure ids
+        fromtime : str
+            Start time in YYYY-MM-DDThh:mm:ssZ format
+        totime : str
+            End time in YYYY-MM-DDThh:mm:ssZ format (included)
+        state_mix : dict
+            Probability of each state code, Default = DEFAULT_STATE_MIX
+        gap_rate : float
+            Share of missing quarter-hours, dropped in runs of gap_length
+        gap_length : int
+            Length of missing runs, in time steps
+        rng : np.random.Generator
+            Random generator, Default = np.random.default_rng(0)
+        datatype : str
+            Time step (base, hour, day, month), Default = "base"
+    return :
+    --------
+        data : list
+            One dict by measure : {"id": str, datatype: [{"date", "value",
+            "state", "validated"}, ...]}
+    """
+    if state_mix is None:
+        state_mix = DEFAULT_STATE_MIX
+    if rng is None:
+        rng = np.random.default_rng(0)
+    states = list(state_mix.keys())
+    weights = np.array(list(state_mix.values()), dtype=float)
+    weights = weights / weights.sum()
+
+    dates = pd.date_range(fromtime, totime, freq=DATATYPE_FREQ[datatype])
+    date_strings = dates.strftime("%Y-%m-%dT%H:%M:%SZ").tolist()
+    n = len(dates)
+
+    data = []
+    for id in measures_id:
+        keep = np.ones(n, dtype=bool)
+        n_gaps = int(n * gap_rate / gap_length)
+        for start in rng.integers(0, max(n - gap_length, 1), n_gaps):
+            keep[start:start + gap_length] = False
+
+        values = np.round(rng.gamma(4.0, 8.0, n), 1)
+        measure_states = rng.choice(states, n, p=weights)
+        validated = rng.random(n) < 0.9
+        base = [
+            {
+                "date": date_strings[i],
+                "value": None if measure_states[i] in "NI" else values[i],
+                "state": measure_states[i],
+                "validated": bool(validated[i]),
+            }
+            for i in np.flatnonzero(keep)
+        ]
+        data.append({"id": id, datatype: base})
+    return data
+
+
+def synthetic_network(group, n_sites, n_measures):
+    """
+    Synthetic sites and measures of a group, as the sites and measures
+    responses of the XR rest api
+
+    return :
+    --------
+        sites : list
+            {"id": str, "name": str} by site
+        measures : list
+            {"id": str, "id_site": str, "phy_name": str} by measure
+    """
+    sites = [
+        {"id": f"{group}_S{i:03d}", "name": f"{group} site {i}"}
+        for i in range(n_sites)
+    ]
+    measures = [
+        {
+            "id": f"{site['id']}_M{j:02d}",
+            "id_site": site["id"],
+            "phy_name": f"PHY{j:02d}",
+        }
+        for site in sites
+        for j in range(n_measures)
+    ]
+    return sites, measures
+
+
+def write_synthetic_group(
+    outdir: str,
+    year: int,
+    group: str,
+    n_sites: int,
+    n_measures: int,
+    state_mix: dict = None,
+    gap_rate: float = 0.0,
+    seed: int = 0,
+):
+    """
+    Write a synthetic group in the layout of get_physicals_and_site_info.py
+    and get_data.py :
+        {outdir}/data/stations_{group}.csv
+        {outdir}/data/measures_{group}.csv
+        {outdir}/data/{year}/{group}/{site}.csv
+
+    return :
+    --------
+        site_files : dict
+            Site CSV file by site id
+    """
+    rng = np.random.default_rng(seed)
+    data_dir = f"{outdir}/data"
+    out_path = f"{data_dir}/{year}/{group}"
+    os.makedirs(out_path, exist_ok=True)
+
+    sites, measures = synthetic_network(group, n_sites, n_measures)
+    pd.DataFrame(sites).to_csv(f"{data_dir}/stations_{group}.csv")
+    measures = pd.DataFrame(measures)
+    measures.to_csv(f"{data_dir}/measures_{group}.csv")
+
+    site_files = {}
+    for site in measures["id_site"].unique():
+        site_file = f"{out_path}/{site}.csv"
+        if os.path.exists(site_file):
+            os.remove(site_file)
+        measures_id = measures[measures["id_site"] == site]["id"].tolist()
+        for month in range(1, 13):
+            sd, ed = get_month_datetimes(f"{year}-01-01T00:00:00Z", month)
+            build_csv_data(
+                synthetic_response(
+                    measures_id,
+                    sd,
+                    ed,
+                    state_mix=state_mix,
+                    gap_rate=gap_rate,
+                    rng=rng,
+                ),
+                site_file
+            )
+        site_files[site] = site_file
+    return site_files
@@ -0,0 +1,238 @@
+import glob
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+from dictionaries import LEASE_MAX_ATTEMPTS, LEASE_TTL, QUEUE_POLL
+
+
+def task_id(*keys):
+    """
+    File name safe id of a task, like 2024-DIDON-SITE
+    """
+    return "-".join(str(key).replace("/", "_") for key in keys)
+
+
+def worker_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def queue_file(path, state, id):
+    """
+    File of a task : tasks/{id}.json (spec), leases/{id}.json (current
+    worker), done/{id}.pkl (result) or failed/{id}.json
+    """
+    suffix = "pkl" if state == "done" else "json"
+    return f"{path}/{state}/{id}.{suffix}"
+
+
+def write_json(data, file):
+    tmp_file = f"{file}.{worker_name()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_file, file)
+
+
+def read_json(file):
+    """
+    json content of a file, None if it was removed meanwhile
+    """
+    try:
+        with open(file) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def init_queue(path, tasks):
+    """
+    Add tasks to a work queue folder on a shared filesystem
+
+    Every worker of a run calls it with the same tasks, existing tasks are
+    kept as they are, so a queue folder is meant for one run.
+
+    input :
+    -------
+        path : str
+            Queue folder
+        tasks : dict
+            json serializable spec by task id, see task_id()
+    """
+    for state in ["tasks", "leases", "done", "failed"]:
+        os.makedirs(f"{path}/{state}", exist_ok=True)
+    for id, spec in tasks.items():
+        spec_file = queue_file(path, "tasks", id)
+        if os.path.exists(spec_file) is False:
+            write_json(spec, spec_file)
+
+
+def task_state(path, id):
+    for state in ["done", "failed"]:
+        if os.path.exists(queue_file(path, state, id)):
+            return state
+    return "pending"
+
+
+def try_lease(path, id, ttl=LEASE_TTL, max_attempts=LEASE_MAX_ATTEMPTS):
+    """
+    Lease a task to this worker
+
+    The lease file is created exclusively. A lease not renewed for ttl
+    seconds (dead or failed worker) is taken over until max_attempts
+    leases were given, then the task is marked failed and its lease
+    removed. The takeover of the n-th lease goes to the single worker
+    creating its marker file {lease}.{n}.takeover exclusively, the lease
+    being then replaced, never removed, so no other worker can create it
+    meanwhile.
+
+    return :
+    --------
+        lease : str
+            Lease file, None if the task is leased to a live worker or
+            failed
+    """
+    lease = queue_file(path, "leases", id)
+    try:
+        fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        info = read_json(lease)
+        try:
+            age = time.time() - os.path.getmtime(lease)
+        except FileNotFoundError:
+            return None
+        if info is None or age < ttl:
+            return None
+        attempts = info["attempts"]
+        if attempts >= max_attempts:
+            write_json(info, queue_file(path, "failed", id))
+            release_lease(lease)
+            return None
+        try:
+            os.close(os.open(f"{lease}.{attempts}.takeover",
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return None
+        write_json(lease_info(attempts + 1), lease)
+        return lease
+    with os.fdopen(fd, "w") as f:
+        json.dump(lease_info(1), f)
+    return lease
+
+
+def lease_info(attempts):
+    return {
+        "worker": worker_name(),
+        "attempts": attempts,
+        "leased_at": time.time(),
+    }
+
+
+@contextmanager
+def hold_lease(lease, ttl=LEASE_TTL):
+    """
+    Renew a lease (its mtime) every ttl / 3 seconds within the block
+    """
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(ttl / 3):
+            try:
+                os.utime(lease)
+            except FileNotFoundError:
+                return
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def release_lease(lease, expire=False):
+    """
+    Remove a lease with its takeover markers, or expire it so the task is
+    leased again with its attempts count (nothing if another worker took
+    it over)
+    """
+    if expire:
+        files = [lease]
+    else:
+        files = [lease] + glob.glob(f"{lease}.*.takeover")
+    for file in files:
+        try:
+            if expire:
+                os.utime(file, (0, 0))
+            else:
+                os.remove(file)
+        except FileNotFoundError:
+            pass
+
+
+def run_queue(path, work, ids=None, ttl=LEASE_TTL,
+              max_attempts=LEASE_MAX_ATTEMPTS, poll=QUEUE_POLL):
+    """
+    Run the tasks of a queue with the other workers sharing it
+
+    Each pending task is leased, run by work(id, spec) and its result
+    pickled to done/{id}.pkl. A task raising an error is left to another
+    lease (of any worker) right away. Returns when every task is done or
+    failed, waiting for the tasks leased to other workers, so a worker
+    takes over the tasks of dead ones.
+
+    input :
+    -------
+        path : str
+            Queue folder, see init_queue()
+        work : function
+            work(id, spec) returns the pickable result of a task
+        ids : list
+            Tasks to run, Default = None (every task of the queue)
+    return :
+    --------
+        states : dict
+            "done" or "failed" by task id
+    """
+    if ids is None:
+        ids = sorted(
+            f[:-len(".json")] for f in os.listdir(f"{path}/tasks")
+            if f.endswith(".json")
+        )
+    while True:
+        pending = [id for id in ids if task_state(path, id) == "pending"]
+        if len(pending) == 0:
+            return {id: task_state(path, id) for id in ids}
+        leased = False
+        for id in pending:
+            lease = try_lease(path, id, ttl, max_attempts)
+            if lease is None:
+                continue
+            if task_state(path, id) != "pending":
+                release_lease(lease)
+                continue
+            leased = True
+            spec = read_json(queue_file(path, "tasks", id))
+            try:
+                with hold_lease(lease, ttl):
+                    result = work(id, spec)
+            except (Exception, SystemExit) as error:
+                print(f"Task {id} failed : {error}")
+                release_lease(lease, expire=True)
+                continue
+            done_file = queue_file(path, "done", id)
+            tmp_file = f"{done_file}.{worker_name()}.tmp"
+            pd.to_pickle(result, tmp_file)
+            os.replace(tmp_file, done_file)
+            release_lease(lease)
+        if not leased:
+            time.sleep(poll)
+
+
+def task_result(path, id):
+    return pd.read_pickle(queue_file(path, "done", id))
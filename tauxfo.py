@@ -0,0 +1,249 @@
+import sys
+import os
+import argparse
+import runpy
+import datetime as dt
+
+# Imports of pandas, requests and the src modules are done by the
+# subcommands, so python -m tauxfo -h and light subcommands start fast
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Subcommands running an existing script with the remaining arguments
+SCRIPTS = {
+    "metadata": "get_physicals_and_site_info",
+    "fetch": "get_data",
+    "rates": "compute_rates",
+    "outliers": "outliers",
+    "gaps": "find_gaps",
+    "plots": "plot_series",
+    "window": "rate_window",
+    "watch": "watch",
+}
+
+
+def run_script(name, argv):
+    sys.argv = [f"{name}.py"] + argv
+    runpy.run_module(name, run_name="__main__", alter_sys=True)
+
+
+def run_group(group, metadata, session, args, year, month):
+    """
+    Fetch a year of a group and compute its rates in memory
+
+    Every site month goes from the api response to count_months() without
+    going through the site CSV, which is only written with -persist. The
+    group rate files are written as compute_rates.py does.
+    """
+    from src.dictionaries import DATA_FORMATS
+    from src.storage import measures_to_frame, site_data_path
+    from src.storage import write_month_data
+    from src.manifest import (
+        read_manifest,
+        record_month,
+        stamp_entry,
+        truncate_site_file,
+        write_manifest,
+    )
+    from src.fonctions import (
+        build_csv_data,
+        build_rate_tables,
+        combine_month_counts,
+        complete_month_counts,
+        count_months,
+        get_month_datetimes,
+        map_request_xr,
+        write_rate_files,
+    )
+    from compute_rates import group_rate_buffers
+
+    phy_names = {
+        id: measure["phy_name"]
+        for id, measure in metadata["measures"].items()
+    }
+    data_path = f"{args.outdir}/data/{year}/{group}"
+    persist = args.persist in DATA_FORMATS
+    manifest = read_manifest(data_path) if persist else {}
+
+    sites = metadata["sites"][group]
+    requests_kwargs = []
+    for site in sites:
+        measures_id = metadata["site_measures"][group].get(site, [])
+        if persist:
+            os.makedirs(data_path, exist_ok=True)
+            manifest[site] = truncate_site_file(
+                manifest.get(site),
+                site_data_path(data_path, site, args.persist),
+                1
+            )
+        for m in range(1, month + 1):
+            sd, ed = get_month_datetimes(f"{year}-01-01T00:00:00Z", m)
+            requests_kwargs.append(
+                dict(folder="data",
+                     fromtime=sd,
+                     totime=ed,
+                     measures=",".join(measures_id),
+                     base_url=args.api_url,
+                     max_url_length=args.max_url_length,
+                     max_points=args.max_points)
+            )
+    responses = map_request_xr(requests_kwargs,
+                               session,
+                               workers=args.workers)
+
+    site_tables = []
+    for site in sites:
+        measures_id = metadata["site_measures"][group].get(site, [])
+        site_path = site_data_path(data_path, site, args.persist)
+        month_counts = []
+        for m in range(1, month + 1):
+            response = list(next(responses))
+            data = measures_to_frame(response)
+            month_counts.append(count_months(data, month))
+            if not persist:
+                continue
+            if args.persist == "csv":
+                offset = (os.path.getsize(site_path)
+                          if os.path.exists(site_path) else 0)
+                rows, last_date = build_csv_data(response, site_path)
+            else:
+                offset = 0
+                rows, last_date = write_month_data(response,
+                                                   site_path,
+                                                   m,
+                                                   args.persist)
+            _, totime = get_month_datetimes(f"{year}-01-01T00:00:00Z", m)
+            manifest[site] = record_month(manifest[site], site_path, m,
+                                          offset, rows, last_date, totime,
+                                          measures_id)
+        if persist:
+            manifest[site] = stamp_entry(manifest[site], site_path)
+            write_manifest(manifest, data_path)
+        if len(measures_id) == 0:
+            continue
+        counts = complete_month_counts(
+            site,
+            combine_month_counts(month_counts),
+            month
+        )
+        site_tables.append(
+            build_rate_tables(site, counts, phy_names, year, month)
+        )
+        print(f"{group} {site} done")
+
+    write_rate_files(
+        group_rate_buffers(site_tables),
+        f"{args.outdir}/rates/{year}/{group}"
+    )
+
+
+def run(argv):
+    from src.dictionaries import (
+        DATA_FORMATS,
+        GROUP_LIST,
+        MAX_POINTS,
+        MAX_URL_LENGTH,
+        YEAR_NOW,
+    )
+    from src.fonctions import list_of_strings
+
+    parser = argparse.ArgumentParser(
+        prog="tauxfo run",
+        description="""
+Refresh the station metadata, fetch the
+data of a year and compute its rates in a
+single process, without writing and reading
+back the site data (see -persist)
+        """,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument("-o", "--outdir", type=str, default=".",
+                        help="Output path directory", metavar="\b")
+    parser.add_argument("-y", "--year", type=int, default=YEAR_NOW,
+                        help="Year to process", metavar="\b")
+    parser.add_argument("-g", "--group", type=list_of_strings,
+                        default=GROUP_LIST, help="Stations group",
+                        metavar="\b")
+    parser.add_argument("-sl", "--station_list_path", type=str,
+                        default="./data", help="stations_GROUP.csv path",
+                        metavar="\b")
+    parser.add_argument("-api", "--api_url", type=str, default="",
+                        help="XR rest api root (default XR_API_URL)",
+                        metavar="\b")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of parallel requests", metavar="\b")
+    parser.add_argument("-mh", "--max_per_host", type=int, default=4,
+                        help="Max simultaneous connections to the api",
+                        metavar="\b")
+    parser.add_argument("-mu", "--max_url_length", type=int,
+                        default=MAX_URL_LENGTH,
+                        help="Split requests with longer urls (0 no limit)",
+                        metavar="\b")
+    parser.add_argument("-mp", "--max_points", type=int,
+                        default=MAX_POINTS,
+                        help="Split requests of more time steps (0 no limit)",
+                        metavar="\b")
+    parser.add_argument("-persist", type=str, default="none",
+                        choices=["none"] + DATA_FORMATS,
+                        help="Also write the fetched data (csv, parquet, "
+                        "feather)",
+                        metavar="\b")
+    parser.add_argument("--cache", type=str, default="",
+                        help="Folder of an api response cache",
+                        metavar="\b")
+    parser.add_argument("-no_metadata", action="store_true",
+                        help="Use the station files of -sl as they are")
+    args = parser.parse_args(argv)
+
+    from src.fonctions import get_session
+    from src.cache import open_cache
+    from src.metadata import fetch_metadata, load_metadata
+
+    cache = open_cache(args.cache) if args.cache else None
+    session = get_session(max_per_host=args.max_per_host, cache=cache)
+    if not args.no_metadata:
+        print("Refreshing station metadata ...")
+        fetch_metadata(args.station_list_path, args.group, args.api_url,
+                       session)
+    metadata = load_metadata(args.station_list_path, args.group)
+
+    if args.year != YEAR_NOW:
+        year, month = args.year, 12
+    else:
+        year, month = YEAR_NOW, dt.datetime.now().month
+    for group in args.group:
+        print(f"Processing {group} ...")
+        run_group(group, metadata, session, args, year, month)
+    print("DONE")
+
+
+def main():
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, os.path.join(ROOT, "src"))
+    parser = argparse.ArgumentParser(
+        prog="tauxfo",
+        description="""
+tauxfo commands :
+    run        metadata, fetch and rates in one process
+    metadata   get_physicals_and_site_info.py
+    fetch      get_data.py
+    rates      compute_rates.py
+    outliers   outliers.py
+    gaps       find_gaps.py
+    plots      plot_series.py
+    window     rate_window.py
+    watch      watch.py
+Run tauxfo COMMAND -h for the options of a command.
+        """,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument("command", choices=["run"] + list(SCRIPTS),
+                        metavar="COMMAND")
+    command = parser.parse_args(sys.argv[1:2]).command
+    if command == "run":
+        run(sys.argv[2:])
+    else:
+        run_script(SCRIPTS[command], sys.argv[2:])
+
+
+if __name__ == "__main__":
+    main()
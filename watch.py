@@ -0,0 +1,252 @@
+import sys
+sys.path.insert(0, "./src")
+
+import datetime as dt
+import argparse
+import time
+import pandas as pd
+
+from src.dictionaries import DATA_FORMATS, GROUP_LIST, RATE_VARS
+
+from src.storage import files_signature, site_data_files, site_data_path
+
+from src.manifest import read_manifest
+
+from src.metadata import load_metadata, metadata_sources, source_signature
+
+from src.checkpoint import checkpoint_path
+
+from src.rate_api import set_group_rates, start_rate_server
+
+from src.fonctions import list_of_strings, write_rate_files
+
+from compute_rates import compute_site, group_rate_buffers
+
+
+def processed_period(year):
+    """
+    (year, last month) to compute, as compute_rates.py
+    """
+    now = dt.datetime.now()
+    if year is None or year == now.year:
+        return now.year, now.month
+    return year, 12
+
+
+def refresh_group(group, state, metadata, args, server):
+    """
+    Recompute the sites of a group whose data files changed since the last
+    call, then rewrite the group rate files and publish them
+
+    state keeps by site its files signature and its last rate tables, it
+    is reset when the processed month changes. Sites whose files were
+    removed are dropped from it. The rate files are only written once
+    every site of the group has rate tables, as compute_rates.py, a
+    change waiting for the missing sites.
+
+    return :
+    --------
+        updated : list
+            Recomputed sites
+    """
+    year, month = processed_period(args.year)
+    if state.get("period") != (year, month):
+        state.clear()
+        state["period"] = (year, month)
+        state["sites"] = {}
+    data_path = f"{args.indir}/data/{year}/{group}"
+    phy_names = {
+        id: measure["phy_name"]
+        for id, measure in metadata["measures"].items()
+    }
+
+    site_list = metadata["sites"][group]
+    manifest = None
+    updated = []
+    for site in site_list:
+        site_path = site_data_path(data_path, site, args.format)
+        signature = files_signature(site_data_files(site_path, args.format))
+        site_state = state["sites"].get(site)
+        if len(signature) == 0:
+            if state["sites"].pop(site, None) is not None:
+                state["changed"] = True
+            continue
+        if site_state is not None and site_state["signature"] == signature:
+            continue
+        if manifest is None:
+            manifest = read_manifest(data_path)
+        try:
+            rate_tables, pert_repport, _ = compute_site(
+                site,
+                site_path,
+                args.format,
+                phy_names,
+                year,
+                month,
+                manifest.get(site),
+                checkpoint_path(args.outdir, year, group, site),
+            )
+        except (Exception, SystemExit) as error:
+            # Incomplete data (being fetched or appended), retried at the
+            # next poll
+            print(f"{group} {site} : {error!r}")
+            continue
+        state["sites"][site] = {
+            "signature": signature,
+            "tables": (rate_tables, pert_repport),
+        }
+        state["changed"] = True
+        updated.append(site)
+
+    missing = [site for site in site_list if site not in state["sites"]]
+    if not state.get("changed") or len(missing) > 0:
+        if len(updated) > 0:
+            print(f"{group} : rate files wait for {', '.join(missing)}")
+        return updated
+
+    site_tables = [state["sites"][site]["tables"] for site in site_list]
+    write_rate_files(
+        group_rate_buffers(site_tables),
+        f"{args.outdir}/rates/{year}/{group}"
+    )
+    set_group_rates(
+        server,
+        group,
+        year,
+        month,
+        {
+            var: pd.concat(
+                [tables[var] for tables, _ in site_tables],
+                ignore_index=True
+            )
+            for var in RATE_VARS
+        },
+        pd.concat(
+            [pert_repport for _, pert_repport in site_tables],
+            ignore_index=True
+        ),
+    )
+    state["changed"] = False
+    return updated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""
+This script keep the rates of groups
+of measuring stations up to date :
+it watch data/{year}/{group} for new
+or modified site data, recompute the
+rates of the changed sites only and
+serve the current rates as json on
+http://host:port/rates/{group}[/{rate}]
+            """,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "-i",
+        "--indir",
+        type=str,
+        default=".",
+        help="input data path directory",
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-o",
+        "--outdir",
+        type=str,
+        default=".",
+        help="Output path directory",
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-y",
+        "--year",
+        type=int,
+        help="Year to compute (default current year)",
+        default=None,
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-g", "--group",
+        help="Station group to process",
+        type=list_of_strings,
+        default=GROUP_LIST,
+        metavar="\b",
+    )
+    parser.add_argument(
+        "-sl",
+        "--station_list_path",
+        type=str,
+        help="""path/to/folder/stations_group.csv
+        from get_physicals_and_site_info.py""",
+        default="./data",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        choices=DATA_FORMATS,
+        help="Data storage format (csv, parquet, feather)",
+        default="csv",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-t",
+        "--interval",
+        type=float,
+        help="Seconds between two scans of the data folders",
+        default=60,
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-host",
+        type=str,
+        help="Rate api address",
+        default="127.0.0.1",
+        metavar="\b"
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        type=int,
+        help="Rate api port",
+        default=8080,
+        metavar="\b"
+    )
+
+    args = parser.parse_args()
+
+    server = start_rate_server(host=args.host, port=args.port)
+    print(f"Serving rates on {server.url}")
+
+    sources = metadata_sources(args.station_list_path, args.group)
+    signature = source_signature(sources)
+    metadata = load_metadata(args.station_list_path, args.group)
+    states = {group: {} for group in args.group}
+    try:
+        while True:
+            try:
+                new_signature = source_signature(sources)
+                if new_signature != signature:
+                    metadata = load_metadata(args.station_list_path,
+                                             args.group)
+                    signature = new_signature
+                    states = {group: {} for group in args.group}
+            except Exception as error:
+                # Metadata files being rewritten, reloaded at the next poll
+                print(f"Metadata not reloaded : {error!r}")
+            for group in args.group:
+                updated = refresh_group(group,
+                                        states[group],
+                                        metadata,
+                                        args,
+                                        server)
+                if len(updated) > 0:
+                    print(f"{dt.datetime.now():%Y-%m-%d %H:%M:%S} {group} : "
+                          f"{len(updated)} sites updated")
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print("Stopped.")